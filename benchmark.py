@@ -0,0 +1,412 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import platform
+import statistics
+import tempfile
+import PIL
+from PIL import Image, ImageDraw
+from sorter_core import (IMAGE_EXTENSIONS, JOURNAL_FILE, METADATA_FILE, STAGE_TIMER, GifStreamer,
+                         ImagePyramid, SortingSession, fit_size, percentile, scale_to_box)
+
+# Размеры тестовых корпусов: изображения разных форматов и мегапикселей,
+# анимированный GIF, папка для сканирования и перемещения с совпадающими именами
+SCALES = {
+    "small": {
+        "megapixels": [1, 4],
+        "formats": ["JPEG", "PNG", "WEBP", "BMP"],
+        "images_per_size": 2,
+        "gif_frames": 60,
+        "gif_size": (480, 360),
+        "scan_files": 10000,
+        "move_files": 2000,
+        "collisions": 500,
+    },
+    "medium": {
+        "megapixels": [1, 4, 12],
+        "formats": ["JPEG", "PNG", "WEBP", "BMP"],
+        "images_per_size": 3,
+        "gif_frames": 200,
+        "gif_size": (640, 480),
+        "scan_files": 50000,
+        "move_files": 10000,
+        "collisions": 2000,
+    },
+    "large": {
+        "megapixels": [1, 4, 12, 24],
+        "formats": ["JPEG", "PNG", "WEBP", "BMP"],
+        "images_per_size": 4,
+        "gif_frames": 400,
+        "gif_size": (800, 600),
+        "scan_files": 200000,
+        "move_files": 20000,
+        "collisions": 5000,
+    },
+}
+
+EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp", "BMP": ".bmp"}
+
+# Размеры окна, под которые масштабируется изображение
+DISPLAY_BOX = (900, 760)
+RESIZE_BOXES = [(1600, 1000), (1200, 800), (900, 760), (640, 480)]
+
+def synthetic_image(rng, size):
+    """Детерминированное изображение: градиенты по каналам и случайные фигуры"""
+    width, height = size
+    channels = []
+    for _ in range(3):
+        gradient = Image.linear_gradient('L').rotate(rng.randrange(360)).resize(size)
+        channels.append(gradient)
+    image = Image.merge('RGB', channels)
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rng.randrange(width), rng.randrange(height)
+        w, h = rng.randrange(width // 20 + 1, width // 4 + 2), rng.randrange(height // 20 + 1, height // 4 + 2)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        if rng.random() < 0.5:
+            draw.ellipse([x, y, x + w, y + h], fill=color)
+        else:
+            draw.rectangle([x, y, x + w, y + h], fill=color)
+    return image
+
+def megapixel_size(megapixels):
+    """Размер 3:2 с заданным числом мегапикселей"""
+    height = int((megapixels * 1000000 / 1.5) ** 0.5)
+    return int(height * 1.5), height
+
+def corpus_signature(spec, seed):
+    data = json.dumps({"spec": spec, "seed": seed, "pillow": PIL.__version__}, sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+def generate_corpus(path, spec, seed=1):
+    """Создает корпус в path, если его еще нет или он построен с другими параметрами.
+    Структура: images/ (форматы и размеры), gif/, scan/ (много мелких файлов)"""
+    manifest_path = os.path.join(path, "corpus.json")
+    signature = corpus_signature(spec, seed)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            if json.load(f).get("signature") == signature:
+                return
+        shutil.rmtree(path)
+    os.makedirs(path, exist_ok=True)
+    rng = random.Random(seed)
+
+    images_dir = os.path.join(path, "images")
+    os.makedirs(images_dir)
+    for megapixels in spec["megapixels"]:
+        size = megapixel_size(megapixels)
+        for number in range(spec["images_per_size"]):
+            image = synthetic_image(rng, size)
+            for fmt in spec["formats"]:
+                name = f"{megapixels:02d}mp_{number}{EXTENSIONS[fmt]}"
+                options = {"quality": 90} if fmt in ("JPEG", "WEBP") else {}
+                image.save(os.path.join(images_dir, name), fmt, **options)
+
+    gif_dir = os.path.join(path, "gif")
+    os.makedirs(gif_dir)
+    base = synthetic_image(rng, spec["gif_size"])
+    frames = [base.rotate(index * 360 / spec["gif_frames"]).convert('P', palette=Image.Palette.ADAPTIVE)
+              for index in range(spec["gif_frames"])]
+    frames[0].save(os.path.join(gif_dir, "animated.gif"), save_all=True,
+                   append_images=frames[1:], duration=40, loop=0)
+
+    # Мелкие файлы одинакового содержимого: для сканирования и перемещений важны имена, а не пиксели
+    scan_dir = os.path.join(path, "scan")
+    os.makedirs(scan_dir)
+    tiny = synthetic_image(rng, (64, 48))
+    tiny_path = os.path.join(path, "tiny.jpg")
+    tiny.save(tiny_path, quality=80)
+    with open(tiny_path, 'rb') as f:
+        tiny_bytes = f.read()
+    for number in range(spec["scan_files"]):
+        with open(os.path.join(scan_dir, f"img_{number:06d}.jpg"), 'wb') as f:
+            f.write(tiny_bytes)
+
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump({"signature": signature, "spec": spec, "seed": seed}, f, indent=4)
+
+def summarize(samples):
+    """Медиана, p95 и минимум в миллисекундах"""
+    values = [sample * 1000 for sample in samples]
+    return {"median_ms": statistics.median(values), "p95_ms": percentile(values, 0.95),
+            "min_ms": min(values)}
+
+def list_images(folder):
+    return sorted(name for name in os.listdir(folder)
+                  if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS)
+
+def close_session(session):
+    """Закрывает сессию и удаляет созданные ею журнал и кэш, чтобы корпус не менялся между запусками"""
+    session.close()
+    for name in (JOURNAL_FILE, METADATA_FILE):
+        path = os.path.join(session.app_path, name)
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+def bench_scan(corpus, repeat):
+    """Аналог load_images: время до первой пачки и до конца сканирования"""
+    first, total = [], []
+    for _ in range(repeat):
+        session = SortingSession(os.path.join(corpus, "scan"))
+        try:
+            started = time.perf_counter()
+            session.start_scan()
+            first_batch = None
+            finished = False
+            while not finished:
+                added, finished = session.poll_scan()
+                if added and first_batch is None:
+                    first_batch = time.perf_counter() - started
+                if not finished:
+                    time.sleep(0.001)
+            total.append(time.perf_counter() - started)
+            first.append(first_batch if first_batch is not None else total[-1])
+            files = len(session.image_files)
+        finally:
+            close_session(session)
+    return {"files": files, "first_batch": summarize(first), "total": summarize(total)}
+
+def bench_show_image(corpus, repeat, decode_backend="threads"):
+    """Аналог show_image: холодное декодирование и повторный показ из кэша"""
+    images_dir = os.path.join(corpus, "images")
+    session = SortingSession(images_dir)
+    session.decode_backend = decode_backend
+    session.start_decoder()
+    results = {}
+    try:
+        for name in list_images(images_dir):
+            path = os.path.join(images_dir, name)
+            group = name.split('_')[0] + os.path.splitext(name)[1]
+            cold, warm = [], []
+            for _ in range(repeat):
+                session.display_cache.clear()
+                started = time.perf_counter()
+                session.load_display_image(path, DISPLAY_BOX)
+                cold.append(time.perf_counter() - started)
+                started = time.perf_counter()
+                session.load_display_image(path, DISPLAY_BOX)
+                warm.append(time.perf_counter() - started)
+            entry = results.setdefault(group, {"cold": [], "warm": []})
+            entry["cold"].extend(cold)
+            entry["warm"].extend(warm)
+    finally:
+        close_session(session)
+    return {group: {"cold": summarize(entry["cold"]), "warm": summarize(entry["warm"])}
+            for group, entry in sorted(results.items())}
+
+def bench_resize(corpus, repeat):
+    """Аналог update_image_size: быстрое превью и итоговый LANCZOS с уровня пирамиды"""
+    images_dir = os.path.join(corpus, "images")
+    path = os.path.join(images_dir, [name for name in list_images(images_dir) if name.endswith(".jpg")][-1])
+    with Image.open(path) as image:
+        base = scale_to_box(image, (1920, 1080), allow_upscale=False)
+    pyramid = ImagePyramid(base)
+    preview, final = [], []
+    for _ in range(repeat):
+        for box in RESIZE_BOXES:
+            size = fit_size(pyramid.size, box)
+            started = time.perf_counter()
+            pyramid.render(size, Image.Resampling.BILINEAR)
+            preview.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            pyramid.render(size, Image.Resampling.LANCZOS)
+            final.append(time.perf_counter() - started)
+    return {"source": os.path.basename(path), "preview": summarize(preview), "final": summarize(final)}
+
+def bench_gif(corpus, repeat):
+    """Загрузка GIF: первый кадр и декодирование всего цикла фоновым потоком"""
+    path = os.path.join(corpus, "gif", "animated.gif")
+    first, loop = [], []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        with Image.open(path) as image:
+            n_frames = image.n_frames
+            scale_to_box(image, DISPLAY_BOX)
+        first.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        streamer = GifStreamer(path, DISPLAY_BOX, 1, n_frames, 16, loop=False)
+        received = 1
+        while received < n_frames:
+            streamer.frames.get()
+            received += 1
+        loop.append(time.perf_counter() - started)
+        streamer.stop(wait=True)
+    return {"frames": n_frames, "first_frame": summarize(first), "full_loop": summarize(loop),
+            "frames_per_s": n_frames / statistics.median(loop)}
+
+def bench_moves(corpus, spec, workdir):
+    """Аналог move_to_folder и undo_last_action на копии мелких файлов.
+    Часть имен уже занята в папке назначения, чтобы проверить подбор суффиксов"""
+    app_path = os.path.join(workdir, "moves")
+    shutil.rmtree(app_path, ignore_errors=True)
+    os.makedirs(os.path.join(app_path, "Target"))
+    source = os.path.join(corpus, "scan")
+    names = list_images(source)[:spec["move_files"]]
+    for name in names:
+        shutil.copyfile(os.path.join(source, name), os.path.join(app_path, name))
+    for name in names[:spec["collisions"]]:
+        shutil.copyfile(os.path.join(source, name), os.path.join(app_path, "Target", name))
+
+    session = SortingSession(app_path)
+    try:
+        session.folders = session.get_existing_folders()
+        session.start_scan()
+        finished = False
+        while not finished:
+            _, finished = session.poll_scan()
+            time.sleep(0.001)
+        session.set_current(0)
+
+        # Постановка в очередь (то, что чувствует пользователь) и полное выполнение
+        started = time.perf_counter()
+        submit = []
+        while session.image_files:
+            moved = time.perf_counter()
+            session.move_current(0)
+            submit.append(time.perf_counter() - moved)
+            if session.image_files:
+                session.set_current(session.current_index)
+        while session.moves_in_flight:
+            session.poll_move_results()
+            time.sleep(0.001)
+        total = time.perf_counter() - started
+
+        undo = []
+        for _ in range(min(len(session.move_history), 1000)):
+            started = time.perf_counter()
+            session.undo_last()
+            # Отмена выполняется в фоне - замеряем до возврата файла на место
+            while session.moves_in_flight:
+                session.poll_move_results()
+                time.sleep(0.001)
+            undo.append(time.perf_counter() - started)
+        return {"files": len(names), "collisions": spec["collisions"], "submit": summarize(submit),
+                "moves_per_s": len(names) / total, "undo": summarize(undo)}
+    finally:
+        session.close()
+        shutil.rmtree(app_path, ignore_errors=True)
+
+BENCHMARKS = ["scan", "show_image", "resize", "gif", "moves"]
+
+def run_benchmarks(corpus, spec, repeat, only, workdir, decode_backend="threads"):
+    results = {}
+    for name in BENCHMARKS:
+        if only and name not in only:
+            continue
+        print(f"Running {name}...", file=sys.stderr)
+        if name == "scan":
+            results[name] = bench_scan(corpus, repeat)
+        elif name == "show_image":
+            results[name] = bench_show_image(corpus, repeat, decode_backend)
+        elif name == "resize":
+            results[name] = bench_resize(corpus, repeat)
+        elif name == "gif":
+            results[name] = bench_gif(corpus, repeat)
+        elif name == "moves":
+            results[name] = bench_moves(corpus, spec, workdir)
+    return results
+
+def flatten(results, prefix=""):
+    """{"a": {"b": 1}} -> {"a.b": 1} (только числовые значения)"""
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+def compare(results, baseline, threshold):
+    """Сравнивает медианы и пропускную способность с сохраненным базовым запуском.
+    Минимум и p95 слишком шумные для порога, поэтому только выводятся в JSON. Возвращает список регрессий"""
+    current = flatten(results)
+    previous = flatten(baseline.get("results", {}))
+    regressions = []
+    for name in sorted(current):
+        if name not in previous or not previous[name]:
+            continue
+        if name.endswith("median_ms"):
+            change = current[name] / previous[name] - 1
+        elif name.endswith("_per_s"):
+            # Для пропускной способности больше - лучше
+            change = previous[name] / current[name] - 1 if current[name] else float('inf')
+        else:
+            continue
+        marker = ""
+        if change > threshold:
+            marker = "  REGRESSION"
+            regressions.append(name)
+        elif change < -threshold:
+            marker = "  improved"
+        print(f"{name:<45} {previous[name]:>12.3f} {current[name]:>12.3f} {change:>+8.1%}{marker}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Image Sorter performance benchmarks")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small", help="corpus size")
+    parser.add_argument("--corpus", help="corpus folder (generated on first use, reused afterwards)")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the synthetic corpus")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions of each measurement")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, help="run only these benchmarks")
+    parser.add_argument("--decode-backend", choices=["threads", "processes"], default="threads",
+                        help="decoder used by the show_image benchmark")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="compare with a results file from an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="relative slowdown reported as a regression (default 0.10)")
+    args = parser.parse_args(argv)
+
+    spec = SCALES[args.scale]
+    corpus = args.corpus or os.path.join(tempfile.gettempdir(), f"image_sorter_corpus_{args.scale}_{args.seed}")
+    print(f"Preparing corpus in {corpus}...", file=sys.stderr)
+    started = time.perf_counter()
+    generate_corpus(corpus, spec, args.seed)
+    print(f"Corpus ready in {time.perf_counter() - started:.1f} s", file=sys.stderr)
+
+    # Замеры по этапам внутри sorter_core (открытие, декодирование, масштабирование, перемещение)
+    STAGE_TIMER.enabled = True
+    workdir = tempfile.mkdtemp(prefix="image_sorter_bench_")
+    try:
+        results = run_benchmarks(corpus, spec, args.repeat, args.only, workdir, args.decode_backend)
+        results["stages"] = {row.pop("stage"): row for row in STAGE_TIMER.snapshot()}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "scale": args.scale,
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "decode_backend": args.decode_backend,
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) above {args.threshold:.0%}", file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,554 @@
 import os
 import sys
-import json
 import shutil
 import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog
 from PIL import Image, ImageTk
-import threading
+import io
+import queue
 import time
+import types
+import multiprocessing
 import subprocess  # Добавляем импорт для запуска проводника
+from sorter_core import (DisplayCache, GifStreamer, MemoryBudgetError, SortingSession, build_pyramid,
+                         fit_size, image_nbytes, main_batch, open_source, scale_to_box, source_stat,
+                         split_archive_path)
+
+# Физические коды клавиш: имя клавиши -> (keysym, код на Windows, код на X11).
+# Коды не зависят от раскладки, поэтому горячая клавиша срабатывает и в русской раскладке
+KEY_CODES = {
+    'space': ('space', 32, 65), 'Left': ('Left', 37, 113), 'Right': ('Right', 39, 114),
+    'Up': ('Up', 38, 111), 'Down': ('Down', 40, 116), 'Return': ('Return', 13, 36),
+    'BackSpace': ('BackSpace', 8, 22), 'Delete': ('Delete', 46, 119), 'Escape': ('Escape', 27, 9),
+    'Tab': ('Tab', 9, 23), 'Home': ('Home', 36, 110), 'End': ('End', 35, 115),
+    'Prior': ('Prior', 33, 112), 'Page_Up': ('Prior', 33, 112), 'Next': ('Next', 34, 117), 'Page_Down': ('Next', 34, 117),
+    '-': ('minus', 189, 20), '=': ('equal', 187, 21), '[': ('bracketleft', 219, 34), ']': ('bracketright', 221, 35),
+    ';': ('semicolon', 186, 47), "'": ('apostrophe', 222, 48), '`': ('grave', 192, 49), '\\': ('backslash', 220, 51),
+    ',': ('comma', 188, 59), '.': ('period', 190, 60), '/': ('slash', 191, 61),
+}
+KEY_CODES.update({f'F{n}': (f'F{n}', 111 + n, 66 + n if n <= 10 else 84 + n) for n in range(1, 13)})
+KEY_CODES.update({letter: (letter, ord(letter.upper()), code)
+                  for letter, code in zip("qwertyuiopasdfghjklzxcvbnm",
+                                          list(range(24, 34)) + list(range(38, 47)) + list(range(52, 59)))})
+KEY_CODES.update({str(digit): (str(digit), 48 + digit, 19 if digit == 0 else 9 + digit) for digit in range(10)})
+# Цифры дополнительной клавиатуры
+KEYPAD_CODES = {digit: (96 + digit, (90, 87, 88, 89, 83, 84, 85, 79, 80, 81)[digit]) for digit in range(10)}
+
+# Модификаторы в event.state; NumLock и CapsLock не учитываются
+SHIFT, CONTROL = 0x1, 0x4
+ALT = {'win32': 0x20000, 'x11': 0x8}
+
+class Filmstrip:
+    """Виртуализированная лента миниатюр очереди изображений.
+    PhotoImage создаются только для ячеек, попадающих в видимую область"""
+    CELL = 104  # Размер ячейки в пикселях
+    PADDING = 4
+
+    def __init__(self, parent, sorter):
+        self.sorter = sorter
+        self.frame = ttk.Frame(parent)
+        self.canvas = tk.Canvas(self.frame, height=self.CELL, background="#2b2b2b",
+                                highlightthickness=0)
+        self.scrollbar = ttk.Scrollbar(self.frame, orient=tk.HORIZONTAL, command=self.on_scroll)
+        self.canvas.configure(xscrollcommand=self.scrollbar.set)
+        self.canvas.pack(fill=tk.X)
+        self.scrollbar.pack(fill=tk.X)
+        
+        self.thumbnails = DisplayCache(32 * 1024 * 1024)  # Декодированные миниатюры по пути
+        sorter.session.memory.add_pool(self.thumbnails)
+        self.photos = {}  # путь -> PhotoImage для видимых ячеек
+        self.requested = set()  # Файлы, миниатюры которых уже запрошены у индексатора
+        self.ready = queue.Queue()  # Файлы, для которых индексатор построил миниатюры
+        self.refresh_timer = None
+        
+        self.canvas.bind("<Configure>", lambda e: self.schedule_refresh())
+        self.canvas.bind("<Button-1>", self.on_click)
+        self.canvas.bind("<MouseWheel>", self.on_mouse_wheel)  # Windows
+        self.canvas.bind("<Button-4>", lambda e: self.on_scroll("scroll", -3, "units"))  # X11
+        self.canvas.bind("<Button-5>", lambda e: self.on_scroll("scroll", 3, "units"))
+        self.poll_ready()
+
+    def on_indexed(self, path, meta):
+        """Вызывается индексатором из фонового потока"""
+        if path in self.requested:
+            self.ready.put(path)
+
+    def poll_ready(self):
+        """Перерисовывает ленту, когда для видимых ячеек появились миниатюры"""
+        updated = False
+        while True:
+            try:
+                self.requested.discard(self.ready.get_nowait())
+                updated = True
+            except queue.Empty:
+                break
+        if updated:
+            self.schedule_refresh()
+        self.canvas.after(150, self.poll_ready)
+
+    def on_scroll(self, *args):
+        self.canvas.xview(*args)
+        self.schedule_refresh()
+
+    def on_mouse_wheel(self, event):
+        self.on_scroll("scroll", -3 if event.delta > 0 else 3, "units")
+
+    def on_click(self, event):
+        index = int(self.canvas.canvasx(event.x) // self.CELL)
+        if not 0 <= index < len(self.sorter.session.image_files):
+            return
+        if event.state & 0x1:  # Shift - выделение диапазона
+            self.sorter.select_range(index)
+        elif event.state & 0x4:  # Ctrl - выделение отдельного файла
+            self.sorter.toggle_selection(index)
+        else:
+            self.sorter.show_image(index)
+
+    def schedule_refresh(self):
+        """Объединяет несколько изменений в одну перерисовку"""
+        if not self.refresh_timer:
+            self.refresh_timer = self.canvas.after_idle(self.refresh)
+
+    def visible_range(self):
+        left = self.canvas.canvasx(0)
+        width = self.canvas.winfo_width()
+        first = max(0, int(left // self.CELL))
+        last = min(len(self.sorter.session.image_files), int((left + width) // self.CELL) + 1)
+        return first, last
+
+    def scroll_to(self, index):
+        """Прокручивает ленту так, чтобы ячейка index была видна"""
+        first, last = self.visible_range()
+        total = len(self.sorter.session.image_files)
+        if total and not first <= index < last - 1:
+            width = self.canvas.winfo_width()
+            offset = index * self.CELL - (width - self.CELL) / 2
+            self.canvas.xview_moveto(max(0.0, offset / (total * self.CELL)))
+        self.schedule_refresh()
+
+    def refresh(self):
+        """Перерисовывает видимые ячейки"""
+        self.refresh_timer = None
+        files = self.sorter.session.image_files
+        self.canvas.configure(scrollregion=(0, 0, len(files) * self.CELL, self.CELL))
+        self.canvas.delete("all")
+        
+        photos = {}
+        first, last = self.visible_range()
+        for index in range(first, last):
+            path = files[index]
+            x = index * self.CELL
+            if path in self.sorter.session.selection:
+                self.canvas.create_rectangle(x + 1, 1, x + self.CELL - 1, self.CELL - 1,
+                                             fill="#35506e", outline="")
+            if index == self.sorter.session.current_index:
+                self.canvas.create_rectangle(x + 1, 1, x + self.CELL - 1, self.CELL - 1,
+                                             outline="#4a90d9", width=3)
+            photo = self.photos.get(path) or self.make_photo(path)
+            if photo:
+                self.canvas.create_image(x + self.CELL // 2, self.CELL // 2, image=photo)
+                photos[path] = photo
+            else:
+                # Миниатюра еще не готова - рисуем заглушку
+                self.canvas.create_rectangle(x + self.PADDING * 2, self.PADDING * 2,
+                                             x + self.CELL - self.PADDING * 2,
+                                             self.CELL - self.PADDING * 2, outline="#555555")
+        # Ссылки на PhotoImage ячеек, ушедших из видимой области, освобождаются
+        self.photos = photos
+
+    def make_photo(self, path):
+        thumbnail = self.thumbnails.get(path)
+        if thumbnail is None:
+            thumbnail = self.load_thumbnail(path)
+        if thumbnail is None:
+            return None
+        return ImageTk.PhotoImage(thumbnail)
+
+    def cached_thumbnail(self, path):
+        """Миниатюра из памяти или кэша метаданных, без запроса у индексатора"""
+        thumbnail = self.thumbnails.get(path)
+        if thumbnail is None:
+            thumbnail = self.load_thumbnail(path, request=False)
+        return thumbnail
+
+    def load_thumbnail(self, path, request=True):
+        """Берет миниатюру из кэша метаданных или запрашивает ее у индексатора"""
+        metadata = self.sorter.session.metadata
+        if not metadata:
+            return None
+        try:
+            meta = metadata.get(path, source_stat(path))
+        except OSError:
+            return None
+        if meta and meta["thumbnail"]:
+            thumbnail = Image.open(io.BytesIO(meta["thumbnail"]))
+            thumbnail.load()
+            self.thumbnails.put(path, thumbnail)
+            return thumbnail
+        indexer = self.sorter.session.metadata_indexer
+        if request and indexer and path not in self.requested:
+            self.requested.add(path)
+            indexer.prioritize(path)
+        return None
+
+class TiledViewer:
+    """Просмотр текущего изображения с увеличением и перемещением.
+    На Canvas рисуются только плитки, попадающие в видимую область"""
+    ZOOM_STEP = 1.25
+    MAX_ZOOM = 8.0  # Наибольшее увеличение относительно пикселей оригинала
+
+    def __init__(self, parent, sorter):
+        self.sorter = sorter
+        self.canvas = tk.Canvas(parent, background="#1e1e1e", highlightthickness=0)
+        self.active = False
+        self.source = None  # TiledImage текущего файла
+        self.future = None  # Фоновое декодирование источника
+        self.pending_zoom = None  # Увеличение и точка, запрошенные до готовности источника
+        self.scale = 1.0  # Пикселей экрана на пиксель оригинала
+        self.offset = (0, 0)  # Положение левого верхнего угла изображения на Canvas
+        self.photos = {}  # (масштаб, столбец, строка) -> (PhotoImage видимой плитки, плитка окончательная)
+        self.tile_future = None  # Фоновое декодирование плиток в полном разрешении
+        self.drag_start = None
+        self.refresh_timer = None
+        
+        self.canvas.bind("<Configure>", lambda e: self.on_resize())
+        self.canvas.bind("<ButtonPress-1>", self.on_press)
+        self.canvas.bind("<B1-Motion>", self.on_drag)
+        self.canvas.bind("<Double-Button-1>", lambda e: self.sorter.reset_zoom())
+        self.canvas.bind("<MouseWheel>", self.on_mouse_wheel)  # Windows
+        self.canvas.bind("<Button-4>", lambda e: self.zoom(self.ZOOM_STEP, (e.x, e.y)))  # X11
+        self.canvas.bind("<Button-5>", lambda e: self.zoom(1 / self.ZOOM_STEP, (e.x, e.y)))
+
+    def viewport(self):
+        return max(1, self.canvas.winfo_width()), max(1, self.canvas.winfo_height())
+
+    def open(self, path, factor=1.0, anchor=None):
+        """Показывает Canvas вместо обычной метки и запускает декодирование источника"""
+        if not self.active:
+            self.sorter.image_label.pack_forget()
+            self.canvas.pack(fill=tk.BOTH, expand=True)
+            self.active = True
+        if self.source is not None and self.source.path == path:
+            self.zoom(factor, anchor)
+            return
+        self.source = None
+        self.pending_zoom = (factor, anchor)
+        self.canvas.delete("all")
+        width, height = self.viewport()
+        self.canvas.create_text(width // 2, height // 2, text="Loading...", fill="#aaaaaa")
+        self.future = self.sorter.session.prefetcher.executor.submit(self.sorter.session.open_tiled, path)
+        self.poll_source(path)
+
+    def poll_source(self, path):
+        """Дожидается декодирования источника, не блокируя интерфейс"""
+        future = self.future
+        if future is None or self.sorter.session.current_file != path:
+            return
+        if not future.done():
+            self.canvas.after(30, self.poll_source, path)
+            return
+        self.future = None
+        try:
+            self.source = future.result()
+        except Exception as e:
+            self.sorter.on_tiled_failed(e)
+            return
+        self.sorter.session.memory.hold("tiled_source", self.source.nbytes)
+        self.scale = self.source.fit_scale(self.viewport())
+        self.offset = (0, 0)
+        self.sorter.on_tiled_ready(self.source)
+        factor, anchor = self.pending_zoom
+        self.pending_zoom = None
+        self.zoom(factor, anchor)
+
+    def close(self):
+        """Возвращает обычный показ и освобождает источник и плитки"""
+        if self.future:
+            self.future.cancel()
+            self.future = None
+        if self.tile_future:
+            self.tile_future.cancel()
+            self.tile_future = None
+        self.source = None
+        self.sorter.session.memory.release("tiled_source")
+        self.photos = {}
+        self.canvas.delete("all")
+        if self.active:
+            self.canvas.pack_forget()
+            self.sorter.image_label.pack(fill=tk.BOTH, expand=True)
+            self.active = False
+
+    def zoom(self, factor, anchor=None):
+        """Меняет масштаб, оставляя точку anchor (по умолчанию центр) на месте"""
+        if self.source is None:
+            if self.pending_zoom:
+                self.pending_zoom = (self.pending_zoom[0] * factor, anchor)
+            return
+        width, height = self.viewport()
+        if anchor is None:
+            anchor = (width / 2, height / 2)
+        min_scale = min(1.0, self.source.fit_scale((width, height)))
+        scale = max(min_scale, min(self.MAX_ZOOM, self.scale * factor))
+        # Координаты оригинала под точкой anchor не меняются
+        x = (anchor[0] - self.offset[0]) / self.scale
+        y = (anchor[1] - self.offset[1]) / self.scale
+        self.scale = scale
+        self.offset = (anchor[0] - x * scale, anchor[1] - y * scale)
+        self.schedule_refresh()
+
+    def clamp_offset(self):
+        """Не дает увести изображение за край; меньшее, чем окно, изображение центрируется"""
+        width, height = self.viewport()
+        image_width, image_height = self.source.display_size(self.scale)
+        x, y = self.offset
+        x = (width - image_width) / 2 if image_width <= width else min(0, max(width - image_width, x))
+        y = (height - image_height) / 2 if image_height <= height else min(0, max(height - image_height, y))
+        self.offset = (int(x), int(y))
+
+    def on_resize(self):
+        if self.source is not None:
+            self.schedule_refresh()
+
+    def on_press(self, event):
+        self.drag_start = (event.x, event.y, self.offset)
+
+    def on_drag(self, event):
+        if self.source is None or self.drag_start is None:
+            return
+        x, y, (left, top) = self.drag_start
+        self.offset = (left + event.x - x, top + event.y - y)
+        self.schedule_refresh()
+
+    def on_mouse_wheel(self, event):
+        factor = self.ZOOM_STEP if event.delta > 0 else 1 / self.ZOOM_STEP
+        self.zoom(factor, (event.x, event.y))
+
+    def schedule_refresh(self):
+        """Объединяет несколько изменений в одну перерисовку"""
+        if not self.refresh_timer:
+            self.refresh_timer = self.canvas.after_idle(self.refresh)
+
+    def refresh(self):
+        """Перерисовывает видимые плитки"""
+        self.refresh_timer = None
+        source = self.source
+        if source is None:
+            return
+        self.clamp_offset()
+        self.canvas.delete("all")
+        
+        width, height = self.viewport()
+        image_width, image_height = source.display_size(self.scale)
+        size = source.tile_size
+        left, top = self.offset
+        first_column, first_row = max(0, -left // size), max(0, -top // size)
+        last_column = min((image_width - 1) // size, (width - left) // size)
+        last_row = min((image_height - 1) // size, (height - top) // size)
+        
+        photos = {}
+        missing = []  # Плитки, которые еще декодируются из файла в полном разрешении
+        region = source.needs_region(self.scale)
+        scale_key = round(self.scale, 6)
+        for row in range(first_row, last_row + 1):
+            for column in range(first_column, last_column + 1):
+                key = (scale_key, column, row)
+                photo, final = self.photos.get(key, (None, False))
+                if not final:
+                    tile = source.cached_region_tile(self.scale, column, row) if region else None
+                    if tile is not None:
+                        photo, final = ImageTk.PhotoImage(tile), True
+                    else:
+                        if photo is None:
+                            # Пока плитка декодируется, показываем ее увеличенной с обзорной копии
+                            photo = ImageTk.PhotoImage(source.tile(self.scale, column, row))
+                        final = not region
+                        if region:
+                            missing.append((column, row))
+                photos[key] = (photo, final)
+                self.canvas.create_image(left + column * size, top + row * size, image=photo, anchor=tk.NW)
+        # Ссылки на PhotoImage плиток, ушедших из видимой области, освобождаются
+        self.photos = photos
+        if missing:
+            self.load_region_tiles(missing)
+        if source.region is None and self.scale > source.detail_scale * 1.0001:
+            # Подробности ограничены разрешением, в котором изображение удалось декодировать
+            self.sorter.status_var.set(f"Zoom: {self.scale * 100:.0f}% "
+                                       f"(detail limited to {source.detail_scale * 100:.0f}%)")
+        else:
+            self.sorter.status_var.set(f"Zoom: {self.scale * 100:.0f}%")
+
+    def load_region_tiles(self, tiles):
+        """Декодирует видимые плитки в полном разрешении в фоновом потоке"""
+        if self.tile_future:
+            self.tile_future.cancel()
+        source, scale = self.source, self.scale
+        
+        def decode():
+            for column, row in tiles:
+                source.region_tile(scale, column, row)
+        
+        self.tile_future = self.sorter.session.prefetcher.executor.submit(decode)
+        self.poll_region_tiles(self.tile_future, source)
+
+    def poll_region_tiles(self, future, source):
+        if future is not self.tile_future or source is not self.source:
+            return
+        if not future.done():
+            self.canvas.after(30, self.poll_region_tiles, future, source)
+            return
+        self.tile_future = None
+        if not future.cancelled() and future.exception() is None:
+            self.schedule_refresh()
+
+class FolderList:
+    """Виртуализированный список папок с фильтром. Виджеты создаются только для видимых строк,
+    при изменении папок или горячих клавиш перенастраиваются лишь изменившиеся строки"""
+    ROW = 34  # Высота строки в пикселях
+    
+    # Понятные надписи для специальных клавиш
+    HOTKEY_LABELS = {
+        'space': 'Space',
+        'Return': 'Enter',
+        'BackSpace': 'Back',
+        'Delete': 'Del',
+        'Escape': 'Esc',
+        'Page_Up': 'PgUp',
+        'Page_Down': 'PgDn'
+    }
+
+    def __init__(self, parent, sorter):
+        self.sorter = sorter
+        self.frame = ttk.Frame(parent)
+        
+        # Поле фильтра: Enter перемещает в первую найденную папку, Esc очищает фильтр
+        self.filter_var = tk.StringVar()
+        self.filter_entry = ttk.Entry(self.frame, textvariable=self.filter_var)
+        self.filter_entry.pack(fill=tk.X, pady=(0, 5))
+        self.filter_entry.bind("<Return>", self.on_filter_return)
+        self.filter_entry.bind("<Escape>", self.on_filter_escape)
+        createToolTip(self.filter_entry, "Type to filter folders (Ctrl+F)")
+        self.filter_var.trace_add("write", lambda *args: self.on_filter_change())
+        
+        self.scrollbar = ttk.Scrollbar(self.frame, orient=tk.VERTICAL, command=self.on_scroll)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.body = ttk.Frame(self.frame)
+        self.body.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.body.bind("<Configure>", lambda e: self.refresh())
+        self.bind_wheel(self.body)
+        
+        self.rows = []  # Пул строк, переиспользуемых при прокрутке
+        self.visible = []  # Индексы папок (в sorter.session.folders), прошедших фильтр
+        self.top = 0  # Первая видимая строка
+        self.buttons = {}  # папка -> кнопка видимой строки
+
+    def bind_wheel(self, widget):
+        widget.bind("<MouseWheel>", lambda e: self.on_scroll("scroll", -1 if e.delta > 0 else 1, "units"))  # Windows
+        widget.bind("<Button-4>", lambda e: self.on_scroll("scroll", -1, "units"))  # X11
+        widget.bind("<Button-5>", lambda e: self.on_scroll("scroll", 1, "units"))
+
+    def make_row(self):
+        """Создает строку: кнопка папки, горячая клавиша, переименование, удаление"""
+        row = types.SimpleNamespace(folder=None, index=None, state=None)
+        row.frame = ttk.Frame(self.body)
+        row.button = ttk.Button(row.frame)
+        # Привязываем обработчик через bind вместо command
+        row.button.bind('<Button-1>', lambda e: self.sorter.handle_folder_click(e, row.index))
+        row.button.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        
+        row.hotkey = ttk.Button(row.frame, width=6, command=lambda: self.sorter.show_hotkey_menu(row.folder))
+        row.hotkey.pack(side=tk.LEFT, padx=2)
+        createToolTip(row.hotkey, "Click to set hotkey")
+        
+        # Латинская буква R (Rename)
+        edit_btn = ttk.Button(row.frame, text="R", width=3, command=lambda: self.sorter.rename_folder(row.folder))
+        edit_btn.pack(side=tk.LEFT, padx=2)
+        createToolTip(edit_btn, "Rename folder")
+        
+        # Латинская буква X (Delete/Remove)
+        del_btn = ttk.Button(row.frame, text="X", width=3, command=lambda: self.sorter.delete_folder(row.folder))
+        del_btn.pack(side=tk.LEFT)
+        createToolTip(del_btn, "Delete folder")
+        
+        for widget in (row.frame, row.button, row.hotkey, edit_btn, del_btn):
+            self.bind_wheel(widget)
+        return row
+
+    def hotkey_text(self, folder):
+        hotkey = self.sorter.session.folder_hotkeys.get(folder)
+        if hotkey is None:
+            return "[ ]"
+        return f"[{self.HOTKEY_LABELS.get(hotkey, hotkey)}]"
+
+    def on_filter_change(self):
+        self.top = 0
+        self.refresh()
+
+    def on_filter_return(self, event):
+        if self.visible:
+            self.sorter.root.focus_set()
+            self.sorter.move_to_folder(self.visible[0])
+        return "break"
+
+    def on_filter_escape(self, event):
+        self.filter_var.set("")
+        self.sorter.root.focus_set()
+        return "break"
+
+    def focus_filter(self):
+        self.filter_entry.focus_set()
+        self.filter_entry.select_range(0, tk.END)
+
+    def on_scroll(self, *args):
+        """Команда полосы прокрутки: moveto / scroll units / scroll pages"""
+        page = max(1, self.body.winfo_height() // self.ROW)
+        if args[0] == "moveto":
+            top = int(round(float(args[1]) * len(self.visible)))
+        else:
+            step = int(args[1])
+            top = self.top + (step * page if args[2] == "pages" else step)
+        self.top = max(0, min(top, len(self.visible) - page))
+        self.refresh()
+
+    def refresh(self):
+        """Сверяет видимые строки с текущими папками и горячими клавишами"""
+        folders = self.sorter.session.folders
+        text = self.filter_var.get().strip().casefold()
+        if text:
+            self.visible = [i for i, folder in enumerate(folders)
+                            if text in folder.casefold() or self.sorter.session.folder_hotkeys.get(folder) == text]
+        else:
+            self.visible = list(range(len(folders)))
+        
+        page = max(1, self.body.winfo_height() // self.ROW)
+        self.top = max(0, min(self.top, len(self.visible) - page))
+        count = min(page + 1, len(self.visible) - self.top)
+        while len(self.rows) < count:
+            self.rows.append(self.make_row())
+        
+        self.buttons.clear()
+        for slot, row in enumerate(self.rows):
+            if slot >= count:
+                if row.state is not None:
+                    row.frame.place_forget()
+                    row.state = None
+                continue
+            index = self.visible[self.top + slot]
+            folder = folders[index]
+            state = (folder, index, self.hotkey_text(folder))
+            if state != row.state:
+                if row.state is None:
+                    row.frame.place(x=0, y=slot * self.ROW, relwidth=1, height=self.ROW - 2)
+                row.folder, row.index = folder, index
+                row.button.configure(text=folder)
+                row.hotkey.configure(text=state[2])
+                row.state = state
+            self.buttons[folder] = row.button
+        
+        total = len(self.visible)
+        if total:
+            self.scrollbar.set(self.top / total, min(1.0, (self.top + page) / total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
 
 class HotkeyDialog(tk.Toplevel):
     def __init__(self, parent, folder_name, current_hotkey=None):
@@ -164,34 +705,34 @@ class ImageSorter:
         self.root.geometry("1200x800")  # Фиксированный начальный размер окна
         self.root.minsize(800, 600)
         
+        # Очередь, перемещения, история и настройки живут в сеансе, независимом от Tk
+        self.session = SortingSession()
+        
         # Инициализируем переменные
         self.current_image = None
         self.current_photo = None  # Сохраняем ссылку на PhotoImage
-        self.image_files = []
-        self.current_index = -1
-        self.folders = []
-        self.folder_hotkeys = {}  # Словарь для хранения горячих клавиш папок
-        self.processed_images = 0  # Счетчик обработанных изображений
-        self.total_images = 0  # Общее количество изображений
         self.resize_timer = None  # Таймер для отложенного обновления размера
         self.is_processing = False  # Флаг для защиты от двойного клика
-        self.folder_buttons = {}  # Словарь для хранения кнопок папок
-        self.current_file = None  # Текущий обрабатываемый файл
         self.processing_lock = False  # Блокировка обработки
         self.animation_frames = []  # Кадры анимации
         self.animation_timer = None  # Таймер для анимации
-        self.move_history = []  # История перемещений для функции Undo
+        self.gif_streamer = None  # Фоновый декодер кадров текущего GIF
+        self.move_poll_timer = None  # Таймер проверки результатов перемещений
+        self.copy_progress_shown = None  # Итоговое сообщение, если в статусе показан ход копирования или извлечения
+        self.nav_timer = None  # Отложенный полный показ после серии быстрых переходов
+        self.nav_last_time = 0.0  # Время последнего перехода (для определения серии)
+        self.shown_file = None  # Файл, изображение (или миниатюра) которого сейчас на экране
+        self.startup_status = None  # Сообщение, которое показывается после завершения сканирования
         self.hotkey_to_index = {}  # Словарь для быстрого поиска индекса папки по горячей клавише
-        self.settings_file = "image_sorter_settings.json"  # Имя файла настроек
+        self.duplicate_folder = None  # Папка, куда уже отправлен дубликат текущего изображения
+        self.timing_timer = None  # Таймер обновления панели замеров
         
-        # Получаем путь к папке, в которой находится скрипт
-        if getattr(sys, 'frozen', False):
-            self.app_path = os.path.dirname(sys.executable)
-        else:
-            self.app_path = os.path.dirname(os.path.abspath(__file__))
-        
-        # Поддерживаемые форматы изображений
-        self.image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'}
+        # Отображение текущего изображения
+        self.display_box = None  # Размер области, под который масштабировано текущее изображение
+        self.resize_preview_timer = None  # Отложенная отрисовка превью
+        self.preview_active = False  # Показано ли сейчас быстрое превью вместо итогового кадра
+        self.preview_only = False  # Изображение не поместилось в лимит памяти и показано уменьшенным
+        self.pyramid_future = None  # Фоновое построение пирамиды текущего изображения
         
         # Создаем интерфейс
         self.create_ui()
@@ -205,18 +746,7 @@ class ImageSorter:
     def save_settings(self):
         """Сохраняет настройки в JSON-файл"""
         try:
-            # Создаем словарь с настройками
-            settings = {
-                "folder_hotkeys": self.folder_hotkeys
-            }
-            
-            # Полный путь к файлу настроек
-            settings_path = os.path.join(self.app_path, self.settings_file)
-            
-            # Сохраняем в JSON
-            with open(settings_path, 'w', encoding='utf-8') as f:
-                json.dump(settings, f, ensure_ascii=False, indent=4)
-                
+            self.session.save_settings()
             self.status_var.set("Settings saved")
         except Exception as e:
             self.status_var.set(f"Error saving settings: {str(e)}")
@@ -224,23 +754,12 @@ class ImageSorter:
     def load_settings(self):
         """Загружает настройки из JSON-файла"""
         try:
-            # Полный путь к файлу настроек
-            settings_path = os.path.join(self.app_path, self.settings_file)
-            
-            # Проверяем, существует ли файл
-            if os.path.exists(settings_path):
-                # Загружаем из JSON
-                with open(settings_path, 'r', encoding='utf-8') as f:
-                    settings = json.load(f)
-                
-                # Загружаем хоткеи
-                if "folder_hotkeys" in settings:
-                    self.folder_hotkeys = settings["folder_hotkeys"]
-                    self.status_var.set("Settings loaded")
+            if self.session.load_settings():
+                self.status_var.set("Settings loaded")
         except Exception as e:
             self.status_var.set(f"Error loading settings: {str(e)}")
             # Если произошла ошибка, используем пустые настройки
-            self.folder_hotkeys = {}
+            self.session.folder_hotkeys = {}
     
     def initialize_app(self):
         """Инициализация приложения после создания интерфейса"""
@@ -248,8 +767,29 @@ class ImageSorter:
         self.load_settings()
         
         # Загружаем список папок
-        self.folders = self.get_existing_folders()
-        self.create_folder_buttons()
+        self.session.folders = self.session.get_existing_folders()
+        self.folder_list.refresh()
+        
+        # Запускаем фоновый сбор метаданных и миниатюр
+        self.session.start_metadata_indexer()
+        if self.session.metadata_indexer:
+            self.session.metadata_indexer.listeners.append(self.filmstrip.on_indexed)
+        
+        # Пул процессов декодирования (если включен в настройках)
+        self.session.start_decoder()
+        
+        # Восстанавливаем историю перемещений из журнала
+        try:
+            recovered = self.session.recover_journal()
+        except OSError as e:
+            self.status_var.set(f"Error reading journal: {str(e)}")
+            recovered = 0
+        
+        if recovered:
+            self.startup_status = f"Recovered {recovered} interrupted move(s)"
+        
+        # Хэши уже разложенных файлов нужны для поиска дубликатов среди новых
+        self.session.index_moved_files()
         
         # Загружаем изображения
         self.load_images()
@@ -257,10 +797,8 @@ class ImageSorter:
         # Привязываем горячие клавиши
         self.bind_keys()
         
-        # Добавляем обработчики изменения размера окна
+        # Добавляем обработчик изменения размера окна
         self.root.bind("<Configure>", self.on_window_resize)
-        self.root.bind("<F11>", self.on_fullscreen)  # Для F11
-        self.root.bind("<Escape>", self.on_fullscreen)  # Для выхода из полноэкранного режима
         
         # Отслеживаем состояние полноэкранного режима
         self.is_fullscreen = False
@@ -270,6 +808,20 @@ class ImageSorter:
         # Сохраняем настройки перед закрытием
         self.save_settings()
         
+        # Останавливаем анимацию, затем фоновые потоки сеанса (с ожиданием перемещений)
+        self.stop_animation()
+        self.viewer.close()
+        self.session.close()
+        
+        # Сохраняем сводку замеров, если они собирались
+        if self.timing_timer:
+            self.root.after_cancel(self.timing_timer)
+            self.timing_timer = None
+        try:
+            self.session.dump_timings()
+        except OSError:
+            pass
+        
         # Очищаем ссылки на изображения
         self.current_image = None
         self.current_photo = None
@@ -279,15 +831,6 @@ class ImageSorter:
         self.root.quit()
         self.root.destroy()
     
-    def get_existing_folders(self):
-        """Получает список существующих папок в директории"""
-        folders = []
-        for item in os.listdir(self.app_path):
-            item_path = os.path.join(self.app_path, item)
-            if os.path.isdir(item_path) and not item.startswith('.'):
-                folders.append(item)
-        return sorted(folders)
-    
     def create_ui(self):
         """Создает пользовательский интерфейс"""
         # Главный контейнер
@@ -326,16 +869,10 @@ class ImageSorter:
         skip_hotkey = ttk.Label(skip_frame, text="[Space]", padding=(5, 0))
         skip_hotkey.pack(side=tk.LEFT)
         
-        # Создаем фрейм для списка папок
-        self.folders_frame = ttk.Frame(sidebar)
-        self.folders_frame.pack(fill=tk.BOTH, expand=True)
-        
-        # Фрейм для кнопок папок
-        self.buttons_frame = ttk.Frame(self.folders_frame)
-        self.buttons_frame.pack(fill=tk.BOTH, expand=True)
-        
-        # Создаем кнопки для папок
-        self.create_folder_buttons()
+        # Прокручиваемый список папок с фильтром
+        self.folder_list = FolderList(sidebar, self)
+        self.folder_list.frame.pack(fill=tk.BOTH, expand=True)
+        self.folder_buttons = self.folder_list.buttons  # Кнопки видимых строк
         
         # Кнопка добавления новой папки
         add_btn = ttk.Button(sidebar, text="+ Add Folder", command=self.add_folder)
@@ -350,6 +887,11 @@ class ImageSorter:
         filename_label = ttk.Label(info_frame, textvariable=self.filename_var, wraplength=250)  # Ограничиваем ширину текста
         filename_label.pack(anchor=tk.W, pady=(0, 5), fill=tk.X)
         
+        # Предупреждение о почти одинаковом изображении
+        self.duplicate_var = tk.StringVar()
+        ttk.Label(info_frame, textvariable=self.duplicate_var, wraplength=250,
+                  foreground="#c05000").pack(anchor=tk.W, fill=tk.X)
+        
         # Кнопка "Открыть в проводнике"
         self.explorer_btn = ttk.Button(
             info_frame,
@@ -367,93 +909,34 @@ class ImageSorter:
         self.status_var = tk.StringVar(value="Loading images...")
         ttk.Label(sidebar, textvariable=self.status_var).pack(anchor=tk.W, pady=10)
         
+        # Панель замеров (Ctrl+T), по умолчанию скрыта
+        self.timing_frame = ttk.LabelFrame(sidebar, text="Timings, ms", padding=(5, 5))
+        self.timing_var = tk.StringVar()
+        ttk.Label(self.timing_frame, textvariable=self.timing_var, font="TkFixedFont",
+                  justify=tk.LEFT).pack(anchor=tk.W)
+        
+        # Область просмотра: изображение и лента миниатюр под ним
+        viewer = ttk.Frame(main_container)
+        viewer.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        
+        # Лента миниатюр очереди
+        self.filmstrip = Filmstrip(viewer, self)
+        self.filmstrip.frame.pack(side=tk.BOTTOM, fill=tk.X)
+        
         # Контейнер для изображения
-        self.image_frame = ttk.Frame(main_container)
-        self.image_frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.image_frame = ttk.Frame(viewer)
+        self.image_frame.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
         
         # Метка для отображения изображения
         self.image_label = ttk.Label(self.image_frame)
         self.image_label.pack(fill=tk.BOTH, expand=True)
-    
-    def create_folder_buttons(self):
-        """Создает кнопки для каждой папки"""
-        # Очищаем словарь кнопок
-        self.folder_buttons.clear()
         
-        # Удаляем старые кнопки
-        for widget in self.buttons_frame.winfo_children():
-            widget.destroy()
-        
-        # Создаем новые кнопки для каждой папки
-        for i, folder in enumerate(self.folders):
-            frame = ttk.Frame(self.buttons_frame)
-            frame.pack(fill=tk.X, pady=2)
-            
-            # Создаем кнопку
-            btn = ttk.Button(
-                frame,
-                text=folder,
-            )
-            # Привязываем обработчик через bind вместо command
-            btn.bind('<Button-1>', lambda e, idx=i: self.handle_folder_click(e, idx))
-            btn.pack(side=tk.LEFT, fill=tk.X, expand=True)
-            
-            # Сохраняем кнопку в словарь
-            self.folder_buttons[folder] = btn
-            
-            # Кнопка выбора горячей клавиши
-            if folder in self.folder_hotkeys:
-                hotkey = self.folder_hotkeys[folder]
-                hotkey_text = hotkey
-                # Для специальных клавиш делаем более понятные надписи
-                special_keys = {
-                    'space': 'Space',
-                    'Return': 'Enter',
-                    'BackSpace': 'Back',
-                    'Delete': 'Del',
-                    'Escape': 'Esc',
-                    'Page_Up': 'PgUp',
-                    'Page_Down': 'PgDn'
-                }
-                if hotkey in special_keys:
-                    hotkey_text = special_keys[hotkey]
-                
-                hotkey_btn = ttk.Button(
-                    frame,
-                    text=f"[{hotkey_text}]",
-                    width=6,
-                    command=lambda f=folder: self.show_hotkey_menu(f)
-                )
-            else:
-                # Пустая кнопка, если нет горячей клавиши
-                hotkey_btn = ttk.Button(
-                    frame,
-                    text="[ ]",
-                    width=6,
-                    command=lambda f=folder: self.show_hotkey_menu(f)
-                )
-            hotkey_btn.pack(side=tk.LEFT, padx=2)
-            createToolTip(hotkey_btn, "Click to set hotkey")
-            
-            # Кнопка редактирования
-            edit_btn = ttk.Button(
-                frame,
-                text="R",  # Латинская буква R (Rename)
-                width=3,
-                command=lambda f=folder: self.rename_folder(f)
-            )
-            edit_btn.pack(side=tk.LEFT, padx=2)
-            createToolTip(edit_btn, "Rename folder")
-            
-            # Кнопка удаления
-            del_btn = ttk.Button(
-                frame,
-                text="X",  # Латинская буква X (Delete/Remove)
-                width=3,
-                command=lambda f=folder: self.delete_folder(f)
-            )
-            del_btn.pack(side=tk.LEFT)
-            createToolTip(del_btn, "Delete folder")
+        # Просмотр с увеличением: колесо мыши над изображением или Ctrl+плюс
+        self.viewer = TiledViewer(self.image_frame, self)
+        self.image_label.bind("<MouseWheel>",
+                              lambda e: self.zoom_image(TiledViewer.ZOOM_STEP if e.delta > 0 else 1 / TiledViewer.ZOOM_STEP,
+                                                        (e.x, e.y)))
+        self.image_label.bind("<Button-4>", lambda e: self.zoom_image(TiledViewer.ZOOM_STEP, (e.x, e.y)))
     
     def handle_folder_click(self, event, folder_index):
         """Обработчик клика по кнопке папки"""
@@ -463,106 +946,19 @@ class ImageSorter:
         # Проверяем блокировки
         if self.processing_lock or str(btn['state']) == 'disabled':
             return
-            
-        # Проверяем базовые условия
-        if not self.current_image or folder_index >= len(self.folders):
-            return
-            
-        try:
-            # Устанавливаем блокировку
-            self.processing_lock = True
-            
-            # Проверяем, что текущий файл существует и не изменился
-            if not self.current_file or self.current_file != self.image_files[self.current_index]:
-                return
-                
-            # Проверяем, существует ли исходный файл
-            src = self.image_files[self.current_index]
-            if not os.path.exists(src):
-                return
-                
-            # Блокируем все кнопки папок
-            for btn in self.folder_buttons.values():
-                btn.configure(state='disabled')
-            
-            # Создаем папку, если её нет
-            folder_name = self.folders[folder_index]
-            folder_path = os.path.join(self.app_path, folder_name)
-            if not os.path.exists(folder_path):
-                os.makedirs(folder_path)
-            
-            # Получаем путь назначения
-            dst = os.path.join(folder_path, os.path.basename(src))
-            
-            # Закрываем текущее изображение и очищаем память
-            if self.current_image:
-                self.current_image.close()
-            self.current_image = None
-            self.current_photo = None
-            self.image_label.configure(image='')
-            
-            # Даем время на освобождение файла
-            self.root.update()
-            time.sleep(0.1)
-            
-            # Пробуем разные способы перемещения файла
-            success = False
-            try:
-                # Сначала пробуем просто переместить
-                shutil.move(src, dst)
-                success = True
-                # Сохраняем информацию о перемещении для функции Undo
-                self.move_history.append((src, dst))
-            except:
-                try:
-                    # Если не получилось, пробуем копировать и удалить
-                    shutil.copy2(src, dst)
-                    os.remove(src)
-                    success = True
-                    # Сохраняем информацию о перемещении для функции Undo
-                    self.move_history.append((src, dst))
-                except:
-                    pass
-            
-            if success:
-                # Удаляем файл из списка и показываем следующий
-                self.image_files.pop(self.current_index)
-                if self.image_files:
-                    if self.current_index >= len(self.image_files):
-                        self.current_index = 0
-                    self.show_image(self.current_index)
-                else:
-                    self.current_image = None
-                    self.current_file = None
-                    self.image_label.configure(image='')
-                    self.status_var.set("All images processed")
-                
-                # Увеличиваем счетчик обработанных изображений
-                self.processed_images += 1
-                self.update_counter()
-                
-                # Обновляем статус с информацией о последнем действии
-                self.status_var.set(f"Moved to: {folder_name}")
-            else:
-                # Если не удалось переместить, просто пропускаем файл
-                self.show_next_image()
-            
-        finally:
-            # Разблокируем кнопки и снимаем блокировку
-            self.processing_lock = False
-            for btn in self.folder_buttons.values():
-                btn.configure(state='normal')
+        
+        self.move_to_folder(folder_index)
     
     def show_hotkey_menu(self, folder):
         """Открывает диалог выбора горячей клавиши"""
-        current_hotkey = self.folder_hotkeys.get(folder)
+        current_hotkey = self.session.folder_hotkeys.get(folder)
         dialog = HotkeyDialog(self.root, folder, current_hotkey)
         
         # Если пользователь выбрал клавишу
         if dialog.result:
             # Проверяем, не занята ли эта клавиша другой папкой
             used_by = None
-            for f, h in self.folder_hotkeys.items():
+            for f, h in self.session.folder_hotkeys.items():
                 if h == dialog.result and f != folder:
                     used_by = f
                     break
@@ -573,17 +969,17 @@ class ImageSorter:
                                       f"Key '{dialog.result}' is already assigned to folder '{used_by}'.\n\n" +
                                       "Reassign it to the current folder?"):
                     # Удаляем старую привязку
-                    del self.folder_hotkeys[used_by]
+                    del self.session.folder_hotkeys[used_by]
                     # Устанавливаем новую
-                    self.folder_hotkeys[folder] = dialog.result
-                    self.create_folder_buttons()
+                    self.session.folder_hotkeys[folder] = dialog.result
+                    self.folder_list.refresh()
                     self.bind_keys()
                     # Сохраняем настройки
                     self.save_settings()
             else:
                 # Если клавиша свободна, просто назначаем её
-                self.folder_hotkeys[folder] = dialog.result
-                self.create_folder_buttons()
+                self.session.folder_hotkeys[folder] = dialog.result
+                self.folder_list.refresh()
                 self.bind_keys()
                 # Сохраняем настройки
                 self.save_settings()
@@ -591,39 +987,41 @@ class ImageSorter:
     def reassign_hotkey(self, new_folder, hotkey, old_folder):
         """Переназначает горячую клавишу с одной папки на другую"""
         # Удаляем горячую клавишу у старой папки
-        if old_folder in self.folder_hotkeys:
-            del self.folder_hotkeys[old_folder]
+        if old_folder in self.session.folder_hotkeys:
+            del self.session.folder_hotkeys[old_folder]
         
         # Устанавливаем горячую клавишу для новой папки
-        self.folder_hotkeys[new_folder] = hotkey
-        self.create_folder_buttons()
+        self.session.folder_hotkeys[new_folder] = hotkey
+        self.folder_list.refresh()
         self.bind_keys()
     
     def set_folder_hotkey(self, folder, hotkey):
         """Устанавливает горячую клавишу для папки"""
-        self.folder_hotkeys[folder] = hotkey
-        self.create_folder_buttons()
+        self.session.folder_hotkeys[folder] = hotkey
+        self.folder_list.refresh()
         self.bind_keys()
     
     def add_folder(self):
         """Добавляет новую папку"""
         name = simpledialog.askstring("New Folder", "Enter folder name:")
         if name:
-            if name in self.folders:
+            if name in self.session.folders:
                 messagebox.showerror("Error", "Folder with this name already exists")
                 return
             
             try:
                 # Создаем папку
-                folder_path = os.path.join(self.app_path, name)
+                folder_path = os.path.join(self.session.app_path, name)
                 os.makedirs(folder_path)
+                self.session.name_index.invalidate(folder_path)
                 
                 # Добавляем в список
-                self.folders.append(name)
-                self.folders.sort()  # Сортируем список папок
+                self.session.folders.append(name)
+                self.session.folders.sort()  # Сортируем список папок
                 
                 # Обновляем интерфейс
-                self.create_folder_buttons()
+                self.folder_list.refresh()
+                self.bind_keys()  # Индексы папок сдвинулись
                 self.status_var.set(f"Folder added: {name}")
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to create folder: {str(e)}")
@@ -634,30 +1032,33 @@ class ImageSorter:
                                         "Enter new folder name:", 
                                         initialvalue=old_name)
         if new_name and new_name != old_name:
-            if new_name in self.folders:
+            if new_name in self.session.folders:
                 messagebox.showerror("Error", "Folder with this name already exists")
                 return
             
             try:
                 # Переименовываем папку
-                old_path = os.path.join(self.app_path, old_name)
-                new_path = os.path.join(self.app_path, new_name)
+                old_path = os.path.join(self.session.app_path, old_name)
+                new_path = os.path.join(self.session.app_path, new_name)
                 os.rename(old_path, new_path)
+                self.session.name_index.invalidate(old_path)
+                self.session.name_index.invalidate(new_path)
                 
                 # Обновляем список
-                idx = self.folders.index(old_name)
-                self.folders[idx] = new_name
-                self.folders.sort()  # Сортируем список папок
+                idx = self.session.folders.index(old_name)
+                self.session.folders[idx] = new_name
+                self.session.folders.sort()  # Сортируем список папок
                 
                 # Обновляем интерфейс
-                self.create_folder_buttons()
+                self.folder_list.refresh()
+                self.bind_keys()  # Индексы папок сдвинулись
                 self.status_var.set(f"Folder renamed: {old_name} → {new_name}")
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to rename folder: {str(e)}")
     
     def delete_folder(self, folder_name):
         """Удаляет папку"""
-        if len(self.folders) <= 1:
+        if len(self.session.folders) <= 1:
             messagebox.showerror("Error", "Cannot delete the last folder")
             return
         
@@ -666,132 +1067,139 @@ class ImageSorter:
                               "Warning: all files in the folder will also be deleted!"):
             try:
                 # Удаляем папку
-                folder_path = os.path.join(self.app_path, folder_name)
+                folder_path = os.path.join(self.session.app_path, folder_name)
                 shutil.rmtree(folder_path)
+                self.session.name_index.invalidate(folder_path)
                 
                 # Обновляем список
-                self.folders.remove(folder_name)
+                self.session.folders.remove(folder_name)
                 
                 # Обновляем интерфейс
-                self.create_folder_buttons()
+                self.folder_list.refresh()
+                self.bind_keys()  # Индексы папок сдвинулись
                 self.status_var.set(f"Folder deleted: {folder_name}")
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to delete folder: {str(e)}")
     
     def bind_keys(self):
-        """Привязка горячих клавиш"""
-        # Навигация
-        self.root.bind("<Right>", lambda event: self.show_next_image())
-        self.root.bind("<Left>", lambda event: self.show_prev_image())
-        self.root.bind("<space>", lambda event: self.show_next_image())  # Пропуск изображения
-        self.root.bind("<Control-z>", lambda event: self.undo_last_action())  # Отмена последнего действия
-        
-        # Добавляем обработчик всех клавиш для работы независимо от раскладки
-        self.root.bind("<KeyPress>", self.handle_keypress)
-        
-        # Создаем словарь для быстрого поиска индекса папки по горячей клавише
+        """Собирает таблицу горячих клавиш. Все клавиши обрабатывает один обработчик <KeyPress>,
+        поэтому каждое нажатие вызывает ровно одно действие"""
+        windowing = self.root.tk.call('tk', 'windowingsystem')
+        self.modifier_mask = SHIFT | CONTROL | ALT.get(windowing, 0)
+        code_index = {'win32': 1, 'x11': 2}.get(windowing)  # На macOS коды клавиш не используем
+        keymap = {}
+        
+        def add(name, modifiers, action):
+            # Клавиша доступна по физическому коду, по keysym и по символу
+            keysym, *codes = KEY_CODES.get(name, (name, None, None))
+            if code_index and codes[code_index - 1] is not None:
+                keymap[(modifiers, codes[code_index - 1])] = action
+            keymap[(modifiers, keysym)] = action
+            keymap[(modifiers, name)] = action
+        
+        # Старое поведение: цифры 0-9 перемещают в папку с таким номером (самый низкий приоритет)
+        for digit in range(min(10, len(self.session.folders))):
+            action = lambda index=digit: self.move_to_folder(index)
+            add(str(digit), 0, action)
+            if code_index:
+                keymap[(0, KEYPAD_CODES[digit][code_index - 1])] = action
+        
+        # Горячие клавиши папок
         self.hotkey_to_index = {}
-        for i, folder in enumerate(self.folders):
-            if folder in self.folder_hotkeys:
-                hotkey = self.folder_hotkeys[folder]
+        for i, folder in enumerate(self.session.folders):
+            if folder in self.session.folder_hotkeys:
+                hotkey = self.session.folder_hotkeys[folder]
                 self.hotkey_to_index[hotkey] = i
+                add(hotkey, 0, lambda index=i: self.move_to_folder(index))
+                if len(hotkey) == 1 and (hotkey != hotkey.lower() or not hotkey.isalnum()):
+                    # Заглавные буквы и символы вроде "!" набираются с Shift
+                    keymap[(SHIFT, hotkey)] = keymap[(0, hotkey)]
+        
+        # Встроенные действия важнее горячих клавиш папок
+        builtin = [
+            ('Right', 0, self.show_next_image),
+            ('Left', 0, self.show_prev_image),
+            ('space', 0, self.show_next_image),  # Пропуск изображения
+            ('z', CONTROL, self.undo_last_action),  # Отмена последнего действия
+            # Выделение для пакетного перемещения
+            ('Right', SHIFT, lambda: self.extend_selection(1)),
+            ('Left', SHIFT, lambda: self.extend_selection(-1)),
+            ('space', CONTROL, self.toggle_selection),
+            ('d', CONTROL, self.route_duplicate),  # Дубликат - в папку оригинала
+            ('t', CONTROL, self.toggle_timing_overlay),  # Панель замеров
+            ('f', CONTROL, self.folder_list.focus_filter),  # Фильтр папок
+            # Увеличение изображения
+            ('=', CONTROL, lambda: self.zoom_image(TiledViewer.ZOOM_STEP)),
+            ('=', CONTROL | SHIFT, lambda: self.zoom_image(TiledViewer.ZOOM_STEP)),  # Ctrl и "+"
+            ('-', CONTROL, lambda: self.zoom_image(1 / TiledViewer.ZOOM_STEP)),
+            ('0', CONTROL, self.reset_zoom),
+            # Полноэкранный режим
+            ('F11', 0, self.on_fullscreen),
+            ('Escape', 0, self.exit_fullscreen),
+        ]
+        for name, modifiers, action in builtin:
+            add(name, modifiers, action)
+        self.keymap = keymap
+        
+        self.root.bind("<KeyPress>", self.handle_keypress)
     
     def handle_keypress(self, event):
-        """Обрабатывает нажатия клавиш независимо от раскладки"""
-        # Получаем код клавиши
-        key_code = event.keycode
-        
-        # Обработка Ctrl+Z (отмена) по коду
-        # Z обычно имеет код 90
-        if key_code == 90 and event.state & 0x4:  # 0x4 - это Ctrl
-            self.undo_last_action()
+        """Находит действие по физическому коду клавиши, затем по keysym и символу"""
+        if event.widget is self.folder_list.filter_entry:
+            return None  # Текст фильтра - не горячие клавиши
+        modifiers = event.state & self.modifier_mask
+        keymap = self.keymap
+        action = keymap.get((modifiers, event.keycode))
+        if action is None:
+            action = keymap.get((modifiers, event.keysym)) or keymap.get((modifiers, event.char))
+            if action is None:
+                return None
+            # Клавиша найдена по символу (например, горячая клавиша назначена в другой раскладке) -
+            # запоминаем ее код, чтобы она работала и после переключения раскладки
+            keymap[(modifiers, event.keycode)] = action
+        action()
+        # Дальше событие не передаем, чтобы одно нажатие не вызвало второе действие
+        return "break"
+    
+    def load_images(self):
+        """Запускает фоновое сканирование текущей директории"""
+        self.status_var.set("Loading images...")
+        self.session.start_scan()
+        self.poll_scan()
+    
+    def poll_scan(self):
+        """Добавляет в список изображения, найденные сканером с прошлой проверки"""
+        scanner = self.session.scanner
+        if scanner is None:
             return
+        added, finished = self.session.poll_scan()
         
-        # Обработка пробела (пропуск) по коду
-        # Пробел обычно имеет код 32
-        if key_code == 32:
-            self.show_next_image()
-            return
+        if added:
+            self.filmstrip.schedule_refresh()
+            # Обновляем счетчик
+            self.update_counter()
+            # Показываем первое найденное изображение, не дожидаясь конца сканирования
+            if not self.session.current_file:
+                self.show_image(0)
         
-        # Обработка стрелок по коду
-        # Стрелка влево обычно имеет код 37, вправо - 39
-        if key_code == 37:  # Стрелка влево
-            self.show_prev_image()
-            return
-        elif key_code == 39:  # Стрелка вправо
-            self.show_next_image()
+        if not finished:
+            self.status_var.set(f"Scanning... {self.session.total_images} images found")
+            self.root.after(20, self.poll_scan)
             return
         
-        # Получаем имя клавиши
-        key_name = None
-        
-        # Для специальных клавиш используем их имена
-        if event.keysym in ('space', 'Return', 'BackSpace', 'Delete', 'Escape',
-                          'Up', 'Down', 'Left', 'Right', 'Home', 'End', 'Page_Up', 'Page_Down',
-                          'F1', 'F2', 'F3', 'F4', 'F5', 'F6', 'F7', 'F8', 'F9', 'F10', 'F11', 'F12'):
-            key_name = event.keysym
-        # Для обычных клавиш используем символ
-        elif len(event.char) > 0:
-            key_name = event.char
-        # Если не удалось определить, используем keysym
+        if scanner.error:
+            self.status_var.set(f"Error scanning: {str(scanner.error)}")
+        elif self.startup_status:
+            self.status_var.set(self.startup_status)
+            self.startup_status = None
+        elif self.session.image_files:
+            self.status_var.set("Ready to work")
         else:
-            key_name = event.keysym
-        
-        # Проверяем, есть ли такая горячая клавиша
-        if key_name in self.hotkey_to_index:
-            folder_index = self.hotkey_to_index[key_name]
-            self.move_to_folder(folder_index)
-            return
-        
-        # Обработка цифровых клавиш (0-9) по их коду
-        # Коды клавиш 0-9 обычно 48-57 (верхний ряд) или 96-105 (цифровая клавиатура)
-        digit_keys = {
-            # Верхний ряд цифр
-            48: '0', 49: '1', 50: '2', 51: '3', 52: '4',
-            53: '5', 54: '6', 55: '7', 56: '8', 57: '9',
-            # Цифровая клавиатура
-            96: '0', 97: '1', 98: '2', 99: '3', 100: '4',
-            101: '5', 102: '6', 103: '7', 104: '8', 105: '9'
-        }
-        
-        # Поддержка старого поведения с цифрами
-        if key_code in digit_keys:
-            digit = digit_keys[key_code]
-            
-            # Если нет папки с такой горячей клавишей, используем индекс
-            digit_index = int(digit)
-            if digit_index < len(self.folders):
-                self.move_to_folder(digit_index)
-    
-    def load_images(self):
-        """Загружает список изображений из текущей директории"""
-        try:
-            # Получаем список всех файлов с изображениями
-            self.image_files = [
-                os.path.join(self.app_path, f) for f in os.listdir(self.app_path)
-                if os.path.isfile(os.path.join(self.app_path, f)) and  # Проверяем что это файл
-                os.path.splitext(f)[1].lower() in self.image_extensions
-            ]
-            
-            if self.image_files:
-                # Сортируем файлы по имени
-                self.image_files.sort()
-                # Обновляем общее количество изображений
-                self.total_images = len(self.image_files)
-                # Обновляем счетчик
-                self.update_counter()
-                # Показываем первое изображение
-                self.show_image(0)
-                self.status_var.set("Ready to work")
-            else:
-                self.status_var.set("No images found in the current folder")
-                
-        except Exception as e:
-            self.status_var.set(f"Error scanning: {str(e)}")
+            self.status_var.set("No images found in the current folder")
     
     def update_counter(self):
         """Обновляет счетчик обработанных изображений"""
-        self.images_count_var.set(f"Processed: {self.processed_images}/{self.total_images}")
+        self.images_count_var.set(f"Processed: {self.session.processed_images}/{self.session.total_images}")
     
     def on_window_resize(self, event):
         """Обработчик изменения размера окна"""
@@ -802,10 +1210,74 @@ class ImageSorter:
                 self.root.after_cancel(self.resize_timer)
             # Создаем новый отложенный вызов
             self.resize_timer = self.root.after(100, self.update_image_size)
+            # Пока размер меняется, показываем быстрое превью (не чаще одного раза за цикл событий)
+            if not self.resize_preview_timer:
+                self.resize_preview_timer = self.root.after_idle(self.show_resize_preview)
+    
+    def show_resize_preview(self):
+        """Быстро масштабирует изображение простым фильтром во время изменения размера окна"""
+        self.resize_preview_timer = None
+        if not self.current_image or self.gif_streamer or self.viewer.active:
+            return
+        
+        frame_width = self.image_frame.winfo_width()
+        frame_height = self.image_frame.winfo_height()
+        box = (frame_width, frame_height)
+        if frame_width <= 1 or frame_height <= 1 or box == self.display_box:
+            return
+        self.render_preview(box)
+    
+    def render_preview(self, box):
+        """Показывает быстро масштабированный кадр; итоговый строит update_image_size"""
+        if self.session.resize_preview_filter == "nearest":
+            resample = Image.Resampling.NEAREST
+        else:
+            resample = Image.Resampling.BILINEAR
+        
+        # Пока пирамида строится в фоне, растягиваем уже показанное изображение
+        pyramid = self.get_pyramid()
+        if pyramid:
+            preview = pyramid.render(fit_size(pyramid.size, box), resample)
+        else:
+            preview = self.current_image.resize(fit_size(self.current_image.size, box), resample)
+        
+        self.preview_active = True
+        self.set_photo(preview)
+    
+    def get_pyramid(self):
+        """Возвращает пирамиду текущего изображения, запуская ее построение при необходимости.
+        Не ждет: пока пирамида строится, возвращает None"""
+        if self.pyramid_future is None:
+            # Строим пирамиду под размер экрана, чтобы хватило и для полноэкранного режима
+            frame_width, frame_height = self.get_display_box()
+            box = (max(self.root.winfo_screenwidth(), frame_width),
+                   max(self.root.winfo_screenheight(), frame_height))
+            max_bytes = self.session.memory.available(("pyramid",))
+            self.pyramid_future = self.session.prefetcher.executor.submit(build_pyramid, self.session.current_file,
+                                                                          box, max_bytes)
+        if not self.pyramid_future.done():
+            return None
+        try:
+            pyramid = self.pyramid_future.result()
+        except Exception:
+            # В том числе MemoryBudgetError: масштабируем уже показанный кадр
+            return None
+        self.session.memory.hold("pyramid", pyramid.nbytes)
+        return pyramid
+    
+    def get_display_box(self):
+        """Возвращает размер области отображения изображения"""
+        frame_width = self.image_frame.winfo_width()
+        frame_height = self.image_frame.winfo_height()
+        if frame_width <= 1 or frame_height <= 1:  # Окно еще не отрисовано
+            # Используем оценку по размеру окна за вычетом боковой панели
+            frame_width = max(self.root.winfo_width() - 300, 500)
+            frame_height = max(self.root.winfo_height(), 500)
+        return frame_width, frame_height
     
     def update_image_size(self):
         """Обновляет размер изображения в соответствии с размером окна"""
-        if not self.current_image:
+        if not self.current_image or self.viewer.active:
             return
             
         # Получаем размеры области отображения
@@ -815,103 +1287,126 @@ class ImageSorter:
         if frame_width <= 1 or frame_height <= 1:  # Окно еще не отрисовано
             self.resize_timer = self.image_frame.after(100, self.update_image_size)
             return
-            
-        # Получаем размеры изображения
-        img_width, img_height = self.current_image.size
-        
-        # Вычисляем соотношение сторон
-        frame_ratio = frame_width / frame_height
-        img_ratio = img_width / img_height
-        
-        # Определяем новые размеры
-        if frame_ratio > img_ratio:
-            # Ограничение по высоте
-            new_height = frame_height
-            new_width = int(new_height * img_ratio)
-        else:
-            # Ограничение по ширине
-            new_width = frame_width
-            new_height = int(new_width / img_ratio)
         
-        # Масштабируем изображение
-        resized_image = self.current_image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        box = (frame_width, frame_height)
+        
+        if self.gif_streamer:
+            # Анимированный GIF: перезапускаем поток кадров под новый размер
+            if box != self.display_box:
+                self.start_gif_stream(box)
+            return
+        else:
+            # Область не изменилась - изображение уже подходящего размера
+            if box == self.display_box and self.current_photo and not self.preview_active:
+                return
+            # Итоговый кадр берем из кэша или качественно масштабируем с уровня пирамиды,
+            # не декодируя оригинал заново
+            key = self.session.prefetcher.cache_key(self.session.current_file, box)
+            resized_image = None if self.preview_only else self.session.display_cache.get(key)
+            pyramid = None if self.preview_only or resized_image else self.get_pyramid()
+            if resized_image is None and not self.preview_only and not self.pyramid_future.done():
+                # Пирамида еще строится: не ждем ее в потоке интерфейса, а показываем превью
+                # и строим итоговый кадр, когда она будет готова
+                self.render_preview(box)
+                self.resize_timer = self.root.after(30, self.wait_for_pyramid, self.pyramid_future)
+                return
+            if pyramid:
+                with self.session.timer.measure("pyramid_render"):
+                    resized_image = pyramid.render(fit_size(pyramid.size, box), Image.Resampling.LANCZOS)
+                self.session.display_cache.put(key, resized_image)
+            elif resized_image is None:
+                # Оригинал не помещается в лимит памяти - растягиваем то, что уже показано
+                resized_image = self.current_image.resize(fit_size(self.current_image.size, box),
+                                                          Image.Resampling.BILINEAR)
+            self.current_image = resized_image
+            self.session.memory.hold("current_image", image_nbytes(resized_image))
+            self.display_box = box
+            self.preview_active = False
         
         # Создаем новый PhotoImage и сохраняем ссылку
-        self.current_photo = ImageTk.PhotoImage(resized_image)
-        self.image_label.configure(image=self.current_photo)
+        self.set_photo(resized_image)
+    
+    def wait_for_pyramid(self, future):
+        """Дожидается построения пирамиды, не блокируя интерфейс, и обновляет итоговый кадр"""
+        if future is not self.pyramid_future:
+            return  # Уже показано другое изображение
+        if not future.done():
+            self.resize_timer = self.root.after(30, self.wait_for_pyramid, future)
+            return
+        self.resize_timer = None
+        self.update_image_size()
+    
+    def set_photo(self, image):
+        """Показывает кадр в области просмотра, сохраняя ссылку на PhotoImage"""
+        with self.session.timer.measure("photo"):
+            self.current_photo = ImageTk.PhotoImage(image)
+        # Tk хранит кадр в 32-битном формате
+        self.session.memory.hold("photo", image.width * image.height * 4)
+        with self.session.timer.measure("configure"):
+            self.image_label.configure(image=self.current_photo)
+    
+    def schedule_prefetch(self):
+        """Запускает предзагрузку соседних изображений"""
+        self.session.schedule_prefetch(self.get_display_box())
     
     def show_image(self, index):
         """Показывает изображение с указанным индексом"""
-        if not self.image_files or index < 0 or index >= len(self.image_files):
+        if self.nav_timer:
+            # Отложенный показ после серии переходов больше не нужен
+            self.root.after_cancel(self.nav_timer)
+            self.nav_timer = None
+        if not self.session.image_files or index < 0 or index >= len(self.session.image_files):
             return
         
         try:
             # Останавливаем предыдущую анимацию если была
-            if self.animation_timer:
-                self.root.after_cancel(self.animation_timer)
-                self.animation_timer = None
-            self.animation_frames.clear()
+            self.stop_animation()
+            self.viewer.close()
             
             # Сохраняем текущий файл
-            self.current_file = self.image_files[index]
+            path = self.session.set_current(index)
+            self.shown_file = path
+            self.duplicate_folder = None
+            self.duplicate_var.set("")
+            self.pyramid_future = None
+            self.preview_active = False
+            self.preview_only = False
+            self.session.memory.release("pyramid")
+            stat = source_stat(path)
             
-            # Загружаем и отображаем изображение
-            self.current_index = index
-            self.current_image = Image.open(self.image_files[index])
+            # Берем масштабированное изображение из кэша предзагрузки или декодируем его
+            box = self.get_display_box()
+            with self.session.timer.measure("load"):
+                try:
+                    display_image = self.session.load_display_image(path, box, stat)
+                except MemoryBudgetError as e:
+                    # Файл не помещается в лимит памяти - показываем уменьшенное превью
+                    display_image = self.session.load_preview(path, box, stat)
+                    if display_image is None:
+                        display_image = self.make_placeholder(box)
+                    self.preview_only = True
+                    self.status_var.set(f"Preview only: {str(e)}")
             
-            # Проверяем, является ли изображение анимированным GIF
-            is_animated = False
-            try:
-                # Более надежный способ определения анимированного GIF
-                if self.current_image.format == 'GIF':
-                    # Пробуем перейти ко второму кадру - если это возможно, значит GIF анимированный
-                    self.current_image.seek(1)
-                    is_animated = True
-                    # Возвращаемся к первому кадру
-                    self.current_image.seek(0)
-            except (EOFError, AttributeError):
-                # Если возникла ошибка EOFError, значит в GIF только один кадр
-                is_animated = False
-                
+            # None означает анимированный GIF - его кадры загружаем отдельно
+            is_animated = display_image is None
             if is_animated:
-                # Загружаем все кадры анимации
-                try:
-                    frame_count = 0
-                    durations = []
-                    
-                    while True:
-                        # Сохраняем длительность текущего кадра
-                        duration = self.current_image.info.get('duration', 100)
-                        durations.append(duration)
-                        
-                        # Копируем текущий кадр
-                        frame = self.current_image.copy()
-                        # Масштабируем кадр
-                        scaled_frame = self.scale_image(frame)
-                        # Конвертируем в PhotoImage
-                        photo = ImageTk.PhotoImage(scaled_frame)
-                        self.animation_frames.append((photo, duration))
-                        
-                        # Переходим к следующему кадру
-                        frame_count += 1
-                        self.current_image.seek(frame_count)
-                except EOFError:
-                    pass  # Достигнут конец файла (все кадры загружены)
-                
-                # Показываем первый кадр
-                if self.animation_frames:
-                    self.current_photo = self.animation_frames[0][0]
-                    self.image_label.configure(image=self.animation_frames[0][0])
-                    # Запускаем анимацию
-                    self.animate_gif(0)
+                # Показываем первый кадр сразу, остальные декодируются в фоне
+                self.start_gif_stream(box)
             else:
                 # Обычное изображение
-                self.update_image_size()
+                self.current_image = display_image
+                self.session.memory.hold("current_image", image_nbytes(display_image))
+                self.display_box = box
+                self.set_photo(display_image)
+            
+            # Запускаем предзагрузку соседних изображений
+            self.schedule_prefetch()
+            
+            # Подсвечиваем текущее изображение в ленте миниатюр
+            self.filmstrip.scroll_to(index)
             
             # Обновляем информацию о файле
-            filename = os.path.basename(self.image_files[index])
-            filesize = os.path.getsize(self.image_files[index])
-            self.filename_var.set(f"File: {filename}\nSize: {self.format_file_size(filesize)}")
+            self.update_file_info(stat)
             
             # Активируем кнопку "Открыть в проводнике"
             self.explorer_btn.configure(state='normal')
@@ -920,125 +1415,439 @@ class ImageSorter:
             for btn in self.folder_buttons.values():
                 btn.configure(state='normal')
             
+        except Image.DecompressionBombError:
+            # Слишком большое для обычного показа изображение открываем плитками
+            self.current_image = None
+            self.current_photo = None
+            self.image_label.configure(image='')
+            self.session.memory.release("current_image", "photo")
+            self.viewer.open(self.session.current_file)
         except Exception as e:
             self.status_var.set(f"Error loading image: {str(e)}")
     
-    def animate_gif(self, frame_index):
-        """Показывает следующий кадр анимированного GIF"""
-        if not self.animation_frames:
+    def zoom_image(self, factor, anchor=None):
+        """Увеличивает или уменьшает текущее изображение, переходя к просмотру плитками"""
+        if not self.session.current_file or self.gif_streamer:
             return
-            
-        # Показываем текущий кадр
-        frame, duration = self.animation_frames[frame_index]
-        self.current_photo = frame
-        self.image_label.configure(image=frame)
-        
-        # Определяем следующий кадр
-        next_frame = (frame_index + 1) % len(self.animation_frames)
-        
-        # Используем сохраненную длительность для текущего кадра
+        if self.viewer.active:
+            self.viewer.zoom(factor, anchor)
+        else:
+            self.viewer.open(self.session.current_file, factor, anchor)
+    
+    def reset_zoom(self):
+        """Возвращает изображение, вписанное в окно"""
+        if not self.viewer.active:
+            return
+        self.viewer.close()
+        self.status_var.set("")
+        self.update_image_size()
+    
+    def on_tiled_ready(self, source):
+        """Источник плиток готов. Для изображения, которое не удалось показать обычным образом,
+        строим из него вписанный в окно кадр"""
+        if self.current_image is not None:
+            return
+        box = self.get_display_box()
+        self.current_image = source.render(fit_size(source.full_size, box))
+        self.session.memory.hold("current_image", image_nbytes(self.current_image))
+        self.display_box = box
+        self.set_photo(self.current_image)
+        self.update_file_info(source.stat)
+    
+    def on_tiled_failed(self, error):
+        """Источник плиток не удалось построить (например, не хватило лимита памяти)"""
+        self.reset_zoom()
+        if self.current_image is None:
+            # Изображение так и не показано: ставим заглушку, чтобы файл можно было разложить
+            box = self.get_display_box()
+            self.current_image = self.make_placeholder(box)
+            self.display_box = box
+            self.preview_only = True
+            self.set_photo(self.current_image)
+        self.status_var.set(f"Error loading image: {str(error)}")
+    
+    def make_placeholder(self, box):
+        """Серый прямоугольник вместо изображения, которое нельзя декодировать в пределах лимита памяти"""
+        return Image.new('RGB', fit_size((4, 3), box), "#404040")
+    
+    def clear_image(self):
+        """Убирает изображение, когда очередь опустела"""
+        self.viewer.close()
+        self.current_image = None
+        self.current_photo = None
+        self.image_label.configure(image='')
+        self.session.memory.release(*self.session.DISPLAY_OWNERS)
+        self.duplicate_var.set("")
+        self.filmstrip.schedule_refresh()
+    
+    def start_gif_stream(self, box):
+        """Показывает первый кадр GIF и запускает фоновое декодирование остальных"""
+        self.stop_animation()
+        
+        with Image.open(open_source(self.session.current_file)) as image:
+            n_frames = image.n_frames
+            duration = image.info.get('duration', 100)
+            first_frame = scale_to_box(image, box)
+        
+        # Если весь цикл помещается в лимит памяти, храним все кадры после первого прохода,
+        # иначе держим в памяти только кольцевой буфер
+        frame_bytes = first_frame.width * first_frame.height * 4
+        loop_limit = min(self.session.gif_cache_budget_mb * 1024 * 1024,
+                         self.session.memory.available(self.session.DISPLAY_OWNERS))
+        cache_loop = n_frames * frame_bytes <= loop_limit
+        # Кольцевой буфер держит кадры и в декодере, и в виде PhotoImage
+        ring_frames = n_frames if cache_loop else self.session.gif_ring_frames * 2
+        self.session.memory.hold("animation", frame_bytes * ring_frames)
+        self.session.memory.hold("current_image", image_nbytes(first_frame))
+        
+        photo = ImageTk.PhotoImage(first_frame)
+        if cache_loop:
+            self.animation_frames.append((photo, duration))
+        self.current_image = first_frame
+        self.display_box = box
+        self.current_photo = photo
+        self.image_label.configure(image=photo)
+        
+        self.gif_streamer = GifStreamer(self.session.current_file, box, 1, n_frames,
+                                        self.session.gif_ring_frames, loop=not cache_loop)
+        self.schedule_gif_frame(1, duration)
+    
+    def stop_animation(self, wait=False):
+        """Останавливает анимацию и фоновый декодер кадров"""
+        if self.animation_timer:
+            self.root.after_cancel(self.animation_timer)
+            self.animation_timer = None
+        if self.gif_streamer:
+            self.gif_streamer.stop(wait)
+            self.gif_streamer = None
+        self.animation_frames = []
+        self.session.memory.release("animation")
+    
+    def schedule_gif_frame(self, frame_index, duration):
+        """Планирует показ следующего кадра через длительность текущего"""
         # Минимальная длительность - 20 мс, чтобы избежать слишком быстрой анимации
         duration = max(duration, 20)
-        
-        # Планируем показ следующего кадра
-        self.animation_timer = self.root.after(duration, lambda: self.animate_gif(next_frame))
+        self.animation_timer = self.root.after(duration, lambda: self.animate_gif(frame_index))
+    
+    def update_file_info(self, stat, attempts=20):
+        """Показывает имя, размер и (если известны) разрешение и формат текущего файла"""
+        filename = os.path.basename(self.session.current_file)
+        info = f"File: {filename}\nSize: {self.format_file_size(stat.st_size)}"
+        
+        meta = self.session.metadata.get(self.session.current_file, stat) if self.session.metadata else None
+        if meta:
+            info += f"\nDimensions: {meta['width']}×{meta['height']} {meta['format'] or ''}".rstrip()
+            if meta["frames"] and meta["frames"] > 1:
+                info += f", {meta['frames']} frames"
+        if meta and meta["dhash"] is not None:
+            self.check_duplicate(meta["dhash"])
+        elif self.session.metadata_indexer and attempts > 0:
+            # Метаданных еще нет - просим индексатор обработать файл в первую очередь
+            if attempts == 20:
+                self.session.metadata_indexer.prioritize(self.session.current_file)
+            path = self.session.current_file
+            def retry():
+                if self.session.current_file == path:
+                    self.update_file_info(stat, attempts - 1)
+            self.root.after(100, retry)
+        self.filename_var.set(info)
+    
+    def check_duplicate(self, value):
+        """Ищет почти одинаковое изображение среди очереди и уже разложенных файлов"""
+        match = self.session.find_duplicate(self.session.current_file, value)
+        if not match:
+            return
+        path, folder = match
+        name = os.path.basename(path)
+        if folder:
+            self.duplicate_folder = folder
+            self.duplicate_var.set(f"Near-duplicate of {name} (already sent to {folder}). "
+                                   f"Press Ctrl+D to send it there too")
+        else:
+            self.duplicate_var.set(f"Near-duplicate of {name} (still in queue)")
+    
+    def route_duplicate(self):
+        """Отправляет текущее изображение в папку, где уже лежит его дубликат"""
+        if self.duplicate_folder in self.session.folders:
+            self.move_to_folder(self.session.folders.index(self.duplicate_folder))
     
-    def scale_image(self, image):
-        """Масштабирует изображение под размер окна"""
-        # Получаем размеры окна и изображения
-        window_width = self.image_frame.winfo_width()
-        window_height = self.image_frame.winfo_height()
-        image_width, image_height = image.size
+    def animate_gif(self, frame_index):
+        """Показывает следующий кадр анимированного GIF"""
+        streamer = self.gif_streamer
+        if not streamer:
+            return
         
-        if window_width <= 1 or window_height <= 1:
-            return image
-            
-        # Вычисляем новые размеры с сохранением пропорций
-        scale_width = window_width / image_width
-        scale_height = window_height / image_height
-        scale = min(scale_width, scale_height)
+        if frame_index < len(self.animation_frames):
+            # Кадр уже закэширован (весь цикл помещается в память)
+            photo, duration = self.animation_frames[frame_index]
+        else:
+            try:
+                frame, duration = streamer.frames.get_nowait()
+            except queue.Empty:
+                if streamer.finished:
+                    # Декодер остановился (например, из-за ошибки) - оставляем последний кадр
+                    return
+                # Декодер не успевает - проверяем еще раз чуть позже
+                self.animation_timer = self.root.after(10, lambda: self.animate_gif(frame_index))
+                return
+            photo = ImageTk.PhotoImage(frame)
+            if not streamer.loop:
+                self.animation_frames.append((photo, duration))
         
-        new_width = int(image_width * scale)
-        new_height = int(image_height * scale)
+        # Показываем текущий кадр
+        self.current_photo = photo
+        self.image_label.configure(image=photo)
         
-        # Масштабируем изображение
-        if new_width != image_width or new_height != image_height:
-            return image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        return image
+        # Определяем следующий кадр
+        next_frame = frame_index + 1
+        if not streamer.loop and next_frame >= streamer.n_frames:
+            next_frame = 0
+        self.schedule_gif_frame(next_frame, duration)
     
     def show_next_image(self):
-        self.show_image(self.current_index + 1)
+        self.navigate(1)
         self.status_var.set("Skipped")
     
     def show_prev_image(self):
-        self.show_image(self.current_index - 1)
+        self.navigate(-1)
+    
+    def navigate(self, step):
+        """Переход на step изображений. Серия быстрых переходов (автоповтор зажатой клавиши)
+        сводится к одному итоговому индексу: промежуточные изображения не декодируются,
+        а полностью показывается только то, на котором серия остановилась"""
+        files = self.session.image_files
+        if not files:
+            return
+        self.session.nav_direction = 1 if step > 0 else -1
+        target = max(0, min(len(files) - 1, self.session.current_index + step))
+        if target == self.session.current_index:
+            return
+        
+        now = time.monotonic()
+        in_burst = self.nav_timer is not None or now - self.nav_last_time < self.session.nav_settle_ms / 1000
+        self.nav_last_time = now
+        if not in_burst:
+            # Одиночное нажатие показываем сразу
+            self.show_image(target)
+            return
+        
+        self.flash_image(target)
+        if self.nav_timer:
+            self.root.after_cancel(self.nav_timer)
+        self.nav_timer = self.root.after(self.session.nav_settle_ms, self.settle_navigation)
+    
+    def flash_image(self, index):
+        """Делает изображение текущим без декодирования, показывая его миниатюру из кэша (если есть)"""
+        self.stop_animation()
+        self.viewer.close()
+        path = self.session.set_current(index)
+        self.duplicate_folder = None
+        self.pyramid_future = None
+        self.session.memory.release("pyramid")
+        # Предзагрузка вокруг промежуточных изображений уже не нужна
+        self.session.prefetcher.schedule([], self.get_display_box())
+        
+        thumbnail = self.filmstrip.cached_thumbnail(path) if self.session.nav_flash_thumbnails else None
+        if thumbnail:
+            box = self.get_display_box()
+            self.set_photo(thumbnail.resize(fit_size(thumbnail.size, box), Image.Resampling.NEAREST))
+            # Итоговый кадр будет построен, когда серия переходов закончится
+            self.preview_active = True
+            self.shown_file = path
+        self.filename_var.set(f"File: {os.path.basename(path)}")
+        self.duplicate_var.set("")
+        self.filmstrip.scroll_to(index)
+    
+    def settle_navigation(self):
+        """Серия переходов закончилась - полностью показываем изображение, на котором она остановилась"""
+        self.nav_timer = None
+        self.show_image(self.session.current_index)
+    
+    def toggle_selection(self, index=None):
+        """Добавляет изображение в выделение или убирает его оттуда"""
+        if index is None:
+            index = self.session.current_index
+        if not self.session.image_files or not 0 <= index < len(self.session.image_files):
+            return
+        self.session.toggle_selection(index)
+        self.update_selection_status()
+    
+    def select_range(self, index):
+        """Выделяет диапазон от опорного изображения до index и показывает index"""
+        if not self.session.image_files or not 0 <= index < len(self.session.image_files):
+            return
+        self.session.select_range(index)
+        self.show_image(index)
+        self.update_selection_status()
+    
+    def extend_selection(self, step):
+        """Shift+стрелка: расширяет выделение на соседнее изображение"""
+        if not self.session.image_files:
+            return
+        self.session.nav_direction = step
+        if not self.session.selection:
+            self.session.selection_anchor = self.session.current_file
+        self.select_range(min(max(self.session.current_index + step, 0), len(self.session.image_files) - 1))
+    
+    def clear_selection(self):
+        self.session.clear_selection()
+        self.filmstrip.schedule_refresh()
+    
+    def update_selection_status(self):
+        self.filmstrip.schedule_refresh()
+        if self.session.selection:
+            self.status_var.set(f"Selected: {len(self.session.selection)}")
+        else:
+            self.status_var.set("Selection cleared")
     
     def move_to_folder(self, folder_index):
-        """Перемещает текущее изображение в выбранную папку"""
-        if not self.current_image or folder_index >= len(self.folders):
+        """Ставит текущее изображение в очередь на перемещение и сразу показывает следующее"""
+        if self.nav_timer:
+            # Серия переходов еще не закончилась. Если миниатюры текущего файла не было в кэше,
+            # на экране остался прежний кадр - перемещаем то изображение, которое видит пользователь
+            shown = self.shown_file
+            if shown in self.session.image_files:
+                self.show_image(self.session.image_files.index(shown))
+            else:
+                self.settle_navigation()
+        if self.session.selection:
+            self.move_selection_to_folder(folder_index)
+            return
+        if not self.current_image or folder_index >= len(self.session.folders):
             return
             
         try:
-            # Проверяем, что текущий файл не изменился
-            if self.current_file != self.image_files[self.current_index]:
-                return
-                
-            # Блокируем все кнопки папок
-            for btn in self.folder_buttons.values():
-                btn.configure(state='disabled')
-            
-            # Создаем папку, если её нет
-            folder_name = self.folders[folder_index]
-            folder_path = os.path.join(self.app_path, folder_name)
-            if not os.path.exists(folder_path):
-                os.makedirs(folder_path)
-            
-            src = self.image_files[self.current_index]
+            # Устанавливаем блокировку
+            self.processing_lock = True
             
-            # Проверяем, существует ли исходный файл
-            if not os.path.exists(src):
-                raise FileNotFoundError("Source file not found")
-                
-            dst = os.path.join(folder_path, os.path.basename(src))
+            # Декодер GIF держит файл открытым - останавливаем его перед перемещением
+            self.stop_animation(wait=True)
             
-            # Проверяем существование файла
-            if os.path.exists(dst):
-                base, ext = os.path.splitext(dst)
-                counter = 1
-                while os.path.exists(f"{base}_{counter}{ext}"):
-                    counter += 1
-                dst = f"{base}_{counter}{ext}"
+            # Ставим перемещение в очередь и сразу убираем файл из списка
+            with self.session.timer.measure("move_submit"):
+                operation = self.session.move_current(folder_index)
+            if operation is None:
+                return
+            self.start_move_polling()
             
-            # Перемещаем файл
-            shutil.move(src, dst)
+            # Показываем следующее изображение, не дожидаясь перемещения
+            if self.session.image_files:
+                self.show_image(self.session.current_index)
+            else:
+                self.clear_image()
             
-            # Сохраняем информацию о перемещении для функции Undo
-            self.move_history.append((src, dst))
+            self.update_counter()
             
             # Обновляем статус с информацией о последнем действии
-            self.status_var.set(f"Moved to: {folder_name}")
-            
-            # Удаляем файл из списка и показываем следующий
-            self.image_files.pop(self.current_index)
-            if self.image_files:
-                if self.current_index >= len(self.image_files):
-                    self.current_index = 0
-                self.show_image(self.current_index)
+            if self.session.image_files:
+                self.status_var.set(f"Moved to: {operation.folder}")
             else:
-                self.current_image = None
-                self.current_file = None
-                self.image_label.configure(image='')
                 self.status_var.set("All images processed")
             
-            # Увеличиваем счетчик обработанных изображений
-            self.processed_images += 1
-            self.update_counter()
-            
         except Exception as e:
             messagebox.showerror("Error", f"Failed to move file: {str(e)}")
-            # Разблокируем кнопки в случае ошибки
-            for btn in self.folder_buttons.values():
-                btn.configure(state='normal')
+        finally:
+            self.processing_lock = False
+    
+    def move_selection_to_folder(self, folder_index):
+        """Перемещает все выделенные изображения одним пакетом"""
+        if self.session.current_file in self.session.selection:
+            self.stop_animation(wait=True)
+        
+        batch, current_removed = self.session.move_selection(folder_index)
+        self.filmstrip.schedule_refresh()
+        if batch is None:
+            return
+        self.start_move_polling()
+        self.update_counter()
+        
+        if self.session.image_files:
+            if current_removed:
+                self.show_image(self.session.current_index)
+            else:
+                self.filmstrip.scroll_to(self.session.current_index)
+            self.status_var.set(f"Moved {len(batch.operations)} images to: {batch.folder}")
+        else:
+            self.clear_image()
+            self.status_var.set("All images processed")
+    
+    def start_move_polling(self):
+        """Запускает проверку результатов фоновых перемещений"""
+        if not self.move_poll_timer:
+            self.move_poll_timer = self.root.after(50, self.poll_move_results)
+    
+    def poll_move_results(self):
+        """Обрабатывает завершенные фоновые перемещения в потоке интерфейса"""
+        if self.move_poll_timer:
+            self.root.after_cancel(self.move_poll_timer)
+            self.move_poll_timer = None
+        self.session.poll_move_results()
+        self.report_failed_moves()
+        
+        # Отмены, выполненные в фоне
+        errors, self.session.undo_errors = self.session.undo_errors, []
+        for error in errors:
+            messagebox.showerror("Error", error)
+        undone, self.session.undone = self.session.undone, []
+        if undone:
+            self.show_undone(undone)
+        
+        # Перемещение на другой диск идет копированием - показываем его ход
+        progress = self.session.move_worker.progress
+        if progress:
+            operation, copied, total = progress
+            extracting = bool(operation and split_archive_path(operation.src)[0])
+            status = (f"{'Extracting' if extracting else 'Copying'} "
+                      f"{os.path.basename(operation.src) if operation else ''}: {copied * 100 // max(total, 1)}%")
+            throughput = self.session.move_worker.copy_throughput()
+            if throughput:
+                status += f" ({throughput / 1048576:.0f} MB/s)"
+            self.status_var.set(status)
+            self.copy_progress_shown = "Extracted from the archive" if extracting else "Copied to another drive"
+        elif self.copy_progress_shown and self.session.moves_in_flight == 0:
+            throughput = self.session.move_worker.copy_throughput()
+            self.status_var.set(f"{self.copy_progress_shown} ({throughput / 1048576:.0f} MB/s)")
+            self.copy_progress_shown = None
+        
+        if self.session.moves_in_flight > 0:
+            self.move_poll_timer = self.root.after(50, self.poll_move_results)
+    
+    def report_failed_moves(self):
+        """Показывает ошибки перемещений; файлы к этому моменту уже вернулись в очередь"""
+        failed, self.session.failed_moves = self.session.failed_moves, []
+        if not failed:
+            return
+        self.update_counter()
+        self.filmstrip.schedule_refresh()
+        for operation in failed:
+            if not self.session.current_file and operation.src in self.session.image_files:
+                # Список был пуст - сразу показываем возвращенный файл
+                self.show_image(self.session.image_files.index(operation.src))
+            self.status_var.set(f"Failed to move {os.path.basename(operation.src)}: "
+                                f"{str(operation.error)}")
+    
+    def toggle_timing_overlay(self):
+        """Показывает или скрывает панель замеров; при показе замеры включаются"""
+        if self.timing_timer:
+            self.timing_frame.pack_forget()
+            self.root.after_cancel(self.timing_timer)
+            self.timing_timer = None
+            return
+        self.session.timer.enabled = True
+        self.timing_frame.pack(fill=tk.X, pady=(0, 10))
+        self.refresh_timing_overlay()
+    
+    def refresh_timing_overlay(self):
+        """Обновляет таблицу p50/p95/p99 по этапам раз в полсекунды"""
+        lines = [f"{'stage':<16}{'p50':>7}{'p95':>7}{'p99':>7}"]
+        for row in self.session.timer.snapshot():
+            lines.append(f"{row['stage'][:16]:<16}{row['p50_ms']:>7.1f}{row['p95_ms']:>7.1f}{row['p99_ms']:>7.1f}")
+        if len(lines) == 1:
+            lines.append("No samples yet")
+        memory = self.session.memory
+        lines.append(f"{'memory, MB':<16}{memory.total_bytes / 1048576:>7.0f} / {memory.max_bytes / 1048576:.0f}")
+        self.timing_var.set("\n".join(lines))
+        self.timing_timer = self.root.after(500, self.refresh_timing_overlay)
     
     def format_file_size(self, bytes):
         """Форматирует размер файла в читаемый вид"""
@@ -1050,13 +1859,15 @@ class ImageSorter:
     
     def open_in_explorer(self):
         """Открывает текущий файл в проводнике Windows"""
-        if not self.current_file or not os.path.exists(self.current_file):
+        # Для элемента архива выделяем сам архив
+        path = split_archive_path(self.session.current_file or "")[0] or self.session.current_file
+        if not path or not os.path.exists(path):
             messagebox.showinfo("Information", "No current file to display")
             return
         
         try:
             # Используем explorer для открытия папки и выделения файла
-            subprocess.run(['explorer', '/select,', os.path.normpath(self.current_file)])
+            subprocess.run(['explorer', '/select,', os.path.normpath(path)])
         except Exception as e:
             messagebox.showerror("Error", f"Failed to open file in explorer: {str(e)}")
     
@@ -1072,49 +1883,44 @@ class ImageSorter:
         # Используем after, чтобы дать окну время обновить свои размеры
         self.root.after(100, self.update_image_size)
     
+    def exit_fullscreen(self):
+        if self.is_fullscreen:
+            self.on_fullscreen()
+    
     def undo_last_action(self):
-        """Отменяет последнее действие"""
-        if not self.move_history:
-            return
-        
-        # Восстанавливаем последнее действие
-        last_action = self.move_history.pop()
-        src, dst = last_action
-        
-        # Проверяем, существует ли файл в текущем местоположении
-        if not os.path.exists(dst):
-            messagebox.showerror("Error", "File not found in destination")
-            return
-        
-        # Проверяем, существует ли исходная папка
-        src_dir = os.path.dirname(src)
-        if not os.path.exists(src_dir):
-            os.makedirs(src_dir)
-        
-        # Перемещаем файл обратно
-        try:
-            shutil.move(dst, src)
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to undo action: {str(e)}")
-            return
-        
+        """Отменяет последнее действие (одиночное перемещение или пакет целиком).
+        Уже выполненные перемещения возвращаются в фоне, как и сами перемещения"""
+        restored, pending = self.session.undo_last()
+        self.report_failed_moves()
+        if pending:
+            self.start_move_polling()
+            if not restored:
+                self.status_var.set("Undoing...")
+        if restored:
+            self.show_undone(restored)
+    
+    def show_undone(self, restored):
+        """Показывает результат отмены"""
         # Обновляем статус
-        self.status_var.set("Action undone")
-        
-        # Обновляем счетчик
-        self.processed_images -= 1
+        if len(restored) > 1:
+            self.status_var.set(f"Action undone: {len(restored)} images returned")
+        else:
+            self.status_var.set("Action undone")
         self.update_counter()
         
-        # Добавляем файл обратно в список изображений
-        self.image_files.append(src)
-        # Сортируем список файлов, чтобы сохранить порядок
-        self.image_files.sort()
-        
-        # Показываем возвращенное изображение
-        new_index = self.image_files.index(src)
-        self.show_image(new_index)
+        # Показываем первое из возвращенных изображений (если оно вернулось в текущую папку)
+        paths = [operation.src for operation in restored if operation.src in self.session.image_files]
+        if paths:
+            self.show_image(self.session.image_files.index(min(paths)))
+        else:
+            self.filmstrip.schedule_refresh()
 
 if __name__ == "__main__":
+    # Нужно для пула процессов в собранном .exe
+    multiprocessing.freeze_support()
+    if "--batch" in sys.argv[1:] or "-h" in sys.argv[1:] or "--help" in sys.argv[1:]:
+        # Пакетный режим работает без окна
+        sys.exit(main_batch(sys.argv[1:]))
     root = tk.Tk()
     app = ImageSorter(root)
     root.mainloop()
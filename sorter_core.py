@@ -0,0 +1,3003 @@
+import os
+import sys
+import json
+import shutil
+from PIL import Image
+import threading
+import time
+import queue
+import bisect
+import io
+import re
+import fnmatch
+import argparse
+import sqlite3
+import csv
+import errno
+import hashlib
+import math
+import weakref
+import multiprocessing
+import mmap
+import struct
+import tarfile
+import tempfile
+import zipfile
+from multiprocessing import shared_memory
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+# При уменьшении сначала применяется быстрое целочисленное сжатие (reduce),
+# а LANCZOS работает только на последнем шаге не более чем с таким запасом
+REDUCING_GAP = 3.0
+
+# Поддерживаемые форматы изображений
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'}
+
+# Файлы программы рядом с .exe (или скриптом)
+SETTINGS_FILE = "image_sorter_settings.json"
+JOURNAL_FILE = "image_sorter_journal.jsonl"
+METADATA_FILE = "image_sorter_cache.sqlite3"
+RULES_FILE = "image_sorter_rules.json"
+TIMINGS_FILE = "image_sorter_timings.csv"
+
+# Недокопированный файл при перемещении между дисками
+PART_SUFFIX = ".part"
+
+def get_app_path():
+    """Папка, в которой находится .exe или скрипт"""
+    if getattr(sys, 'frozen', False):
+        return os.path.dirname(sys.executable)
+    return os.path.dirname(os.path.abspath(__file__))
+
+def list_folders(path):
+    """Список папок назначения в директории (скрытые папки пропускаются)"""
+    folders = []
+    # scandir берет тип записи из данных каталога, без stat для каждого файла
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir() and not entry.name.startswith('.'):
+                folders.append(entry.name)
+    return sorted(folders)
+
+def percentile(values, fraction):
+    """Значение, ниже которого лежит заданная доля выборки (ближайший ранг)"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+class _NullStage:
+    """Пустой контекст для выключенного таймера"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class _StageMeasure:
+    __slots__ = ("timer", "stage", "started")
+
+    def __init__(self, timer, stage):
+        self.timer = timer
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.record(self.stage, time.perf_counter() - self.started)
+        return False
+
+class StageTimer:
+    """Длительность этапов показа и перемещения (открытие файла, декодирование, масштабирование...)
+    Для каждого этапа хранится скользящее окно последних замеров, по которому считаются p50/p95/p99.
+    Выключенный таймер возвращает общий пустой контекст, поэтому замеры почти ничего не стоят"""
+    def __init__(self, window=2048):
+        self.enabled = False
+        self.window = window
+        self.samples = {}  # этап -> deque последних длительностей в секундах
+        self.counts = {}  # этап -> число замеров за все время
+        self.lock = threading.Lock()
+
+    def measure(self, stage):
+        """Контекст, замеряющий длительность блока: with STAGE_TIMER.measure("decode"): ..."""
+        if not self.enabled:
+            return _NULL_STAGE
+        return _StageMeasure(self, stage)
+
+    def record(self, stage, seconds):
+        with self.lock:
+            samples = self.samples.get(stage)
+            if samples is None:
+                samples = self.samples[stage] = deque(maxlen=self.window)
+                self.counts[stage] = 0
+            samples.append(seconds)
+            self.counts[stage] += 1
+
+    def snapshot(self):
+        """Сводка по этапам в миллисекундах, в порядке первого замера"""
+        with self.lock:
+            windows = [(stage, list(samples), self.counts[stage]) for stage, samples in self.samples.items()]
+        rows = []
+        for stage, samples, count in windows:
+            values = [sample * 1000 for sample in samples]
+            rows.append({
+                "stage": stage,
+                "count": count,
+                "mean_ms": sum(values) / len(values),
+                "p50_ms": percentile(values, 0.50),
+                "p95_ms": percentile(values, 0.95),
+                "p99_ms": percentile(values, 0.99),
+                "max_ms": max(values),
+            })
+        return rows
+
+    def dump(self, path):
+        """Сохраняет сводку в CSV или JSON (по расширению файла)"""
+        rows = self.snapshot()
+        if path.lower().endswith('.json'):
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(rows, f, indent=4)
+            return
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=["stage", "count", "mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"])
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+            self.counts.clear()
+
+# Общий таймер процесса: этапы выполняются в разных потоках и модулях
+STAGE_TIMER = StageTimer()
+
+def fit_size(image_size, box):
+    """Вычисляет размер изображения, вписанного в область с сохранением пропорций"""
+    img_width, img_height = image_size
+    box_width, box_height = box
+    scale = min(box_width / img_width, box_height / img_height)
+    return max(1, int(img_width * scale)), max(1, int(img_height * scale))
+
+def image_nbytes(image):
+    """Оценивает объем памяти, занимаемый декодированным изображением"""
+    return image.width * image.height * len(image.getbands())
+
+def is_animated_gif(image):
+    """Проверяет, является ли изображение анимированным GIF"""
+    if image.format != 'GIF':
+        return False
+    try:
+        # Пробуем перейти ко второму кадру - если это возможно, значит GIF анимированный
+        image.seek(1)
+        # Возвращаемся к первому кадру
+        image.seek(0)
+        return True
+    except (EOFError, AttributeError):
+        # Если возникла ошибка EOFError, значит в GIF только один кадр
+        return False
+
+class MemoryBudgetError(Exception):
+    """Декодированное изображение не помещается в общий лимит памяти"""
+    def __init__(self, needed, available):
+        super().__init__(f"Image needs {needed / 1048576:.0f} MB, "
+                         f"only {max(0, available) / 1048576:.0f} MB left in the memory budget")
+        self.needed = needed
+        self.available = available
+
+    def __reduce__(self):
+        # Ошибка может прийти из процесса декодирования
+        return (MemoryBudgetError, (self.needed, self.available))
+
+class MemoryBudget:
+    """Общий учет памяти декодированных изображений.
+    Владельцы (текущий кадр, PhotoImage, кадры GIF, пирамида, источник плиток) сообщают, сколько держат,
+    а кэши подключаются как пулы: при превышении лимита они сокращаются в порядке подключения"""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.held = {}  # владелец -> байт
+        self.pools = []  # кэши с методом shrink(байт) и полем total_bytes
+        self.lock = threading.Lock()
+
+    def add_pool(self, cache):
+        cache.budget = self
+        self.pools.append(cache)
+
+    def hold(self, owner, nbytes):
+        """Запоминает объем, который держит владелец (0 - освобождено), и вытесняет кэши при превышении"""
+        with self.lock:
+            if nbytes:
+                self.held[owner] = nbytes
+            else:
+                self.held.pop(owner, None)
+        self.trim()
+
+    def release(self, *owners):
+        with self.lock:
+            for owner in owners:
+                self.held.pop(owner, None)
+
+    def held_bytes(self, exclude=()):
+        with self.lock:
+            return sum(nbytes for owner, nbytes in self.held.items() if owner not in exclude)
+
+    @property
+    def total_bytes(self):
+        return self.held_bytes() + sum(pool.total_bytes for pool in self.pools)
+
+    def available(self, exclude=()):
+        """Сколько можно декодировать, если освободить кэши и владельцев exclude"""
+        return self.max_bytes - self.held_bytes(exclude)
+
+    def trim(self):
+        """Сокращает кэши, пока общий объем не уложится в лимит"""
+        over = self.total_bytes - self.max_bytes
+        for pool in self.pools:
+            if over <= 0:
+                break
+            over -= pool.shrink(over)
+
+def scale_to_box(image, box, allow_upscale=True, max_bytes=None):
+    """Декодирует открытое изображение и масштабирует его под область отображения.
+    Если max_bytes задан и декодированный битмап в него не помещается, бросает MemoryBudgetError"""
+    new_size = fit_size(image.size, box)
+    if new_size[0] < image.width and new_size[1] < image.height:
+        # JPEG можно декодировать сразу в уменьшенном масштабе (1/2, 1/4, 1/8),
+        # не разворачивая полноразмерный битмап. Для остальных форматов draft ничего не делает
+        image.draft(None, new_size)
+    # После draft размер изображения - это размер, в котором оно будет декодировано
+    if max_bytes is not None and image_nbytes(image) > max_bytes:
+        raise MemoryBudgetError(image_nbytes(image), max_bytes)
+    if new_size == image.size or (not allow_upscale and new_size[0] >= image.width):
+        return image.copy()
+    if new_size[0] < image.width and new_size[1] < image.height:
+        with STAGE_TIMER.measure("decode"):
+            image.load()
+        with STAGE_TIMER.measure("resize"):
+            return image.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+    with STAGE_TIMER.measure("decode"):
+        image.load()
+    with STAGE_TIMER.measure("resize"):
+        return image.resize(new_size, Image.Resampling.LANCZOS)
+
+class ImagePyramid:
+    """Уменьшенные в 2, 4, 8... раз копии изображения для быстрого масштабирования"""
+    def __init__(self, base, min_side=256):
+        self.levels = [base]
+        while min(self.levels[-1].size) // 2 >= min_side:
+            self.levels.append(self.levels[-1].reduce(2))
+
+    @property
+    def size(self):
+        return self.levels[0].size
+
+    @property
+    def nbytes(self):
+        return sum(image_nbytes(level) for level in self.levels)
+
+    def render(self, size, resample):
+        """Масштабирует до нужного размера с самого маленького подходящего уровня"""
+        source = self.levels[0]
+        for level in self.levels[1:]:
+            if level.width < size[0] or level.height < size[1]:
+                break
+            source = level
+        if source.size == size:
+            return source
+        return source.resize(size, resample)
+
+def build_pyramid(path, box, max_bytes=None):
+    """Декодирует изображение не крупнее области box и строит по нему пирамиду"""
+    with STAGE_TIMER.measure("open"):
+        image = Image.open(open_source(path))
+    with image:
+        base = scale_to_box(image, box, allow_upscale=False, max_bytes=max_bytes)
+    return ImagePyramid(base)
+
+# Image.MAX_IMAGE_PIXELS - общий параметр Pillow, поэтому снимаем его только под блокировкой
+_LARGE_IMAGE_LOCK = threading.Lock()
+
+def open_large_image(path):
+    """Открывает изображение без защиты Pillow от "бомбы распаковки".
+    Объем декодируемого битмапа в этом случае ограничивает сам TiledImage"""
+    with _LARGE_IMAGE_LOCK:
+        limit = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+        try:
+            with STAGE_TIMER.measure("open"):
+                return Image.open(open_source(path))
+        finally:
+            Image.MAX_IMAGE_PIXELS = limit
+
+class RegionReader:
+    """Декодирует прямоугольную область изображения в полном разрешении, читая из файла только
+    нужные строки. Подходит для несжатых данных (BMP, PPM, несжатый TIFF, в том числе разбитый
+    на полосы и плитки): положение каждой строки в файле известно заранее. Сжатые форматы
+    (JPEG, PNG, сжатый TIFF, WebP) Pillow умеет декодировать только целиком"""
+    BAND_BYTES = 32 * 1024 * 1024  # Объем полосы при построении уменьшенной копии
+
+    def __init__(self, path, mode, size, palette, blocks):
+        self.path = path
+        self.mode = mode
+        self.size = size
+        self.palette = palette
+        self.blocks = blocks  # [(extents, смещение, rawmode, шаг строки, направление, бит на пиксель)]
+
+    @classmethod
+    def probe(cls, path, image):
+        """RegionReader для открытого, но еще не декодированного изображения
+        или None, если данные нельзя прочитать по частям"""
+        # Поворот из тега Orientation TIFF Pillow применяет только после полного декодирования
+        if getattr(image, "use_load_libtiff", False) or getattr(image, "tag_v2", {}).get(0x0112, 1) != 1:
+            return None
+        blocks = []
+        for tile in image.tile:
+            decoder, extents, offset, args = tile[:4]
+            if isinstance(args, str):
+                args = (args, 0, 1)
+            if decoder != "raw" or not isinstance(args, tuple) or len(args) < 3:
+                return None
+            rawmode, stride, orientation = args[:3]
+            try:
+                # Байт на 8 пикселей - это число бит на пиксель
+                bits = len(Image.new(image.mode, (8, 1)).tobytes("raw", rawmode))
+            except (ValueError, OSError):
+                return None
+            width = extents[2] - extents[0]
+            blocks.append((extents, offset, rawmode, int(stride) or (bits * width + 7) // 8,
+                           -1 if orientation < 0 else 1, bits))
+        # Каналы, записанные отдельными плоскостями (TIFF PlanarConfiguration=2), так не собрать
+        if not blocks or len({block[0] for block in blocks}) != len(blocks):
+            return None
+        palette = image.getpalette() if image.mode in ('P', 'PA') else None
+        return cls(path, image.mode, image.size, palette, blocks)
+
+    def read(self, box):
+        """Область box = (left, top, right, bottom) в пикселях оригинала"""
+        x0, y0, x1, y1 = box
+        region = Image.new(self.mode, (x1 - x0, y1 - y0))
+        if self.palette:
+            region.putpalette(self.palette)
+        source = open_source(self.path)
+        with (open(source, 'rb') if isinstance(source, str) else source) as f:
+            for (ex0, ey0, ex1, ey1), offset, rawmode, stride, orientation, bits in self.blocks:
+                top, bottom = max(y0, ey0), min(y1, ey1)
+                if top >= bottom or ex1 <= x0 or ex0 >= x1:
+                    continue
+                # Строки, записанные снизу вверх (BMP), идут в файле в обратном порядке
+                offset += ((ey1 - bottom) if orientation < 0 else (top - ey0)) * stride
+                left, right = ex0, ex1
+                if bits % 8 == 0:
+                    # Пиксели выровнены по байтам - из строки берем только нужные столбцы
+                    left, right = max(x0, ex0), min(x1, ex1)
+                    offset += (left - ex0) * bits // 8
+                rows = bottom - top
+                f.seek(offset)
+                data = f.read((rows - 1) * stride + (bits * (right - left) + 7) // 8)
+                piece = Image.frombytes(self.mode, (right - left, rows), data, "raw",
+                                        (rawmode, stride, orientation))
+                region.paste(piece, (left - x0, top - y0))
+        return region
+
+    def overview(self, reduction, convert):
+        """Уменьшенная в reduction раз копия, собранная из полос: целиком изображение в памяти
+        не разворачивается. convert приводит полосу к режиму показа"""
+        width, height = self.size
+        row_bytes = max(1, len(Image.new(self.mode, (width, 1)).tobytes()))
+        band = max(reduction, self.BAND_BYTES // row_bytes // reduction * reduction)
+        result = None
+        for top in range(0, height, band):
+            piece = convert(self.read((0, top, width, min(height, top + band))))
+            if reduction > 1:
+                piece = piece.reduce(reduction)
+            if result is None:
+                result = Image.new(piece.mode, (-(-width // reduction), -(-height // reduction)))
+            result.paste(piece, (0, top // reduction))
+        return result
+
+def display_mode(image):
+    """Приводит изображение к режиму, в котором его показывает и масштабирует окно"""
+    if image.mode in ('RGB', 'RGBA', 'L'):
+        return image
+    has_alpha = 'A' in image.getbands() or 'transparency' in image.info
+    return image.convert('RGBA' if has_alpha else 'RGB')
+
+class TiledImage:
+    """Источник плиток для просмотра с увеличением.
+    Обзорная копия строится один раз в разрешении, которое укладывается в max_decode_bytes
+    (промежуточный битмап - в max_bytes). Несжатые форматы читаются по полосам, а при увеличении
+    сверх обзорной копии плитки декодируются из файла в полном разрешении (RegionReader).
+    JPEG сразу декодируется в уменьшенном масштабе (draft), и подробности на нем ограничены этим
+    масштабом. Остальные форматы декодируются целиком и уменьшаются после декодирования: если полный
+    битмап не помещается в max_bytes, выбрасывается MemoryBudgetError.
+    Плитки вырезаются с ближайшего уровня пирамиды и кэшируются в LRU с лимитом по байтам"""
+    def __init__(self, path, tile_cache, max_decode_bytes, max_bytes=None, tile_size=256):
+        self.path = path
+        self.tile_cache = tile_cache
+        self.tile_size = tile_size
+        self.stat = source_stat(path)
+        with open_large_image(path) as image:
+            self.full_size = image.size
+            bands = max(3, len(image.getbands()))  # палитра и ч/б изображения переводятся в RGB
+            reduction = 1
+            while (image.width // reduction) * (image.height // reduction) * bands > max_decode_bytes:
+                reduction *= 2
+            self.region = RegionReader.probe(path, image)
+            if self.region:
+                with STAGE_TIMER.measure("decode"):
+                    base = self.region.overview(reduction, display_mode)
+            else:
+                base = self._decode(image, reduction, max_bytes)
+        self.pyramid = ImagePyramid(base, min_side=tile_size)
+        # Масштаб, до которого обзорная копия показывает все подробности оригинала
+        self.detail_scale = base.width / self.full_size[0]
+
+    def _decode(self, image, reduction, max_bytes):
+        if reduction > 1:
+            # Для JPEG декодер сам уменьшает в 2, 4 или 8 раз, не разворачивая полный битмап
+            image.draft(None, (image.width // reduction, image.height // reduction))
+        # Остальные форматы декодируются целиком - проверяем, что такой битмап поместится в память
+        if max_bytes is not None and image_nbytes(image) > max_bytes:
+            raise MemoryBudgetError(image_nbytes(image), max_bytes)
+        with STAGE_TIMER.measure("decode"):
+            image.load()
+        base = display_mode(image)
+        target = (max(1, self.full_size[0] // reduction), max(1, self.full_size[1] // reduction))
+        if base.width > target[0]:
+            with STAGE_TIMER.measure("resize"):
+                base = base.reduce(max(1, base.width // target[0]))
+        elif base is image:
+            base = image.copy()
+        return base
+
+    @property
+    def nbytes(self):
+        return self.pyramid.nbytes
+
+    def fit_scale(self, box):
+        """Масштаб (пикселей экрана на пиксель оригинала), при котором изображение вписано в box"""
+        return min(box[0] / self.full_size[0], box[1] / self.full_size[1])
+
+    def display_size(self, scale):
+        return max(1, int(self.full_size[0] * scale)), max(1, int(self.full_size[1] * scale))
+
+    def render(self, size):
+        """Все изображение целиком в указанном размере (для обычного показа)"""
+        return self.pyramid.render(size, Image.Resampling.LANCZOS)
+
+    def tile(self, scale, column, row):
+        """Плитка tile_size x tile_size (у краев меньше) изображения в масштабе scale"""
+        key = (self.path, self.stat.st_mtime_ns, round(scale, 6), column, row)
+        cached = self.tile_cache.get(key)
+        if cached is not None:
+            return cached
+        
+        width, height = self.display_size(scale)
+        left, top = column * self.tile_size, row * self.tile_size
+        right, bottom = min(left + self.tile_size, width), min(top + self.tile_size, height)
+        
+        # Самый маленький уровень пирамиды, который еще не меньше нужного масштаба
+        levels = self.pyramid.levels
+        source = levels[0]
+        for level in levels[1:]:
+            if level.width / self.full_size[0] < scale:
+                break
+            source = level
+        ratio = source.width / self.full_size[0] / scale  # пикселей уровня на пиксель экрана
+        box = (left * ratio, top * ratio, right * ratio, bottom * ratio)
+        # При сильном увеличении показываем пиксели как есть, без размытия
+        resample = Image.Resampling.NEAREST if ratio <= 0.5 else Image.Resampling.LANCZOS
+        with STAGE_TIMER.measure("tile"):
+            tile = source.resize((right - left, bottom - top), resample, box=box)
+        self.tile_cache.put(key, tile)
+        return tile
+
+    def needs_region(self, scale):
+        """При таком увеличении плитки стоит декодировать из файла в полном разрешении"""
+        return self.region is not None and scale > self.detail_scale * 1.0001
+
+    def _region_key(self, scale, column, row):
+        return (self.path, self.stat.st_mtime_ns, round(scale, 6), column, row, "region")
+
+    def cached_region_tile(self, scale, column, row):
+        return self.tile_cache.get(self._region_key(scale, column, row))
+
+    def region_tile(self, scale, column, row):
+        """Плитка, декодированная из файла в полном разрешении (выполняется в фоновом потоке)"""
+        key = self._region_key(scale, column, row)
+        cached = self.tile_cache.get(key)
+        if cached is not None:
+            return cached
+        width, height = self.display_size(scale)
+        left, top = column * self.tile_size, row * self.tile_size
+        right, bottom = min(left + self.tile_size, width), min(top + self.tile_size, height)
+        # Пиксели оригинала, которые покрывает плитка
+        x0, y0 = int(left / scale), int(top / scale)
+        x1 = min(self.full_size[0], max(x0 + 1, math.ceil(right / scale)))
+        y1 = min(self.full_size[1], max(y0 + 1, math.ceil(bottom / scale)))
+        with STAGE_TIMER.measure("tile_decode"):
+            region = display_mode(self.region.read((x0, y0, x1, y1)))
+        box = (left / scale - x0, top / scale - y0, right / scale - x0, bottom / scale - y0)
+        resample = Image.Resampling.NEAREST if scale >= 2 else Image.Resampling.LANCZOS
+        with STAGE_TIMER.measure("tile"):
+            tile = region.resize((right - left, bottom - top), resample, box=box)
+        self.tile_cache.put(key, tile)
+        return tile
+
+class GifStreamer:
+    """Фоновый декодер кадров анимированного GIF с ограниченным буфером.
+    Кадры масштабируются в потоке и передаются в очередь не больше ring_size штук"""
+    def __init__(self, path, box, start_frame, n_frames, ring_size, loop=True):
+        self.path = path
+        self.box = box
+        self.start_frame = start_frame
+        self.n_frames = n_frames
+        self.loop = loop  # False - декодируем один проход, кадры кэширует получатель
+        self.frames = queue.Queue(maxsize=max(1, ring_size))  # (кадр, длительность)
+        self.finished = False
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="gif-stream", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            with Image.open(open_source(self.path)) as image:
+                index = self.start_frame
+                while not self.stop_event.is_set():
+                    if index >= self.n_frames:
+                        if not self.loop:
+                            break
+                        index = 0
+                    image.seek(index)
+                    duration = image.info.get('duration', 100)
+                    frame = scale_to_box(image, self.box)
+                    if not self._put((frame, duration)):
+                        break
+                    index += 1
+        except Exception:
+            # Поврежденный хвост файла: показываем уже декодированные кадры
+            pass
+        finally:
+            self.finished = True
+
+    def _put(self, item):
+        # Ждем места в буфере, периодически проверяя сигнал остановки
+        while not self.stop_event.is_set():
+            try:
+                self.frames.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def stop(self, wait=False):
+        """Останавливает декодер. wait=True дожидается закрытия файла"""
+        self.stop_event.set()
+        if wait:
+            self.thread.join(timeout=2)
+
+class MoveOperation:
+    """Перемещение одного файла, ожидающее выполнения в фоновом потоке"""
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, src, dst, folder, status=PENDING, journal_id=None):
+        self.src = src
+        self.dst = dst
+        self.folder = folder
+        self.status = status
+        self.error = None
+        self.journal_id = journal_id  # Номер записи в журнале перемещений
+        self.from_journal = journal_id is not None and status == self.DONE  # Из прошлой сессии
+        self.done_event = threading.Event()  # Устанавливается, когда операция завершена или отменена
+        self.batch = None  # Пакет, в который входит операция
+        if status != self.PENDING:
+            self.done_event.set()
+
+class UndoTask:
+    """Возврат файла выполненного перемещения на место; выполняется потоком MoveWorker"""
+    def __init__(self, operation):
+        self.operation = operation
+        self.done = False  # Файл возвращен
+        self.error = None
+
+class MoveBatch:
+    """Группа перемещений в одну папку: выполняется одной задачей и отменяется как одно действие"""
+    def __init__(self, operations, folder, journal_batch=None):
+        self.operations = list(operations)
+        self.folder = folder
+        self.journal_batch = journal_batch  # Номер пакета в журнале перемещений
+        for operation in self.operations:
+            operation.batch = self
+
+class MoveJournal:
+    """Журнал перемещений: по одной JSON-записи на строку, только дозапись в конец.
+    
+    Записи: ["M", id, src, dst] - начало перемещения (пятым элементом может идти номер пакета),
+    ["C", id] - успешно завершено, ["A", id] - не выполнено, ["U", id] - отменено пользователем.
+    fsync выполняется пакетами: после fsync_batch записей или по истечении fsync_interval секунд"""
+    def __init__(self, path, fsync_batch=32, fsync_interval=0.5):
+        self.path = path
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.next_id = self._read_last_id() + 1
+        self.file = open(path, 'a', encoding='utf-8')
+        if self._has_torn_tail():
+            # Последняя запись оборвана сбоем - начинаем новые записи с новой строки
+            self.file.write('\n')
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def _read_last_id(self):
+        for record in self.read_backwards():
+            return record[1]
+        return 0
+
+    def _has_torn_tail(self):
+        with open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                return False
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) != b'\n'
+
+    def read_backwards(self, block_size=65536):
+        """Читает записи с конца файла блоками, не загружая журнал целиком"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            tail = b''
+            while position > 0:
+                size = min(block_size, position)
+                position -= size
+                f.seek(position)
+                lines = (f.read(size) + tail).split(b'\n')
+                tail = lines.pop(0)
+                for line in reversed(lines):
+                    record = self._parse(line)
+                    if record:
+                        yield record
+            record = self._parse(tail)
+            if record:
+                yield record
+
+    @staticmethod
+    def _parse(line):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # Пустая строка или запись, оборванная при аварийном завершении
+            return None
+        if isinstance(record, list) and len(record) >= 2:
+            return record
+        return None
+
+    def append(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+            self.file.flush()
+            self.unsynced += 1
+            if (self.unsynced >= self.fsync_batch or
+                    time.monotonic() - self.last_sync >= self.fsync_interval):
+                self._sync()
+
+    def new_id(self):
+        with self.lock:
+            journal_id = self.next_id
+            self.next_id += 1
+        return journal_id
+
+    def begin(self, src, dst, batch=None):
+        """Записывает начало перемещения и возвращает номер записи"""
+        journal_id = self.new_id()
+        if batch is None:
+            self.append(["M", journal_id, src, dst])
+        else:
+            self.append(["M", journal_id, src, dst, batch])
+        return journal_id
+
+    def commit(self, journal_id):
+        self.append(["C", journal_id])
+
+    def abort(self, journal_id):
+        self.append(["A", journal_id])
+
+    def undo(self, journal_id):
+        self.append(["U", journal_id])
+
+    def sync(self):
+        """Сбрасывает на диск записи, еще не прошедшие fsync"""
+        with self.lock:
+            if self.unsynced:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+    def load_history(self, limit):
+        """Возвращает не отмененные завершенные перемещения (не больше limit, от старых к новым)
+        и перемещения, прерванные аварийным завершением"""
+        closed = {}  # id -> "C" или "A"
+        undone = set()
+        history = []
+        interrupted = []
+        for record in self.read_backwards():
+            kind, journal_id = record[0], record[1]
+            if kind == "U":
+                undone.add(journal_id)
+            elif kind in ("C", "A"):
+                closed[journal_id] = kind
+            elif kind == "M" and len(record) >= 4:
+                state = closed.get(journal_id)
+                if state is None:
+                    interrupted.append(record)
+                elif state == "C" and journal_id not in undone:
+                    history.append(record)
+                    if len(history) >= limit:
+                        break
+        history.reverse()
+        interrupted.reverse()
+        return history, interrupted
+
+class FolderNameIndex:
+    """Индекс имен файлов в папках назначения.
+    
+    Строится лениво одним scandir на папку и обновляется при перемещениях и отменах,
+    поэтому свободное имя подбирается без проверки os.path.exists для каждого суффикса"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._names = {}  # папка -> множество занятых имен (в регистре файловой системы)
+        self._next_suffix = {}  # (папка, основа, расширение) -> следующий номер суффикса
+        self._suffixes = {}  # (папка, имя) -> (ключ счетчика, номер) для выданных имен с суффиксом
+
+    def _folder_names(self, folder_path):
+        names = self._names.get(folder_path)
+        if names is None:
+            names = set()
+            if os.path.isdir(folder_path):
+                with os.scandir(folder_path) as entries:
+                    names.update(os.path.normcase(entry.name) for entry in entries)
+            self._names[folder_path] = names
+        return names
+
+    def reserve(self, folder_path, filename):
+        """Подбирает свободное имя в папке, помечает его занятым и возвращает полный путь"""
+        with self.lock:
+            return self._reserve(folder_path, filename)
+
+    def reserve_many(self, folder_path, filenames):
+        """Резервирует имена для пакета файлов за одну блокировку"""
+        with self.lock:
+            return [self._reserve(folder_path, filename) for filename in filenames]
+
+    def _reserve(self, folder_path, filename):
+        names = self._folder_names(folder_path)
+        if os.path.normcase(filename) not in names:
+            names.add(os.path.normcase(filename))
+            return os.path.join(folder_path, filename)
+        
+        base, ext = os.path.splitext(filename)
+        counter_key = (folder_path, os.path.normcase(base), os.path.normcase(ext))
+        counter = self._next_suffix.get(counter_key, 1)
+        while os.path.normcase(f"{base}_{counter}{ext}") in names:
+            counter += 1
+        name = f"{base}_{counter}{ext}"
+        names.add(os.path.normcase(name))
+        self._next_suffix[counter_key] = counter + 1
+        self._suffixes[(folder_path, os.path.normcase(name))] = (counter_key, counter)
+        return os.path.join(folder_path, name)
+
+    def release(self, path):
+        """Освобождает имя, если файл больше не находится в папке (отмена или ошибка)"""
+        folder_path, name = os.path.split(path)
+        name = os.path.normcase(name)
+        with self.lock:
+            names = self._names.get(folder_path)
+            if names is not None:
+                names.discard(name)
+            suffix = self._suffixes.pop((folder_path, name), None)
+            if suffix:
+                # Освободившийся номер снова становится первым кандидатом
+                counter_key, counter = suffix
+                if counter < self._next_suffix.get(counter_key, 1):
+                    self._next_suffix[counter_key] = counter
+
+    def invalidate(self, folder_path):
+        """Сбрасывает индекс папки (папка переименована, удалена или изменена извне)"""
+        with self.lock:
+            self._names.pop(folder_path, None)
+            for key in [key for key in self._next_suffix if key[0] == folder_path]:
+                del self._next_suffix[key]
+            for key in [key for key in self._suffixes if key[0] == folder_path]:
+                del self._suffixes[key]
+
+# Элементы архивов попадают в очередь как обычные файлы: путь элемента - путь архива и имя внутри него
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+# Архив не перезаписывается: разложенные элементы отмечаются в файле рядом с ним
+ARCHIVE_MANIFEST_SUFFIX = ".processed.jsonl"
+# Сжатый TAR один раз распаковывается в несжатую копию во временной папке
+ARCHIVE_SPOOL_PREFIX = "umisp-spool-"
+
+# stat элемента архива: время изменения и устройство - от самого архива
+ArchiveMemberStat = namedtuple("ArchiveMemberStat", "st_size st_mtime st_mtime_ns st_dev")
+
+def is_archive(name):
+    return name.lower().endswith(ARCHIVE_EXTENSIONS)
+
+class MappedMember(io.RawIOBase):
+    """Несжатый элемент архива как файл только для чтения поверх mmap архива - без копии в память"""
+    def __init__(self, mapping, start, size):
+        super().__init__()
+        self.view = memoryview(mapping)[start:start + size]
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = max(0, min(len(buffer), len(self.view) - self.position))
+        buffer[:count] = self.view[self.position:self.position + count]
+        self.position += count
+        return count
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            self.view.release()
+        super().close()
+
+class ArchiveManifest:
+    """Элементы архива, уже разложенные по папкам. Файл только дописывается:
+    строки {"done": имя} и {"undone": имя} (после отмены)"""
+    def __init__(self, path):
+        self.path = path
+        self.processed = set()
+        self.lock = threading.Lock()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Оборванная при сбое строка
+                    if "done" in record:
+                        self.processed.add(record["done"])
+                    elif "undone" in record:
+                        self.processed.discard(record["undone"])
+        except FileNotFoundError:
+            pass
+
+    def __contains__(self, name):
+        return name in self.processed
+
+    def mark(self, name, done=True):
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({"done" if done else "undone": name}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            if done:
+                self.processed.add(name)
+            else:
+                self.processed.discard(name)
+
+class ArchiveReader:
+    """Оглавление архива ZIP или TAR и чтение отдельных элементов без распаковки архива.
+    ZIP читается по центральному каталогу, TAR - одним последовательным проходом по заголовкам.
+    Несжатые элементы отдаются через mmap, сжатые элементы ZIP распаковываются в память.
+    Сжатый TAR не позволяет перейти к элементу без распаковки всего, что перед ним, поэтому
+    он один раз целиком распаковывается в несжатую копию (spool), и дальше читается как обычный TAR"""
+    def __init__(self, path):
+        self.path = path
+        self.stat = os.stat(path)
+        self.lock = threading.Lock()  # Отображение создается один раз на все потоки
+        self.mapping = None
+        self.members = {}  # имя -> ZipInfo или TarInfo
+        self.spool = None  # Несжатая копия сжатого TAR
+        if zipfile.is_zipfile(path):
+            self.zip, self.tar = zipfile.ZipFile(path), None
+            for info in self.zip.infolist():
+                # Каталоги и зашифрованные элементы пропускаем
+                if not info.is_dir() and not info.flag_bits & 0x1:
+                    self.members[info.filename] = info
+        else:
+            self.zip, self.tar = None, tarfile.open(path)
+            if not isinstance(self.tar.fileobj, io.BufferedReader):
+                self.tar = self._open_spool()
+            for info in self.tar:
+                if info.isfile() and not info.issparse():
+                    self.members[info.name] = info
+        self.manifest = ArchiveManifest(path + ARCHIVE_MANIFEST_SUFFIX)
+
+    def _open_spool(self):
+        """Распаковывает сжатый TAR одним последовательным проходом и открывает несжатую копию.
+        Имя копии зависит от архива, его размера и времени изменения, поэтому процессы пула
+        декодирования (и программа, перезапущенная после сбоя) берут уже готовую копию"""
+        key = f"{os.path.abspath(self.path)}|{self.stat.st_size}|{self.stat.st_mtime_ns}"
+        self.spool = os.path.join(tempfile.gettempdir(),
+                                  ARCHIVE_SPOOL_PREFIX + hashlib.sha1(key.encode('utf-8')).hexdigest() + ".tar")
+        if not os.path.exists(self.spool):
+            # Копия получает свое имя только целиком: прерванная распаковка не оставит обрывок
+            part_path = f"{self.spool}.{os.getpid()}.{threading.get_ident()}{PART_SUFFIX}"
+            try:
+                with STAGE_TIMER.measure("archive_spool"):
+                    self.tar.fileobj.seek(0)
+                    with open(part_path, 'wb') as f:
+                        shutil.copyfileobj(self.tar.fileobj, f, 4 * 1024 * 1024)
+                os.replace(part_path, self.spool)
+            except Exception as e:
+                try:
+                    os.remove(part_path)
+                except OSError:
+                    pass
+                # Другой поток или процесс успел распаковать архив первым (на Windows
+                # занятую копию нельзя заменить) - берем его копию
+                if not (isinstance(e, OSError) and os.path.exists(self.spool)):
+                    self.tar.close()
+                    if isinstance(e, OSError):
+                        raise
+                    # Оборванный или поврежденный поток сжатых данных
+                    raise tarfile.ReadError(f"Cannot unpack {os.path.basename(self.path)}: {e}") from e
+        self.tar.close()
+        return tarfile.open(self.spool)
+
+    def pending(self, extensions):
+        """Пути еще не разложенных изображений архива"""
+        return [os.path.join(self.path, *name.split('/')) for name in self.members
+                if os.path.splitext(name)[1].lower() in extensions and name not in self.manifest]
+
+    def _map(self):
+        with self.lock:
+            if self.mapping is None:
+                with open(self.spool or self.path, 'rb') as f:
+                    self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.mapping
+
+    def open(self, name):
+        """Файловый объект с содержимым элемента"""
+        info = self.members[name]
+        if self.zip:
+            if info.compress_type == zipfile.ZIP_STORED:
+                mapping = self._map()
+                # Данные начинаются после локального заголовка: 30 байт, имя и дополнительное поле
+                name_length, extra_length = struct.unpack_from("<HH", mapping, info.header_offset + 26)
+                start = info.header_offset + 30 + name_length + extra_length
+                return MappedMember(mapping, start, info.file_size)
+            return io.BytesIO(self.zip.read(info))
+        return MappedMember(self._map(), info.offset_data, info.size)
+
+    def member_stat(self, name):
+        info = self.members[name]
+        size = info.file_size if self.zip else info.size
+        return ArchiveMemberStat(size, self.stat.st_mtime, self.stat.st_mtime_ns, self.stat.st_dev)
+
+    def member_time(self, name):
+        """Время изменения элемента, записанное в архиве"""
+        info = self.members[name]
+        return time.mktime(info.date_time + (0, 0, -1)) if self.zip else info.mtime
+
+    def close(self):
+        (self.zip or self.tar).close()
+        if self.mapping is not None:
+            try:
+                self.mapping.close()
+            except BufferError:
+                pass  # Элемент еще открыт - отображение закроется вместе с ним
+        # Копию удаляет основной процесс; процессы пула только читают ее
+        if self.spool and multiprocessing.parent_process() is None:
+            try:
+                os.remove(self.spool)
+            except OSError:
+                pass  # На Windows копия еще отображена - останется во временной папке
+
+_ARCHIVES = {}  # путь архива -> ArchiveReader; у каждого процесса свои
+_ARCHIVES_LOCK = threading.Lock()
+
+def archive_reader(path):
+    """Открывает архив при первом обращении и дальше возвращает тот же ArchiveReader"""
+    reader = _ARCHIVES.get(path)
+    if reader is None:
+        # Оглавление большого TAR читается долго - не держим блокировку на это время
+        reader = ArchiveReader(path)
+        with _ARCHIVES_LOCK:
+            reader = _ARCHIVES.setdefault(path, reader)
+    return reader
+
+def close_archives():
+    with _ARCHIVES_LOCK:
+        readers = list(_ARCHIVES.values())
+        _ARCHIVES.clear()
+    for reader in readers:
+        reader.close()
+
+def split_archive_path(path):
+    """'/drop/photos.zip/2024/a.jpg' -> ('/drop/photos.zip', '2024/a.jpg'); для обычного файла - (None, None)"""
+    lower = path.lower()
+    for extension in ARCHIVE_EXTENSIONS:
+        marker = extension + os.sep
+        index = lower.find(marker)
+        while index != -1:
+            archive = path[:index + len(extension)]
+            if archive in _ARCHIVES or os.path.isfile(archive):
+                return archive, path[index + len(marker):].replace(os.sep, '/')
+            index = lower.find(marker, index + 1)
+    return None, None
+
+def open_source(path):
+    """То, что можно передать в Image.open: путь обычного файла или файловый объект элемента архива"""
+    archive, name = split_archive_path(path)
+    if archive is None:
+        return path
+    return archive_reader(archive).open(name)
+
+def source_stat(path):
+    """os.stat для обычного файла, ArchiveMemberStat для элемента архива"""
+    archive, name = split_archive_path(path)
+    if archive is None:
+        return os.stat(path)
+    reader = archive_reader(archive)
+    if name not in reader.members:
+        raise FileNotFoundError(errno.ENOENT, "No such archive member", path)
+    return reader.member_stat(name)
+
+def source_exists(path):
+    """Файл существует; элемент архива - есть в архиве и еще не разложен"""
+    archive, name = split_archive_path(path)
+    if archive is None:
+        return os.path.exists(path)
+    try:
+        reader = archive_reader(archive)
+    except (OSError, zipfile.BadZipFile, tarfile.TarError):
+        return False
+    return name in reader.members and name not in reader.manifest
+
+def file_sha256(path, chunk_size):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+def copy_file_chunked(src, dst, chunk_size, verify=False, progress=None):
+    """Копирует src в dst кусками по chunk_size через временный файл dst.part.
+    progress(скопировано, всего) вызывается после каждого куска. При verify SHA-256 записанной копии
+    сверяется с исходным файлом до того, как копия получит свое имя. src может быть элементом архива -
+    тогда он извлекается. Возвращает число скопированных байт"""
+    archive, member = split_archive_path(src)
+    total = source_stat(src).st_size
+    part_path = dst + PART_SUFFIX
+    digest = hashlib.sha256() if verify else None
+    copied = 0
+    try:
+        source = open(src, 'rb') if archive is None else archive_reader(archive).open(member)
+        # 'xb' - не затираем чужой файл с таким же именем
+        with source as fsrc, open(part_path, 'xb') as fdst:
+            for chunk in iter(lambda: fsrc.read(chunk_size), b''):
+                fdst.write(chunk)
+                if digest:
+                    digest.update(chunk)
+                copied += len(chunk)
+                if progress:
+                    progress(copied, total)
+            fdst.flush()
+            os.fsync(fdst.fileno())
+        if digest and file_sha256(part_path, chunk_size) != digest.digest():
+            raise OSError(f"Checksum mismatch after copying {os.path.basename(src)}")
+        if archive is None:
+            shutil.copystat(src, part_path)
+        else:
+            # Извлеченный файл получает время изменения, записанное в архиве
+            mtime = archive_reader(archive).member_time(member)
+            os.utime(part_path, (mtime, mtime))
+        os.rename(part_path, dst)
+    except BaseException:
+        try:
+            os.remove(part_path)
+        except OSError:
+            pass
+        raise
+    return copied
+
+class MoveWorker:
+    """Фоновый поток, выполняющий перемещения файлов строго в порядке постановки"""
+    def __init__(self, journal=None, retries=5, retry_delay=0.1, chunk_size=4 * 1024 * 1024, verify_copies=True):
+        self.journal = journal  # Журнал перемещений (может отсутствовать)
+        self.retries = retries  # Попытки при временной блокировке файла (Windows)
+        self.retry_delay = retry_delay
+        self.chunk_size = chunk_size  # Размер куска при копировании между дисками
+        self.verify_copies = verify_copies  # Сверять контрольную сумму копии перед удалением исходного файла
+        self.devices = {}  # папка -> st_dev, чтобы не вызывать stat для каждого файла
+        self.progress = None  # (операция, скопировано, всего) для текущего копирования между дисками
+        self.stats = {"renames": 0, "copies": 0, "extracts": 0, "bytes_copied": 0, "copy_seconds": 0.0}
+        self.tasks = queue.Queue()
+        self.results = queue.Queue()  # Завершенные операции для потока интерфейса
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name="move-worker", daemon=True)
+        self.thread.start()
+
+    def submit(self, task):
+        """Ставит в очередь операцию MoveOperation, пакет MoveBatch или отмену UndoTask"""
+        self.tasks.put(task)
+
+    def cancel(self, operation):
+        """Отменяет операцию, если она еще не начата"""
+        with self.lock:
+            if operation.status != MoveOperation.PENDING:
+                return False
+            operation.status = MoveOperation.CANCELLED
+        operation.done_event.set()
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                operation = self.tasks.get(timeout=0.5 if self.journal else None)
+            except queue.Empty:
+                # Очередь простаивает - сбрасываем на диск хвост журнала
+                self.journal.sync()
+                continue
+            if operation is None:
+                self.tasks.task_done()
+                break
+            if isinstance(operation, MoveBatch):
+                self._run_batch(operation)
+            elif isinstance(operation, UndoTask):
+                self._run_undo(operation)
+            else:
+                self._run_operation(operation)
+            self.tasks.task_done()
+
+    def _run_batch(self, batch):
+        """Выполняет пакет: папка создается один раз, переименования идут подряд"""
+        folder_error = None
+        try:
+            folder_path = os.path.dirname(batch.operations[0].dst)
+            if not os.path.exists(folder_path):
+                os.makedirs(folder_path)
+        except OSError as e:
+            folder_error = e
+        if self.journal and batch.journal_batch is None:
+            batch.journal_batch = self.journal.new_id()
+        # Список пакета принадлежит потоку интерфейса - обходим его копию
+        for operation in list(batch.operations):
+            self._run_operation(operation, batch.journal_batch, create_folder=False, error=folder_error)
+
+    def _run_operation(self, operation, journal_batch=None, create_folder=True, error=None):
+        with self.lock:
+            if operation.status == MoveOperation.CANCELLED:
+                return
+            operation.status = MoveOperation.RUNNING
+        try:
+            if error:
+                raise error
+            if self.journal:
+                operation.journal_id = self.journal.begin(operation.src, operation.dst, journal_batch)
+            self.move_file(operation.src, operation.dst, create_folder, operation)
+            operation.status = MoveOperation.DONE
+            if self.journal:
+                self.journal.commit(operation.journal_id)
+        except Exception as e:
+            operation.error = e
+            operation.status = MoveOperation.FAILED
+            if self.journal and operation.journal_id is not None:
+                try:
+                    self.journal.abort(operation.journal_id)
+                except OSError:
+                    pass
+        operation.done_event.set()
+        self.results.put(operation)
+
+    def _run_undo(self, task):
+        operation = task.operation
+        # Само перемещение стоит в очереди раньше и к этому моменту уже завершено
+        operation.done_event.wait()
+        if operation.status == MoveOperation.DONE:
+            src, dst = operation.src, operation.dst
+            try:
+                # Проверяем, существует ли файл в текущем местоположении
+                if not os.path.exists(dst):
+                    raise FileNotFoundError(f"File not found in destination: {os.path.basename(dst)}")
+                # Проверяем, существует ли исходная папка (элемент архива возвращать некуда - он в архиве)
+                src_dir = os.path.dirname(src)
+                if not split_archive_path(src)[0] and not os.path.exists(src_dir):
+                    os.makedirs(src_dir)
+                # Перемещаем файл обратно тем же способом (переименование или проверенная копия)
+                self.move_file(dst, src, create_folder=False, operation=operation)
+                if self.journal and operation.journal_id is not None:
+                    self.journal.undo(operation.journal_id)
+                task.done = True
+            except Exception as e:
+                task.error = e
+        self.results.put(task)
+
+    def _device(self, folder_path):
+        device = self.devices.get(folder_path)
+        if device is None:
+            device = self.devices[folder_path] = os.stat(folder_path).st_dev
+        return device
+
+    def move_file(self, src, dst, create_folder=True, operation=None):
+        """Перемещает файл: на том же диске - переименованием, на другой - проверенной копией.
+        Элемент архива извлекается, а при отмене извлеченный файл удаляется"""
+        archive, member = split_archive_path(dst)
+        if archive:
+            # Элемент и так лежит в архиве - достаточно убрать копию и снять отметку
+            os.remove(src)
+            archive_reader(archive).manifest.mark(member, done=False)
+            return
+        folder_path = os.path.dirname(dst)
+        if create_folder and not os.path.exists(folder_path):
+            os.makedirs(folder_path)
+        if os.path.exists(dst):
+            # Файл появился в папке в обход индекса имен - не перезаписываем его
+            raise FileExistsError(f"Destination already exists: {os.path.basename(dst)}")
+        if split_archive_path(src)[0]:
+            self._extract(src, dst, operation)
+            return
+        for attempt in range(self.retries):
+            try:
+                with STAGE_TIMER.measure("move"):
+                    if self._device(os.path.dirname(src)) == self._device(folder_path):
+                        try:
+                            # Тот же диск: атомарное переименование без копирования данных
+                            os.rename(src, dst)
+                            self.stats["renames"] += 1
+                            return
+                        except OSError as e:
+                            # Одинаковый st_dev еще не гарантирует общую файловую систему (bind mount)
+                            if e.errno != errno.EXDEV:
+                                raise
+                    self._copy_across(src, dst, operation)
+                return
+            except PermissionError:
+                # Файл может быть еще открыт (например, декодером) - даем время на освобождение
+                if attempt == self.retries - 1:
+                    raise
+                time.sleep(self.retry_delay)
+
+    def _copy_across(self, src, dst, operation):
+        """Перемещение на другой диск: копия кусками с проверкой, затем удаление исходного файла"""
+        def progress(copied, total):
+            self.progress = (operation, copied, total)
+        started = time.perf_counter()
+        try:
+            with STAGE_TIMER.measure("copy"):
+                copied = copy_file_chunked(src, dst, self.chunk_size, self.verify_copies, progress)
+            try:
+                os.remove(src)
+            except OSError:
+                # Исходный файл не удалить - убираем копию, чтобы файл не оказался в двух местах
+                os.remove(dst)
+                raise
+        finally:
+            self.progress = None
+        self.stats["copies"] += 1
+        self.stats["bytes_copied"] += copied
+        self.stats["copy_seconds"] += time.perf_counter() - started
+
+    def _extract(self, src, dst, operation):
+        """Извлекает из архива только этот элемент прямо в папку назначения и отмечает его как разложенный"""
+        def progress(copied, total):
+            self.progress = (operation, copied, total)
+        archive, member = split_archive_path(src)
+        started = time.perf_counter()
+        try:
+            with STAGE_TIMER.measure("extract"):
+                copied = copy_file_chunked(src, dst, self.chunk_size, self.verify_copies, progress)
+        finally:
+            self.progress = None
+        archive_reader(archive).manifest.mark(member)
+        self.stats["extracts"] += 1
+        self.stats["bytes_copied"] += copied
+        self.stats["copy_seconds"] += time.perf_counter() - started
+
+    def copy_throughput(self):
+        """Средняя скорость копирования между дисками в байтах в секунду (0, если копий не было)"""
+        seconds = self.stats["copy_seconds"]
+        return self.stats["bytes_copied"] / seconds if seconds else 0.0
+
+    def shutdown(self):
+        """Дожидается выполнения всех операций в очереди и останавливает поток"""
+        self.tasks.put(None)
+        self.thread.join()
+        if self.journal:
+            self.journal.close()
+
+class ImageQueue:
+    """Отсортированная очередь путей к файлам.
+    
+    Пути хранятся блоками по ~load элементов, а длины блоков - в дереве Фенвика, поэтому
+    доступ по позиции, поиск позиции по пути, удаление и вставка с сохранением порядка
+    выполняются за O(log n) (плюс сдвиг внутри одного блока). Все операции защищены
+    блокировкой, чтобы очередь можно было разделять со сканером и фоновыми потоками"""
+    def __init__(self, paths=(), load=1000):
+        self.load = load
+        self.lock = threading.RLock()
+        self._build(sorted(set(paths)))
+
+    def _build(self, sorted_paths):
+        self._lists = [sorted_paths[i:i + self.load] for i in range(0, len(sorted_paths), self.load)]
+        self._maxes = [block[-1] for block in self._lists]
+        self._len = len(sorted_paths)
+        self._rebuild_tree()
+
+    def _rebuild_tree(self):
+        count = len(self._lists)
+        tree = [0] * (count + 1)
+        for i in range(1, count + 1):
+            tree[i] += len(self._lists[i - 1])
+            parent = i + (i & -i)
+            if parent <= count:
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _tree_add(self, block_index, delta):
+        i = block_index + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, block_index):
+        """Количество элементов во всех блоках до block_index"""
+        total = 0
+        i = block_index
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def _locate(self, index):
+        """Находит блок и смещение в нем для позиции index"""
+        if index < 0:
+            index += self._len
+        if index < 0 or index >= self._len:
+            raise IndexError("queue index out of range")
+        position = 0
+        step = 1 << (len(self._lists).bit_length() - 1)
+        while step:
+            next_position = position + step
+            if next_position <= len(self._lists) and self._tree[next_position] <= index:
+                position = next_position
+                index -= self._tree[next_position]
+            step >>= 1
+        return position, index
+
+    def _find(self, path):
+        """Возвращает (блок, смещение) для пути или (блок, None), если пути нет"""
+        block_index = bisect.bisect_left(self._maxes, path)
+        if block_index == len(self._maxes):
+            return block_index, None
+        block = self._lists[block_index]
+        offset = bisect.bisect_left(block, path)
+        if offset < len(block) and block[offset] == path:
+            return block_index, offset
+        return block_index, None
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        with self.lock:
+            block_index, offset = self._locate(index)
+            return self._lists[block_index][offset]
+
+    def __iter__(self):
+        with self.lock:
+            blocks = [list(block) for block in self._lists]
+        for block in blocks:
+            yield from block
+
+    def __contains__(self, path):
+        with self.lock:
+            return self._find(path)[1] is not None
+
+    def index(self, path):
+        """Позиция пути в очереди"""
+        with self.lock:
+            block_index, offset = self._find(path)
+            if offset is None:
+                raise ValueError(f"{path} is not in queue")
+            return self._prefix(block_index) + offset
+
+    def add(self, path):
+        """Вставляет путь с сохранением порядка и возвращает его позицию"""
+        with self.lock:
+            if not self._lists:
+                self._build([path])
+                return 0
+            block_index, offset = self._find(path)
+            if offset is not None:
+                return self._prefix(block_index) + offset
+            if block_index == len(self._lists):
+                block_index -= 1
+            block = self._lists[block_index]
+            offset = bisect.bisect_left(block, path)
+            block.insert(offset, path)
+            self._maxes[block_index] = block[-1]
+            self._len += 1
+            position = self._prefix(block_index) + offset
+            if len(block) > 2 * self.load:
+                # Делим переполненный блок пополам
+                half = len(block) // 2
+                self._lists[block_index:block_index + 1] = [block[:half], block[half:]]
+                self._maxes[block_index:block_index + 1] = [block[half - 1], block[-1]]
+                self._rebuild_tree()
+            else:
+                self._tree_add(block_index, 1)
+            return position
+
+    def update(self, paths):
+        """Добавляет пачку путей и возвращает количество действительно добавленных"""
+        with self.lock:
+            new_paths = sorted({path for path in paths if self._find(path)[1] is None})
+            if len(new_paths) > len(self._lists):
+                # Крупную пачку выгоднее слить со всей очередью за линейное время
+                merged = list(self)
+                merged.extend(new_paths)
+                merged.sort()
+                self._build(merged)
+            else:
+                for path in new_paths:
+                    self.add(path)
+            return len(new_paths)
+
+    def remove(self, path):
+        """Удаляет путь и возвращает позицию, которую он занимал"""
+        with self.lock:
+            block_index, offset = self._find(path)
+            if offset is None:
+                raise ValueError(f"{path} is not in queue")
+            position = self._prefix(block_index) + offset
+            self._delete(block_index, offset)
+            return position
+
+    def pop(self, index):
+        """Удаляет и возвращает путь по позиции"""
+        with self.lock:
+            block_index, offset = self._locate(index)
+            path = self._lists[block_index][offset]
+            self._delete(block_index, offset)
+            return path
+
+    def _delete(self, block_index, offset):
+        block = self._lists[block_index]
+        del block[offset]
+        self._len -= 1
+        if block:
+            self._maxes[block_index] = block[-1]
+            self._tree_add(block_index, -1)
+        else:
+            del self._lists[block_index]
+            del self._maxes[block_index]
+            self._rebuild_tree()
+
+class DirectoryScanner:
+    """Фоновое сканирование папки через os.scandir.
+    Найденные изображения передаются пачками, первое - сразу, как только найдено"""
+    def __init__(self, path, extensions, batch_size=4096, batch_interval=0.1, archives=True):
+        self.path = path
+        self.extensions = extensions
+        self.archives = archives  # Добавлять изображения из архивов ZIP и TAR в папке
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.batches = queue.Queue()
+        self.error = None
+        self.finished = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="scanner", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        batch = []
+        published = False
+        started = last_publish = time.monotonic()
+        try:
+            with os.scandir(self.path) as entries:
+                for entry in entries:
+                    if self.stop_event.is_set():
+                        break
+                    archive = self.archives and is_archive(entry.name)
+                    if not archive and os.path.splitext(entry.name)[1].lower() not in self.extensions:
+                        continue
+                    try:
+                        # Тип берется из данных каталога, без отдельного stat на файл
+                        if not entry.is_file():
+                            continue
+                        if archive:
+                            # Очередь строится по оглавлению архива, без распаковки
+                            batch.extend(archive_reader(entry.path).pending(self.extensions))
+                        else:
+                            batch.append(entry.path)
+                    except (OSError, zipfile.BadZipFile, tarfile.TarError):
+                        continue
+                    now = time.monotonic()
+                    if (not published or len(batch) >= self.batch_size or
+                            now - last_publish >= self.batch_interval):
+                        if not published and STAGE_TIMER.enabled:
+                            STAGE_TIMER.record("scan_first_batch", now - started)
+                        self.batches.put(batch)
+                        batch = []
+                        published = True
+                        last_publish = now
+        except OSError as e:
+            self.error = e
+        finally:
+            if batch:
+                self.batches.put(batch)
+            if STAGE_TIMER.enabled:
+                STAGE_TIMER.record("scan", time.monotonic() - started)
+            self.finished.set()
+
+    def stop(self):
+        self.stop_event.set()
+
+class MetadataCache:
+    """Постоянный кэш метаданных и миниатюр изображений в SQLite.
+    Запись действительна, пока у файла не изменились размер и время изменения"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            width INTEGER,
+            height INTEGER,
+            format TEXT,
+            frames INTEGER,
+            thumbnail BLOB,
+            accessed REAL,
+            dhash INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS files_accessed ON files (accessed);
+    """
+    FIELDS = ("width", "height", "format", "frames", "thumbnail", "dhash")
+
+    def __init__(self, path, max_bytes):
+        self.max_bytes = max_bytes  # Лимит суммарного объема миниатюр
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(files)")}
+        if "dhash" not in columns:
+            # Кэш из предыдущей версии - хэши досчитает индексатор
+            self.conn.execute("ALTER TABLE files ADD COLUMN dhash INTEGER")
+        self.conn.commit()
+
+    def get(self, path, stat):
+        """Возвращает словарь метаданных или None, если записи нет или файл изменился"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT width, height, format, frames, thumbnail, dhash FROM files "
+                "WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, stat.st_size, stat.st_mtime_ns)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE files SET accessed = ? WHERE path = ?", (time.time(), path))
+        meta = dict(zip(self.FIELDS, row))
+        meta["size"] = stat.st_size
+        if meta["dhash"] is not None and meta["dhash"] < 0:
+            # SQLite хранит только знаковые 64-битные числа
+            meta["dhash"] += 1 << 64
+        return meta
+
+    def put(self, path, stat, meta):
+        dhash = meta.get("dhash")
+        if dhash is not None and dhash >= 1 << 63:
+            dhash -= 1 << 64
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files "
+                "(path, size, mtime_ns, width, height, format, frames, thumbnail, accessed, dhash) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime_ns, meta["width"], meta["height"],
+                 meta["format"], meta["frames"], meta["thumbnail"], time.time(), dhash))
+
+    def rename(self, old_path, new_path):
+        """Переносит запись вслед за перемещенным файлом (время изменения при этом сохраняется)"""
+        with self.lock:
+            self.conn.execute("DELETE FROM files WHERE path = ?", (new_path,))
+            self.conn.execute("UPDATE files SET path = ? WHERE path = ?", (new_path, old_path))
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def evict(self):
+        """Удаляет давно не использованные записи, пока объем миниатюр превышает лимит"""
+        with self.lock:
+            total = self.conn.execute(
+                "SELECT COALESCE(SUM(LENGTH(thumbnail)), 0) FROM files").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            excess = total - self.max_bytes
+            removed = 0
+            rows = self.conn.execute(
+                "SELECT path, COALESCE(LENGTH(thumbnail), 0) FROM files ORDER BY accessed").fetchall()
+            stale = []
+            for path, nbytes in rows:
+                if removed >= excess:
+                    break
+                stale.append((path,))
+                removed += nbytes
+            self.conn.executemany("DELETE FROM files WHERE path = ?", stale)
+            self.conn.commit()
+
+    def close(self, vacuum=True):
+        """Вытесняет лишние записи, сжимает базу и закрывает соединение"""
+        self.evict()
+        with self.lock:
+            self.conn.commit()
+            if vacuum:
+                self.conn.execute("VACUUM")
+            self.conn.close()
+
+def compute_dhash(image, size=8):
+    """Разностный перцептивный хэш (dHash): 64 бита сравнения соседних пикселей
+    уменьшенной полутоновой копии. Устойчив к пересжатию и изменению размера"""
+    gray = image.convert('L').resize((size + 1, size), Image.Resampling.BOX)
+    pixels = gray.tobytes()
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+def read_image_metadata(path, thumbnail_size=(128, 128)):
+    """Читает размеры, формат и число кадров изображения, строит миниатюру в JPEG
+    и считает перцептивный хэш по ней"""
+    with Image.open(open_source(path)) as image:
+        meta = {
+            "width": image.width,
+            "height": image.height,
+            "format": image.format,
+            "frames": getattr(image, "n_frames", 1),
+        }
+        image.draft('RGB', thumbnail_size)
+        image.thumbnail(thumbnail_size, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+        thumb = image.convert('RGB')
+    meta["dhash"] = compute_dhash(thumb)
+    buffer = io.BytesIO()
+    thumb.save(buffer, format='JPEG', quality=80)
+    meta["thumbnail"] = buffer.getvalue()
+    return meta
+
+class MetadataIndexer:
+    """Фоновый поток, заполняющий кэш метаданных для файлов очереди.
+    Декодирование миниатюр выполняется в пуле процессов (если он передан),
+    чтобы тяжелые JPEG не конкурировали за GIL с потоком интерфейса"""
+    def __init__(self, cache, executor=None, max_in_flight=8, commit_every=100):
+        self.cache = cache
+        self.executor = executor
+        self.max_in_flight = max_in_flight
+        self.commit_every = commit_every
+        self.listeners = []  # Вызываются из фонового потока с путем и метаданными обработанного файла
+        self.paths = deque()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, name="metadata-indexer", daemon=True)
+        self.thread.start()
+
+    def enqueue(self, paths):
+        with self.condition:
+            self.paths.extend(paths)
+            self.condition.notify()
+
+    def prioritize(self, path):
+        """Ставит файл в начало очереди (например, текущее изображение)"""
+        with self.condition:
+            self.paths.appendleft(path)
+            self.condition.notify()
+
+    def _next_path(self, block):
+        with self.condition:
+            while block and not self.paths and not self.stopped:
+                self.condition.wait()
+            if self.stopped or not self.paths:
+                return None
+            return self.paths.popleft()
+
+    def _run(self):
+        uncommitted = 0
+        in_flight = {}  # Future -> (путь, stat)
+        while not self.stopped:
+            # Набираем задачи, пока есть место в пуле
+            while len(in_flight) < self.max_in_flight:
+                block = not in_flight and not uncommitted
+                path = self._next_path(block)
+                if path is None:
+                    break
+                try:
+                    stat = source_stat(path)
+                    meta = self.cache.get(path, stat)
+                    if meta is not None and meta["dhash"] is not None:
+                        self._notify(path, meta)
+                        continue
+                    if self.executor:
+                        in_flight[self.executor.submit(read_image_metadata, path)] = (path, stat)
+                        continue
+                    meta = read_image_metadata(path)
+                    self.cache.put(path, stat, meta)
+                    uncommitted += 1
+                    self._notify(path, meta)
+                except Exception:
+                    # Файл перемещен, удален или поврежден - просто пропускаем его
+                    continue
+            
+            if in_flight:
+                done, _ = wait(in_flight, timeout=0.2, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, stat = in_flight.pop(future)
+                    try:
+                        meta = future.result()
+                        self.cache.put(path, stat, meta)
+                    except Exception:
+                        continue
+                    uncommitted += 1
+                    self._notify(path, meta)
+            elif uncommitted and not self.paths:
+                # Очередь опустела - фиксируем накопленные записи
+                self.cache.commit()
+                uncommitted = 0
+            
+            if uncommitted >= self.commit_every:
+                self.cache.commit()
+                uncommitted = 0
+
+    def _notify(self, path, meta):
+        for listener in self.listeners:
+            listener(path, meta)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join(timeout=2)
+        if self.executor:
+            self.executor.shutdown(wait=False)
+
+class BKTree:
+    """BK-дерево по расстоянию Хэмминга для поиска близких перцептивных хэшей.
+    Каждый узел хранит хэш и множество путей с этим хэшем"""
+    def __init__(self):
+        self.root = None  # [хэш, множество путей, {расстояние: дочерний узел}]
+
+    def add(self, value, path):
+        if self.root is None:
+            self.root = [value, {path}, {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].add(path)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, {path}, {}]
+                return
+            node = child
+
+    def find(self, value):
+        """Возвращает узел с точно таким хэшем или None"""
+        node = self.root
+        while node is not None:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                return node
+            node = node[2].get(distance)
+        return None
+
+    def search(self, value, radius):
+        """Все (расстояние, путь) с расстоянием не больше radius, ближайшие первыми"""
+        results = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node = nodes.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= radius:
+                results.extend((distance, path) for path in node[1])
+            # По неравенству треугольника подходят только поддеревья в диапазоне
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    nodes.append(child)
+        results.sort()
+        return results
+
+class DuplicateIndex:
+    """Индекс перцептивных хэшей очереди и уже перемещенных файлов.
+    Пополняется из потока индексатора, запросы приходят из потока интерфейса"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tree = BKTree()
+        self.hashes = {}  # путь -> хэш
+
+    def add(self, path, value):
+        with self.lock:
+            if self.hashes.get(path) == value:
+                return
+            self._discard(path)
+            self.hashes[path] = value
+            self.tree.add(value, path)
+
+    def _discard(self, path):
+        value = self.hashes.pop(path, None)
+        if value is not None:
+            node = self.tree.find(value)
+            if node:
+                # Узел остается в дереве, чтобы не перестраивать поддеревья
+                node[1].discard(path)
+
+    def rename(self, old_path, new_path):
+        """Переносит хэш вслед за перемещенным файлом"""
+        with self.lock:
+            value = self.hashes.get(old_path)
+            if value is not None:
+                self._discard(old_path)
+                self.hashes[new_path] = value
+                self.tree.add(value, new_path)
+
+    def find_similar(self, path, value, radius):
+        """Ближайшие к value файлы, кроме самого path"""
+        with self.lock:
+            return [(distance, other) for distance, other in self.tree.search(value, radius)
+                    if other != path]
+
+class DisplayCache:
+    """LRU-кэш масштабированных изображений с ограничением по объему памяти"""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.budget = None  # Общий MemoryBudget, если кэш к нему подключен
+        self._items = OrderedDict()  # ключ -> (изображение, размер в байтах)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Возвращает изображение из кэша или None"""
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, image):
+        """Добавляет изображение в кэш, вытесняя самые старые записи"""
+        nbytes = image_nbytes(image)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old:
+                self.total_bytes -= old[1]
+            self._items[key] = (image, nbytes)
+            self.total_bytes += nbytes
+            self._evict()
+        if self.budget:
+            self.budget.trim()
+
+    def set_budget(self, max_bytes):
+        """Изменяет лимит памяти кэша"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.total_bytes = 0
+
+    def shrink(self, nbytes):
+        """Вытесняет самые старые записи, пока не освободится nbytes. Возвращает освобожденный объем"""
+        freed = 0
+        with self._lock:
+            while freed < nbytes and self._items:
+                _, (_, size) = self._items.popitem(last=False)
+                self.total_bytes -= size
+                freed += size
+        return freed
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._items:
+            _, (_, nbytes) = self._items.popitem(last=False)
+            self.total_bytes -= nbytes
+
+def decode_to_shared_memory(path, segment_name, box, max_bytes=None):
+    """Выполняется в процессе пула: декодирует и масштабирует изображение и записывает
+    готовые к показу пиксели в сегмент общей памяти. Возвращает (режим, размер) или None для анимированных GIF"""
+    with Image.open(open_source(path)) as image:
+        if is_animated_gif(image):
+            return None
+        scaled = scale_to_box(image, box, max_bytes=max_bytes)
+    # Режимы, которые Image.frombuffer отображает на буфер без копирования
+    if scaled.mode not in ('L', 'RGBA', 'RGBX'):
+        has_alpha = 'A' in scaled.getbands() or 'transparency' in scaled.info
+        scaled = scaled.convert('RGBA' if has_alpha else 'RGBX')
+    data = scaled.tobytes()
+    segment = shared_memory.SharedMemory(name=segment_name)
+    try:
+        if len(data) > segment.size:
+            raise ValueError(f"Decoded image does not fit into the shared buffer: {len(data)} > {segment.size}")
+        segment.buf[:len(data)] = data
+    finally:
+        segment.close()
+    return scaled.mode, scaled.size
+
+class SharedMemoryDecoder:
+    """Пул процессов для декодирования и масштабирования без GIL основного процесса.
+    Сегмент общей памяти создает основной процесс, процесс пула записывает в него пиксели,
+    а возвращенное изображение ссылается на сегмент напрямую - без pickle и копирования"""
+    def __init__(self, workers):
+        self.workers = workers
+        # spawn - как и у пула миниатюр: одинаковое поведение на всех платформах
+        self.executor = ProcessPoolExecutor(max_workers=workers,
+                                            mp_context=multiprocessing.get_context("spawn"))
+
+    def decode(self, path, box, max_bytes=None):
+        """Блокирует вызывающий поток до готовности изображения. Для анимированных GIF возвращает None"""
+        # Масштабированное изображение вписано в область, поэтому 4 байт на пиксель области хватает всегда
+        segment = shared_memory.SharedMemory(create=True, size=box[0] * box[1] * 4)
+        try:
+            with STAGE_TIMER.measure("process_decode"):
+                result = self.executor.submit(decode_to_shared_memory, path, segment.name, box, max_bytes).result()
+            if result is not None:
+                mode, size = result
+                # Отдельное представление буфера: на него ссылается только изображение
+                view = memoryview(segment.buf)
+                image = Image.frombuffer(mode, size, view, "raw", mode, 0, 1)
+        except BaseException:
+            segment.close()
+            segment.unlink()
+            raise
+        # Имя сегмента больше не нужно; память остается, пока она отображена (на Windows unlink ничего не делает)
+        segment.unlink()
+        if result is None:
+            segment.close()
+            return None
+        # Сегмент закрывается, когда удаляется изображение, а с ним и представление буфера.
+        # memoryview освобождает буфер до вызова weakref-обработчиков, поэтому close не встретит экспорт
+        finalizer = weakref.finalize(view, segment.close)
+        # При выходе из программы изображение может быть еще живо - отображение освободит ОС
+        finalizer.atexit = False
+        del view
+        return image
+
+    def shutdown(self, wait=True):
+        """Отменяет еще не начатые задачи; при wait дожидается завершения процессов пула"""
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+class ImagePrefetcher:
+    """Пул потоков, заранее декодирующий соседние изображения в кэш"""
+    def __init__(self, cache, workers=2):
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+        self.pending = {}  # (путь, размер области) -> Future
+        self.lock = threading.Lock()
+        self.process_decoder = None  # SharedMemoryDecoder, если декодирование вынесено в процессы
+
+    def use_processes(self, decoder):
+        """Переключает декодирование на пул процессов. Потоков предзагрузки становится
+        столько же, сколько процессов, чтобы все процессы были заняты"""
+        self.process_decoder = decoder
+        previous = self.executor
+        self.executor = ThreadPoolExecutor(max_workers=decoder.workers, thread_name_prefix="prefetch")
+        previous.shutdown(wait=False)
+
+    @staticmethod
+    def cache_key(path, box, stat=None):
+        """Ключ кэша: путь, время изменения файла и размер области отображения"""
+        if stat is None:
+            stat = source_stat(path)
+        return (path, stat.st_mtime_ns, box)
+
+    def decode(self, path, box, stat=None, max_bytes=None):
+        """Декодирует и масштабирует изображение, сохраняя результат в кэш.
+        Для анимированных GIF возвращает None - они отображаются отдельно"""
+        key = self.cache_key(path, box, stat)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        decoder = self.process_decoder
+        if decoder:
+            try:
+                scaled = decoder.decode(path, box, max_bytes)
+            except BrokenProcessPool:
+                # Процесс пула аварийно завершился - дальше декодируем в потоках
+                self.process_decoder = None
+                decoder.shutdown(wait=False)
+                return self.decode(path, box, stat, max_bytes)
+            if scaled is not None:
+                self.cache.put(key, scaled)
+            return scaled
+        with STAGE_TIMER.measure("open"):
+            image = Image.open(open_source(path))
+        with image:
+            if is_animated_gif(image):
+                return None
+            scaled = scale_to_box(image, box, max_bytes=max_bytes)
+        self.cache.put(key, scaled)
+        return scaled
+
+    def schedule(self, paths, box):
+        """Ставит в очередь предзагрузку изображений в порядке приоритета.
+        Задачи, которые больше не нужны и еще не начаты, отменяются"""
+        wanted = [(path, box) for path in paths]
+        with self.lock:
+            for request, future in list(self.pending.items()):
+                if request not in wanted and future.cancel():
+                    del self.pending[request]
+            for request in wanted:
+                if request not in self.pending:
+                    future = self.executor.submit(self._run, *request)
+                    self.pending[request] = future
+
+    def wait_for(self, path, box):
+        """Ждет завершения уже запущенной предзагрузки, чтобы не декодировать файл дважды"""
+        with self.lock:
+            future = self.pending.get((path, box))
+            if future is not None and future.cancel():
+                # Задача еще не начата - проще декодировать файл сразу
+                del self.pending[(path, box)]
+                future = None
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception:
+            return None
+
+    def _run(self, path, box):
+        try:
+            # Предзагрузка не должна вытеснять то, что уже показано
+            max_bytes = self.cache.budget.available() if self.cache.budget else None
+            return self.decode(path, box, max_bytes=max_bytes)
+        except Exception:
+            # Ошибки предзагрузки не критичны: файл будет загружен при показе
+            return None
+        finally:
+            with self.lock:
+                self.pending.pop((path, box), None)
+
+    def shutdown(self):
+        with self.lock:
+            for future in self.pending.values():
+                future.cancel()
+            self.pending.clear()
+        self.executor.shutdown(wait=False)
+        if self.process_decoder:
+            self.process_decoder.shutdown()
+
+class SortingSession:
+    """Сеанс сортировки без привязки к интерфейсу: очередь изображений, декодирование
+    и масштабирование, фоновые перемещения, история Undo и настройки.
+    Окно (или тест производительности) вызывает методы сеанса и само показывает результат"""
+    # Владельцы памяти, которые освобождаются при переходе к другому изображению
+    DISPLAY_OWNERS = ("current_image", "photo", "pyramid", "animation", "tiled_source")
+    # Настройки, которые сохраняются в файле настроек вместе с горячими клавишами
+    SETTINGS = (
+        ("prefetch_depth", int),
+        ("read_archives", bool),
+        ("cache_budget_mb", int),
+        ("prefetch_direction_aware", bool),
+        ("decode_backend", str),
+        ("decode_workers", int),
+        ("resize_preview_filter", str),
+        ("gif_ring_frames", int),
+        ("gif_cache_budget_mb", int),
+        ("journal_undo_depth", int),
+        ("metadata_cache_mb", int),
+        ("thumbnail_workers", int),
+        ("duplicate_max_distance", int),
+        ("memory_budget_mb", int),
+        ("copy_chunk_mb", int),
+        ("nav_settle_ms", int),
+        ("nav_flash_thumbnails", bool),
+        ("verify_copies", bool),
+        ("tile_cache_mb", int),
+        ("viewer_decode_mb", int),
+        ("timing_enabled", bool),
+        ("timing_log_file", str),
+    )
+
+    def __init__(self, app_path=None):
+        self.app_path = app_path or get_app_path()
+        self.image_files = ImageQueue()  # Отсортированная очередь файлов
+        self.current_index = -1
+        self.current_file = None  # Текущий обрабатываемый файл
+        self.folders = []
+        self.folder_hotkeys = {}  # Словарь для хранения горячих клавиш папок
+        self.processed_images = 0  # Счетчик обработанных изображений
+        self.total_images = 0  # Общее количество изображений
+        self.image_extensions = set(IMAGE_EXTENSIONS)
+        self.read_archives = True  # Брать изображения из архивов ZIP и TAR без распаковки
+        self.settings_file = SETTINGS_FILE  # Имя файла настроек
+        self.journal_file = JOURNAL_FILE  # Журнал перемещений для Undo между сессиями
+        self.metadata_file = METADATA_FILE  # Кэш метаданных и миниатюр
+        
+        # Перемещения и история
+        self.move_history = []  # История перемещений для функции Undo (MoveOperation или MoveBatch)
+        self.failed_moves = []  # Неудавшиеся перемещения, о которых еще не сообщили пользователю
+        self.undone = []  # Операции, отмененные фоновым потоком, о которых еще не сообщили пользователю
+        self.undo_errors = []  # Тексты ошибок фоновой отмены
+        self.selection = set()  # Выделенные файлы для пакетного перемещения
+        self.selection_anchor = None  # Файл, от которого строится выделение диапазона
+        self.moves_in_flight = 0  # Сколько перемещений еще не завершено
+        self.name_index = FolderNameIndex()  # Занятые имена в папках назначения
+        self.scanner = None  # Фоновое сканирование папки с изображениями
+        self.scan_excluded = set()  # Файлы, перемещенные во время сканирования
+        self.journal_undo_depth = 10000  # Сколько перемещений из журнала доступно для отмены
+        
+        # Настройки предзагрузки и отображения
+        self.prefetch_depth = 3  # Сколько изображений декодировать заранее
+        self.cache_budget_mb = 256  # Лимит памяти кэша масштабированных изображений
+        self.prefetch_direction_aware = True  # Предзагружать в направлении последнего перехода
+        self.nav_direction = 1  # Направление последнего перехода: 1 - вперед, -1 - назад
+        self.nav_settle_ms = 120  # Пауза, после которой серия быстрых переходов считается законченной
+        self.nav_flash_thumbnails = True  # Показывать миниатюры промежуточных изображений серии
+        self.resize_preview_filter = "bilinear"  # Фильтр быстрого превью: "bilinear" или "nearest"
+        self.gif_ring_frames = 16  # Сколько кадров GIF декодируется заранее
+        self.gif_cache_budget_mb = 64  # Лимит памяти, при котором весь цикл GIF хранится целиком
+        self.decode_backend = "threads"  # "processes" - декодировать в пуле процессов с общей памятью
+        self.decode_workers = 0  # Процессов декодирования (0 - по числу ядер)
+        self.display_cache = DisplayCache(self.cache_budget_mb * 1024 * 1024)
+        self.prefetcher = ImagePrefetcher(self.display_cache)
+        
+        # Просмотр с увеличением
+        self.tile_cache_mb = 64  # Лимит памяти кэша плиток
+        self.viewer_decode_mb = 512  # Наибольший объем декодированного оригинала для просмотра с увеличением
+        self.tile_cache = DisplayCache(self.tile_cache_mb * 1024 * 1024)
+        
+        # Общий лимит памяти декодированных изображений; кэши сокращаются в этом порядке
+        self.memory_budget_mb = 1024
+        self.memory = MemoryBudget(self.memory_budget_mb * 1024 * 1024)
+        self.memory.add_pool(self.display_cache)
+        self.memory.add_pool(self.tile_cache)
+        
+        # Журнал перемещений хранится рядом с файлом настроек
+        try:
+            self.journal = MoveJournal(os.path.join(self.app_path, self.journal_file))
+        except OSError:
+            # Без журнала Undo работает только в пределах сессии
+            self.journal = None
+        self.copy_chunk_mb = 4  # Размер куска при копировании на другой диск
+        self.verify_copies = True  # Сверять контрольную сумму копии перед удалением оригинала
+        self.move_worker = MoveWorker(self.journal)  # Фоновое выполнение перемещений
+        
+        # Кэш метаданных и миниатюр, заполняемый в фоне
+        self.metadata_cache_mb = 512  # Лимит объема миниатюр в кэше метаданных
+        try:
+            self.metadata = MetadataCache(os.path.join(self.app_path, self.metadata_file),
+                                          self.metadata_cache_mb * 1024 * 1024)
+        except sqlite3.Error:
+            self.metadata = None
+        self.metadata_indexer = None  # Запускается после загрузки настроек
+        self.thumbnail_workers = 0  # Процессов для построения миниатюр (0 - по числу ядер)
+        self.duplicates = DuplicateIndex()  # Перцептивные хэши для поиска почти одинаковых изображений
+        self.duplicate_max_distance = 6  # Наибольшее число отличающихся бит хэша у дубликатов
+        
+        # Замеры длительности этапов
+        self.timer = STAGE_TIMER
+        self.timing_enabled = False  # Собирать замеры с самого запуска
+        self.timing_log_file = TIMINGS_FILE  # Куда сохранить сводку при выходе (.csv или .json)
+
+    def save_settings(self):
+        """Сохраняет настройки в JSON-файл"""
+        settings = {"folder_hotkeys": self.folder_hotkeys}
+        for name, _ in self.SETTINGS:
+            settings[name] = getattr(self, name)
+        settings_path = os.path.join(self.app_path, self.settings_file)
+        with self.timer.measure("settings_save"):
+            with open(settings_path, 'w', encoding='utf-8') as f:
+                json.dump(settings, f, ensure_ascii=False, indent=4)
+
+    def load_settings(self):
+        """Загружает настройки из JSON-файла. Возвращает True, если в нем были горячие клавиши"""
+        settings_path = os.path.join(self.app_path, self.settings_file)
+        if not os.path.exists(settings_path):
+            return False
+        started = time.perf_counter()
+        with open(settings_path, 'r', encoding='utf-8') as f:
+            settings = json.load(f)
+        
+        for name, kind in self.SETTINGS:
+            setattr(self, name, kind(settings.get(name, getattr(self, name))))
+        # Включен ли таймер, становится известно только из самих настроек
+        if self.timing_enabled:
+            self.timer.enabled = True
+            self.timer.record("settings_load", time.perf_counter() - started)
+        self.display_cache.set_budget(self.cache_budget_mb * 1024 * 1024)
+        self.tile_cache.set_budget(self.tile_cache_mb * 1024 * 1024)
+        self.memory.max_bytes = self.memory_budget_mb * 1024 * 1024
+        self.memory.trim()
+        self.move_worker.chunk_size = max(1, self.copy_chunk_mb) * 1024 * 1024
+        self.move_worker.verify_copies = self.verify_copies
+        if self.metadata:
+            self.metadata.max_bytes = self.metadata_cache_mb * 1024 * 1024
+        
+        if "folder_hotkeys" in settings:
+            self.folder_hotkeys = settings["folder_hotkeys"]
+            return True
+        return False
+
+    def get_existing_folders(self):
+        """Получает список существующих папок в директории"""
+        return list_folders(self.app_path)
+
+    def start_metadata_indexer(self):
+        """Запускает индексатор метаданных с пулом процессов для миниатюр"""
+        if not self.metadata:
+            return
+        workers = self.thumbnail_workers or max(1, min(8, (os.cpu_count() or 2) - 1))
+        try:
+            # spawn - одинаковое поведение на всех платформах и без копирования состояния потоков
+            executor = ProcessPoolExecutor(max_workers=workers,
+                                           mp_context=multiprocessing.get_context("spawn"))
+        except (OSError, ValueError, NotImplementedError):
+            # Пул процессов недоступен - строим миниатюры в фоновом потоке
+            executor = None
+        self.metadata_indexer = MetadataIndexer(self.metadata, executor, max_in_flight=workers * 2)
+        self.metadata_indexer.listeners.append(self.on_metadata_indexed)
+
+    def start_decoder(self):
+        """Запускает пул процессов декодирования, если он выбран в настройках"""
+        if self.decode_backend != "processes" or self.prefetcher.process_decoder:
+            return
+        workers = self.decode_workers or max(1, (os.cpu_count() or 2) - 1)
+        try:
+            decoder = SharedMemoryDecoder(workers)
+        except (OSError, ValueError, NotImplementedError):
+            # Пул процессов недоступен - декодируем в потоках
+            return
+        self.prefetcher.use_processes(decoder)
+
+    def on_metadata_indexed(self, path, meta):
+        """Добавляет хэш файла в индекс дубликатов (вызывается из потока индексатора)"""
+        if meta["dhash"] is not None:
+            self.duplicates.add(path, meta["dhash"])
+
+    def recover_journal(self):
+        """Загружает историю перемещений прошлых сессий и завершает прерванные операции.
+        Возвращает количество восстановленных операций"""
+        if not self.journal:
+            return 0
+        history, interrupted = self.journal.load_history(self.journal_undo_depth)
+        
+        # Прерванные операции сверяем с состоянием файловой системы
+        for record in interrupted:
+            journal_id, src, dst = record[1:4]
+            archive, member = split_archive_path(src)
+            if os.path.exists(dst) and not archive and os.path.exists(src):
+                # Оба файла на месте: сбой мог случиться между переименованием копии в dst
+                # и удалением src. Наша копия попадает в dst только после проверки, поэтому она
+                # совпадает с src; несовпадающий dst - чужой файл, его не трогаем
+                if not self.is_interrupted_copy(src, dst):
+                    self.journal.abort(journal_id)
+                else:
+                    try:
+                        os.remove(src)
+                        self.journal.commit(journal_id)
+                        history.append(record)
+                    except OSError:
+                        # Исходный файл не удалить - убираем копию, чтобы файл не оказался в двух местах
+                        try:
+                            os.remove(dst)
+                        except OSError:
+                            pass
+                        self.journal.abort(journal_id)
+            elif os.path.exists(dst) and (archive or not os.path.exists(src)):
+                # Файл успел переместиться (или извлечься из архива) до сбоя
+                self.journal.commit(journal_id)
+                history.append(record)
+                reader = archive_reader(archive) if archive else None
+                if reader and member not in reader.manifest:
+                    reader.manifest.mark(member)
+            else:
+                # Перемещение не состоялось (исходный файл на месте) или файл потерян
+                self.journal.abort(journal_id)
+            # Недокопированный при перемещении на другой диск файл
+            try:
+                os.remove(dst + PART_SUFFIX)
+            except OSError:
+                pass
+        self.journal.sync()
+        history.sort(key=lambda record: record[1])
+        
+        # Перемещения одного пакета снова объединяем в одно действие для Undo
+        restored = []
+        for record in history:
+            journal_id, src, dst = record[1:4]
+            journal_batch = record[4] if len(record) > 4 else None
+            operation = MoveOperation(src, dst, os.path.basename(os.path.dirname(dst)),
+                                      status=MoveOperation.DONE, journal_id=journal_id)
+            if journal_batch is None:
+                restored.append(operation)
+            elif (restored and isinstance(restored[-1], MoveBatch) and
+                    restored[-1].journal_batch == journal_batch):
+                restored[-1].operations.append(operation)
+                operation.batch = restored[-1]
+            else:
+                restored.append(MoveBatch([operation], operation.folder, journal_batch))
+        self.move_history = restored + self.move_history
+        return len(interrupted)
+
+    def is_interrupted_copy(self, src, dst):
+        """dst - завершенная копия src, оставшаяся после сбоя. Сначала сверяются размер и время
+        изменения (копия получает время оригинала), и только при совпадении - SHA-256"""
+        try:
+            src_stat, dst_stat = os.stat(src), os.stat(dst)
+            # Допуск в 2 секунды - точность времени изменения на FAT
+            if src_stat.st_size != dst_stat.st_size or abs(src_stat.st_mtime - dst_stat.st_mtime) > 2:
+                return False
+            chunk_size = self.move_worker.chunk_size
+            return file_sha256(src, chunk_size) == file_sha256(dst, chunk_size)
+        except OSError:
+            return False
+
+    def index_moved_files(self):
+        """Ставит уже разложенные файлы в очередь индексатора: их хэши нужны для поиска дубликатов"""
+        if not self.metadata_indexer:
+            return
+        moved = []
+        for entry in self.move_history:
+            operations = entry.operations if isinstance(entry, MoveBatch) else [entry]
+            moved.extend(operation.dst for operation in operations)
+        self.metadata_indexer.enqueue(moved)
+
+    def start_scan(self):
+        """Запускает фоновое сканирование папки с изображениями"""
+        self.image_files = ImageQueue()
+        self.total_images = 0
+        self.scanner = DirectoryScanner(self.app_path, self.image_extensions, archives=self.read_archives)
+
+    def poll_scan(self):
+        """Добавляет в очередь файлы, найденные сканером с прошлой проверки.
+        Возвращает количество добавленных файлов и признак окончания сканирования"""
+        scanner = self.scanner
+        if scanner is None:
+            return 0, True
+        finished = scanner.finished.is_set()
+        
+        added = 0
+        while True:
+            try:
+                batch = scanner.batches.get_nowait()
+            except queue.Empty:
+                break
+            added += self.merge_scanned(batch)
+            # Метаданные новых файлов собираем в фоне
+            if self.metadata_indexer:
+                self.metadata_indexer.enqueue(batch)
+        self.total_images += added
+        
+        if finished:
+            self.scanner = None
+            self.scan_excluded.clear()
+        return added, finished
+
+    def merge_scanned(self, batch):
+        """Вливает пачку найденных файлов в отсортированный список, сохраняя текущую позицию.
+        Возвращает количество добавленных файлов"""
+        # Пропускаем файлы, уже перемещенные во время сканирования;
+        # файлы, которые уже есть в очереди (например, после Undo), очередь отбросит сама
+        added = self.image_files.update(path for path in batch if path not in self.scan_excluded)
+        if added and self.current_file:
+            self.current_index = self.image_files.index(self.current_file)
+        return added
+
+    def set_current(self, index):
+        """Делает изображение с указанным индексом текущим и возвращает его путь"""
+        self.current_file = self.image_files[index]
+        self.current_index = index
+        return self.current_file
+
+    def load_display_image(self, path, box, stat=None):
+        """Возвращает масштабированное изображение из кэша или декодирует его.
+        Для анимированных GIF возвращает None"""
+        key = self.prefetcher.cache_key(path, box, stat)
+        image = self.display_cache.get(key)
+        if image is None:
+            # Если файл уже декодируется в фоне, дожидаемся результата
+            image = self.prefetcher.wait_for(path, box)
+        if image is None:
+            # Текущее изображение будет заменено, поэтому его память в расчет не берем
+            image = self.prefetcher.decode(path, box, stat, self.memory.available(self.DISPLAY_OWNERS))
+        return image
+
+    def load_preview(self, path, box, stat=None):
+        """Уменьшенное превью файла, который не помещается в лимит памяти:
+        JPEG декодируется в масштабе 1/8, для остальных форматов берется миниатюра из кэша метаданных.
+        Возвращает None, если превью получить нельзя"""
+        with Image.open(open_source(path)) as image:
+            if image.format == 'JPEG':
+                image.draft(None, (1, 1))  # Самый мелкий масштаб декодера
+                if image_nbytes(image) <= self.memory.available(self.DISPLAY_OWNERS):
+                    return image.resize(fit_size(image.size, box), Image.Resampling.BILINEAR)
+        if self.metadata:
+            meta = self.metadata.get(path, stat or source_stat(path))
+            if meta and meta["thumbnail"]:
+                with Image.open(io.BytesIO(meta["thumbnail"])) as thumbnail:
+                    return thumbnail.resize(fit_size(thumbnail.size, box), Image.Resampling.BILINEAR)
+        return None
+
+    def schedule_prefetch(self, box):
+        """Запускает предзагрузку соседних изображений"""
+        if self.prefetch_depth <= 0 or not self.image_files:
+            return
+        
+        depth = self.prefetch_depth
+        if self.prefetch_direction_aware:
+            # Основная глубина - в направлении движения, одно изображение - в обратном
+            offsets = [self.nav_direction * d for d in range(1, depth + 1)]
+            offsets.append(-self.nav_direction)
+        else:
+            # Симметрично вперед и назад
+            offsets = []
+            for d in range(1, depth + 1):
+                offsets.extend((d, -d))
+        
+        paths = []
+        for offset in offsets:
+            i = self.current_index + offset
+            if 0 <= i < len(self.image_files):
+                paths.append(self.image_files[i])
+        self.prefetcher.schedule(paths, box)
+
+    def find_duplicate(self, path, value):
+        """Ищет почти одинаковое изображение среди очереди и уже разложенных файлов.
+        Возвращает (путь дубликата, папка назначения или None) либо None"""
+        matches = self.duplicates.find_similar(path, value, self.duplicate_max_distance)
+        # При равном расстоянии важнее файлы, которые уже отправлены в папку
+        matches.sort(key=lambda match: (match[0], self.in_source_folder(match[1])))
+        for distance, other in matches[:5]:
+            if not source_exists(other):
+                continue
+            folder_path = os.path.dirname(other)
+            folder = os.path.basename(folder_path)
+            if os.path.dirname(folder_path) == self.app_path and folder in self.folders:
+                return other, folder
+            return other, None
+        return None
+
+    def toggle_selection(self, index):
+        """Добавляет изображение в выделение или убирает его оттуда"""
+        path = self.image_files[index]
+        if path in self.selection:
+            self.selection.discard(path)
+        else:
+            self.selection.add(path)
+        self.selection_anchor = path
+
+    def select_range(self, index):
+        """Выделяет диапазон от опорного изображения до index"""
+        if self.selection_anchor is None or self.selection_anchor not in self.image_files:
+            self.selection_anchor = self.current_file or self.image_files[index]
+        anchor = self.image_files.index(self.selection_anchor)
+        first, last = min(anchor, index), max(anchor, index)
+        self.selection = set(self.image_files[first:last + 1])
+
+    def clear_selection(self):
+        self.selection = set()
+        self.selection_anchor = None
+
+    def move_current(self, folder_index):
+        """Ставит текущее изображение в очередь на перемещение и убирает его из списка.
+        Возвращает операцию или None, если перемещать нечего"""
+        if not self.current_file or folder_index >= len(self.folders):
+            return None
+        
+        # Проверяем, что текущий файл не изменился
+        if self.current_file != self.image_files[self.current_index]:
+            return None
+        
+        folder_name = self.folders[folder_index]
+        folder_path = os.path.join(self.app_path, folder_name)
+        src = self.current_file
+        
+        # Проверяем, существует ли исходный файл
+        if not source_exists(src):
+            raise FileNotFoundError("Source file not found")
+        
+        dst = self.resolve_destination(folder_path, os.path.basename(src))
+        
+        # Ставим перемещение в очередь и сохраняем его для функции Undo
+        operation = MoveOperation(src, dst, folder_name)
+        self.move_history.append(operation)
+        if self.scanner:
+            # Файл еще на месте - сканер не должен вернуть его в список
+            self.scan_excluded.add(src)
+        self.submit_move(operation)
+        
+        # Удаляем файл из списка, не дожидаясь перемещения
+        self.image_files.pop(self.current_index)
+        if self.image_files:
+            if self.current_index >= len(self.image_files):
+                self.current_index = 0
+        else:
+            self.current_file = None
+        
+        # Увеличиваем счетчик обработанных изображений
+        self.processed_images += 1
+        return operation
+
+    def move_selection(self, folder_index):
+        """Перемещает все выделенные изображения одним пакетом.
+        Возвращает пакет (или None) и признак того, что текущее изображение тоже перемещено"""
+        if folder_index >= len(self.folders):
+            return None, False
+        
+        # Файлы, которых уже нет в очереди, в пакет не попадают
+        paths = sorted(path for path in self.selection if path in self.image_files)
+        self.clear_selection()
+        if not paths:
+            return None, False
+        
+        folder_name = self.folders[folder_index]
+        folder_path = os.path.join(self.app_path, folder_name)
+        
+        # Имена в папке назначения подбираются сразу для всего пакета
+        destinations = self.name_index.reserve_many(folder_path, [os.path.basename(path) for path in paths])
+        batch = MoveBatch([MoveOperation(src, dst, folder_name) for src, dst in zip(paths, destinations)],
+                          folder_name)
+        self.move_history.append(batch)
+        if self.scanner:
+            self.scan_excluded.update(paths)
+        self.submit_move(batch)
+        
+        # Новая позиция текущего изображения с учетом удаленных перед ним файлов
+        removed_before = 0
+        for path in paths:
+            if self.image_files.index(path) < self.current_index:
+                removed_before += 1
+        current_removed = self.current_file in paths
+        for path in paths:
+            self.image_files.remove(path)
+        self.processed_images += len(paths)
+        
+        if self.image_files:
+            self.current_index -= removed_before
+            if self.current_index >= len(self.image_files):
+                self.current_index = 0
+            if current_removed:
+                self.current_file = None
+        else:
+            self.current_file = None
+        return batch, current_removed
+
+    def resolve_destination(self, folder_path, filename):
+        """Подбирает свободное имя в папке назначения с учетом перемещений в очереди"""
+        return self.name_index.reserve(folder_path, filename)
+
+    def submit_move(self, operation):
+        """Передает перемещение (или пакет) фоновому потоку"""
+        self.moves_in_flight += len(operation.operations) if isinstance(operation, MoveBatch) else 1
+        self.move_worker.submit(operation)
+
+    def poll_move_results(self):
+        """Обрабатывает завершенные фоновые перемещения. Неудавшиеся операции
+        возвращают файл в очередь и накапливаются в failed_moves"""
+        while True:
+            try:
+                operation = self.move_worker.results.get_nowait()
+            except queue.Empty:
+                break
+            self.moves_in_flight -= 1
+            
+            if isinstance(operation, UndoTask):
+                task, operation = operation, operation.operation
+                if task.done:
+                    self.name_index.release(operation.dst)
+                    if self.metadata:
+                        self.metadata.rename(operation.dst, operation.src)
+                    self.duplicates.rename(operation.dst, operation.src)
+                    self.finish_undo([operation])
+                    self.undone.append(operation)
+                elif task.error:
+                    self.undo_errors.append(f"Failed to undo action: {str(task.error)}")
+                # Иначе само перемещение не удалось - файл уже возвращен в очередь
+                continue
+            
+            if operation.status == MoveOperation.DONE:
+                # Метаданные и хэш переезжают вместе с файлом
+                if self.metadata:
+                    self.metadata.rename(operation.src, operation.dst)
+                self.duplicates.rename(operation.src, operation.dst)
+            
+            if operation.status == MoveOperation.FAILED:
+                self.name_index.release(operation.dst)
+                if isinstance(operation.error, FileExistsError):
+                    # Индекс папки устарел - перечитаем его при следующем перемещении
+                    self.name_index.invalidate(os.path.dirname(operation.dst))
+                # Файл остался на месте: убираем операцию из истории и возвращаем файл в очередь
+                # Состав пакета не меняем: его еще обходит поток перемещений. Неудавшиеся операции
+                # пакета отличаются по статусу, а пакет уходит из истории, когда не удались все
+                batch = operation.batch
+                if batch:
+                    if (batch in self.move_history and
+                            all(op.status == MoveOperation.FAILED for op in batch.operations)):
+                        self.move_history.remove(batch)
+                elif operation in self.move_history:
+                    self.move_history.remove(operation)
+                self.processed_images -= 1
+                if source_exists(operation.src):
+                    self.restore_to_queue(operation.src)
+                self.failed_moves.append(operation)
+
+    def in_source_folder(self, path):
+        """Файл лежит в папке с изображениями или в архиве из нее"""
+        archive = split_archive_path(path)[0]
+        return os.path.dirname(archive or path) == self.app_path
+
+    def restore_to_queue(self, path):
+        """Возвращает файл в отсортированный список изображений, сохраняя текущую позицию"""
+        index = self.image_files.add(path)
+        if self.current_file and index <= self.current_index:
+            self.current_index += 1
+        return index
+
+    def undo_last(self):
+        """Отменяет последнее действие (одиночное перемещение или пакет целиком).
+        Перемещения, которые еще стоят в очереди, отменяются сразу. Уже выполненные возвращает
+        фоновый поток, как и прямые перемещения: они появятся в undone (ошибки - в undo_errors)
+        после poll_move_results. Возвращает сразу восстановленные операции и число отправленных в фон"""
+        # Сначала учитываем уже завершенные фоновые перемещения (в том числе неудачные)
+        self.poll_move_results()
+        if not self.move_history:
+            return [], 0
+        
+        # Восстанавливаем последнее действие, перемещения пакета - в обратном порядке
+        entry = self.move_history.pop()
+        operations = entry.operations if isinstance(entry, MoveBatch) else [entry]
+        restored = []
+        pending = 0
+        for operation in reversed(list(operations)):
+            if operation.status == MoveOperation.FAILED:
+                # Файл не перемещался и уже возвращен в очередь
+                continue
+            if self.move_worker.cancel(operation):
+                # Перемещение еще в очереди - файл не трогали, достаточно вернуть его в список
+                self.moves_in_flight -= 1
+                self.name_index.release(operation.dst)
+                restored.append(operation)
+            else:
+                # Поток перемещений выполнит возврат после самого перемещения
+                self.moves_in_flight += 1
+                self.move_worker.submit(UndoTask(operation))
+                pending += 1
+        self.finish_undo(restored)
+        return restored, pending
+
+    def finish_undo(self, restored):
+        """Учитывает файлы, вернувшиеся на место: счетчики и очередь изображений"""
+        # Файл из прошлой сессии добавляется к общему числу изображений
+        for operation in restored:
+            if operation.from_journal:
+                self.total_images += 1
+            else:
+                self.processed_images -= 1
+        
+        # Файлы, вернувшиеся в другую папку, в текущий список не попадают
+        paths = [operation.src for operation in restored if self.in_source_folder(operation.src)]
+        if paths:
+            self.image_files.update(paths)
+            if self.current_file:
+                self.current_index = self.image_files.index(self.current_file)
+
+    def close(self):
+        """Останавливает фоновые потоки, дожидается перемещений и закрывает кэш метаданных"""
+        if self.scanner:
+            self.scanner.stop()
+        self.prefetcher.shutdown()
+        
+        # Дожидаемся завершения перемещений, поставленных в очередь
+        self.move_worker.shutdown()
+        
+        # Закрываем кэш метаданных: вытесняем лишнее и сжимаем базу
+        if self.metadata:
+            if self.metadata_indexer:
+                self.metadata_indexer.stop()
+            self.metadata.close()
+        self.display_cache.clear()
+        self.tile_cache.clear()
+        close_archives()
+    
+    def open_tiled(self, path):
+        """Декодирует изображение для просмотра с увеличением (выполняется в фоновом потоке)"""
+        max_bytes = self.memory.available(self.DISPLAY_OWNERS)
+        return TiledImage(path, self.tile_cache, min(self.viewer_decode_mb * 1024 * 1024, max_bytes), max_bytes)
+    
+    def dump_timings(self):
+        """Сохраняет сводку замеров рядом с настройками, если они собирались.
+        Возвращает путь к файлу или None"""
+        if not self.timer.samples or not self.timing_log_file:
+            return None
+        path = os.path.join(self.app_path, self.timing_log_file)
+        self.timer.dump(path)
+        return path
+
+class SortRule:
+    """Правило пакетной сортировки: все заданные условия должны выполняться одновременно.
+    
+    Условия по имени, расширению и размеру файла проверяются сразу, а размеры, ориентация
+    и анимация требуют чтения заголовка изображения"""
+    NAME_KEYS = {"glob", "regex", "extension", "min_size", "max_size"}
+    HEADER_KEYS = {"min_width", "max_width", "min_height", "max_height", "orientation", "animated"}
+    ORIENTATIONS = ("landscape", "portrait", "square")
+
+    def __init__(self, spec, folder):
+        unknown = set(spec) - self.NAME_KEYS - self.HEADER_KEYS - {"folder", "hotkey"}
+        if unknown:
+            raise ValueError(f"Unknown rule keys: {', '.join(sorted(unknown))}")
+        self.folder = folder
+        self.spec = spec
+        self.glob = spec.get("glob")
+        self.regex = re.compile(spec["regex"]) if "regex" in spec else None
+        extensions = spec.get("extension", ())
+        if isinstance(extensions, str):
+            extensions = [extensions]
+        self.extensions = {ext.lower() if ext.startswith('.') else '.' + ext.lower() for ext in extensions}
+        self.min_size = spec.get("min_size")
+        self.max_size = spec.get("max_size")
+        self.min_width = spec.get("min_width")
+        self.max_width = spec.get("max_width")
+        self.min_height = spec.get("min_height")
+        self.max_height = spec.get("max_height")
+        self.orientation = spec.get("orientation")
+        if self.orientation is not None and self.orientation not in self.ORIENTATIONS:
+            raise ValueError(f"Unknown orientation: {self.orientation}")
+        self.animated = spec.get("animated")
+        self.needs_header = bool(self.HEADER_KEYS & set(spec))
+
+    def matches_name(self, name, size):
+        """Проверяет условия, для которых не нужно открывать файл"""
+        if self.glob and not fnmatch.fnmatch(name.lower(), self.glob.lower()):
+            return False
+        if self.regex and not self.regex.search(name):
+            return False
+        if self.extensions and os.path.splitext(name)[1].lower() not in self.extensions:
+            return False
+        if self.min_size is not None and size < self.min_size:
+            return False
+        if self.max_size is not None and size > self.max_size:
+            return False
+        return True
+
+    def matches_header(self, header):
+        """Проверяет условия по заголовку изображения"""
+        width, height = header["width"], header["height"]
+        if self.min_width is not None and width < self.min_width:
+            return False
+        if self.max_width is not None and width > self.max_width:
+            return False
+        if self.min_height is not None and height < self.min_height:
+            return False
+        if self.max_height is not None and height > self.max_height:
+            return False
+        if self.orientation == "landscape" and width <= height:
+            return False
+        if self.orientation == "portrait" and height <= width:
+            return False
+        if self.orientation == "square" and width != height:
+            return False
+        if self.animated is not None and bool(self.animated) != header["animated"]:
+            return False
+        return True
+
+def read_image_header(path):
+    """Читает из заголовка размеры изображения и признак анимации (выполняется в пуле процессов)"""
+    try:
+        with Image.open(path) as image:
+            return {"width": image.width, "height": image.height,
+                    "animated": bool(getattr(image, "is_animated", False))}
+    except Exception:
+        # Поврежденный файл не подходит ни под одно правило с условиями по заголовку
+        return None
+
+def load_sort_rules(rules_path, folders, folder_hotkeys):
+    """Загружает правила из JSON и сопоставляет их папкам по имени или горячей клавише"""
+    with open(rules_path, 'r', encoding='utf-8') as f:
+        specs = json.load(f)
+    if isinstance(specs, dict):
+        specs = specs.get("rules", [])
+    
+    hotkey_folders = {hotkey: folder for folder, hotkey in folder_hotkeys.items() if folder in folders}
+    rules = []
+    for number, spec in enumerate(specs, 1):
+        if "folder" in spec:
+            folder = spec["folder"]
+        elif "hotkey" in spec:
+            folder = hotkey_folders.get(spec["hotkey"])
+            if folder is None:
+                raise ValueError(f"Rule {number}: no folder is assigned to hotkey '{spec['hotkey']}'")
+        else:
+            raise ValueError(f"Rule {number}: 'folder' or 'hotkey' is required")
+        if folder not in folders:
+            raise ValueError(f"Rule {number}: folder '{folder}' does not exist")
+        rules.append(SortRule(spec, folder))
+    return rules
+
+def plan_batch(app_path, rules, workers=0, metadata=None):
+    """Подбирает папку для каждого изображения в app_path.
+    Возвращает список (путь, номер правила) и количество файлов без подходящего правила"""
+    plan = []
+    pending = []  # (путь, размер, номер правила, с которого продолжить проверку после чтения заголовка)
+    unmatched = 0
+    with os.scandir(app_path) as entries:
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            if os.path.splitext(entry.name)[1].lower() not in IMAGE_EXTENSIONS:
+                continue
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except OSError:
+                continue
+            for number, rule in enumerate(rules):
+                if not rule.matches_name(entry.name, stat.st_size):
+                    continue
+                if rule.needs_header:
+                    pending.append((entry.path, stat, number))
+                else:
+                    plan.append((entry.path, number))
+                break
+            else:
+                unmatched += 1
+    
+    # Заголовки читаются только для файлов, которые дошли до правила с условиями по размерам
+    headers = {}
+    if metadata:
+        for path, stat, _ in pending:
+            meta = metadata.get(path, stat)
+            if meta:
+                headers[path] = {"width": meta["width"], "height": meta["height"],
+                                 "animated": meta["frames"] > 1}
+    missing = [path for path, _, _ in pending if path not in headers]
+    if missing:
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context("spawn")) as executor:
+            chunksize = max(1, min(256, len(missing) // (workers * 4)))
+            headers.update(zip(missing, executor.map(read_image_header, missing, chunksize=chunksize)))
+    
+    for path, stat, first in pending:
+        header = headers.get(path)
+        for number in range(first, len(rules)):
+            rule = rules[number]
+            if not rule.matches_name(os.path.basename(path), stat.st_size):
+                continue
+            if rule.needs_header and (header is None or not rule.matches_header(header)):
+                continue
+            plan.append((path, number))
+            break
+        else:
+            unmatched += 1
+    plan.sort()
+    return plan, unmatched
+
+def run_batch(args):
+    """Пакетная сортировка без интерфейса. Возвращает код завершения"""
+    app_path = os.path.abspath(args.dir or get_app_path())
+    folders = list_folders(app_path)
+    settings = {}
+    settings_path = os.path.join(app_path, SETTINGS_FILE)
+    if os.path.exists(settings_path):
+        with open(settings_path, 'r', encoding='utf-8') as f:
+            settings = json.load(f)
+    folder_hotkeys = settings.get("folder_hotkeys", {})
+    
+    try:
+        rules = load_sort_rules(args.rules or os.path.join(app_path, RULES_FILE), folders, folder_hotkeys)
+    except (OSError, ValueError, re.error) as e:
+        print(f"Error loading rules: {e}", file=sys.stderr)
+        return 2
+    
+    try:
+        metadata = MetadataCache(os.path.join(app_path, METADATA_FILE),
+                                 int(settings.get("metadata_cache_mb", 512)) * 1024 * 1024)
+    except sqlite3.Error:
+        metadata = None
+    
+    started = time.monotonic()
+    plan, unmatched = plan_batch(app_path, rules, args.workers, metadata)
+    
+    # Группируем файлы по папкам: для каждой папки одно перемещение пакетом
+    groups = OrderedDict((rule.folder, []) for rule in rules)
+    for path, number in plan:
+        groups[rules[number].folder].append(path)
+    name_index = FolderNameIndex()
+    batches = []
+    for folder, paths in groups.items():
+        if not paths:
+            continue
+        folder_path = os.path.join(app_path, folder)
+        destinations = name_index.reserve_many(folder_path, [os.path.basename(path) for path in paths])
+        batches.append(MoveBatch([MoveOperation(src, dst, folder) for src, dst in zip(paths, destinations)],
+                                 folder))
+    
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            for batch in batches:
+                for operation in batch.operations:
+                    f.write(f"{operation.src}\t{operation.dst}\n")
+    
+    for batch in batches:
+        print(f"{batch.folder}: {len(batch.operations)}")
+    print(f"Unmatched: {unmatched}")
+    
+    failed = 0
+    if not args.dry_run and batches:
+        # Журнал тот же, что у интерфейса: каждую папку можно отменить в GUI через Ctrl+Z
+        try:
+            journal = MoveJournal(os.path.join(app_path, JOURNAL_FILE))
+        except OSError as e:
+            print(f"Error opening journal: {e}", file=sys.stderr)
+            return 1
+        worker = MoveWorker(journal)
+        for batch in batches:
+            worker.submit(batch)
+        worker.shutdown()
+        while not worker.results.empty():
+            operation = worker.results.get()
+            if operation.status == MoveOperation.DONE:
+                if metadata:
+                    metadata.rename(operation.src, operation.dst)
+            else:
+                failed += 1
+                print(f"Failed to move {operation.src}: {operation.error}", file=sys.stderr)
+    if metadata:
+        metadata.close(vacuum=False)
+    
+    moved = len(plan) - failed
+    verb = "Would move" if args.dry_run else "Moved"
+    print(f"{verb} {moved} images in {time.monotonic() - started:.1f} s")
+    return 1 if failed else 0
+
+def main_batch(argv):
+    parser = argparse.ArgumentParser(
+        prog="image_sorter",
+        description="Sort images into folders by rules without the user interface.")
+    parser.add_argument("--batch", action="store_true", help="run rule-based sorting without the window")
+    parser.add_argument("--rules", help=f"rules file (default: {RULES_FILE} in the images folder)")
+    parser.add_argument("--dir", help="folder with images (default: the program folder)")
+    parser.add_argument("--dry-run", action="store_true", help="only show where files would be moved")
+    parser.add_argument("--report", help="write 'source<TAB>destination' lines for every planned move")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="processes for reading image headers (default: number of CPU cores)")
+    return run_batch(parser.parse_args(argv))
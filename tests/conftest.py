@@ -0,0 +1,51 @@
+import os
+import sys
+import time
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sorter_core import SortingSession
+
+
+def make_images(folder, names, size=(16, 12)):
+    """Создает маленькие JPEG с разным содержимым"""
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for i, name in enumerate(names):
+        path = os.path.join(folder, name)
+        Image.new('RGB', size, (i * 20 % 256, 40, 80)).save(path)
+        paths.append(path)
+    return paths
+
+
+def wait_moves(session, timeout=10):
+    """Обрабатывает результаты фоновых перемещений, пока очередь не опустеет"""
+    deadline = time.monotonic() + timeout
+    while session.moves_in_flight:
+        assert time.monotonic() < deadline, "moves did not finish"
+        session.poll_move_results()
+        time.sleep(0.001)
+
+
+def open_session(app_path):
+    """Сеанс над папкой app_path с уже просканированной очередью"""
+    session = SortingSession(app_path)
+    session.folders = session.get_existing_folders()
+    session.start_scan()
+    finished = False
+    while not finished:
+        _, finished = session.poll_scan()
+        time.sleep(0.001)
+    session.set_current(0)
+    return session
+
+
+@pytest.fixture
+def sorting_dir(tmp_path):
+    """Папка с изображениями f0.jpg ... f9.jpg и пустой папкой назначения Target"""
+    make_images(str(tmp_path), [f"f{i}.jpg" for i in range(10)])
+    os.makedirs(tmp_path / "Target")
+    return tmp_path
@@ -0,0 +1,76 @@
+import io
+import os
+import tarfile
+import tempfile
+import zipfile
+
+import pytest
+
+from sorter_core import ARCHIVE_SPOOL_PREFIX, archive_reader, close_archives, open_source
+
+MEMBERS = {f"dir/{i:02}.jpg": bytes([i]) * (1000 + i) for i in range(20)}
+
+
+@pytest.fixture(autouse=True)
+def spool_dir(tmp_path, monkeypatch):
+    """Копии сжатых TAR создаются во временной папке теста"""
+    spool = tmp_path / "spool"
+    spool.mkdir()
+    monkeypatch.setattr(tempfile, "tempdir", str(spool))
+    yield spool
+    close_archives()
+
+
+def make_archive(folder, name, mode):
+    path = os.path.join(folder, name)
+    if name.endswith(".zip"):
+        with zipfile.ZipFile(path, "w", mode) as archive:
+            for member, data in MEMBERS.items():
+                archive.writestr(member, data)
+    else:
+        with tarfile.open(path, mode) as archive:
+            for member, data in MEMBERS.items():
+                info = tarfile.TarInfo(member)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+    return path
+
+
+@pytest.mark.parametrize("name, mode", [
+    ("a.zip", zipfile.ZIP_STORED),
+    ("a.zip", zipfile.ZIP_DEFLATED),
+    ("a.tar", "w"),
+    ("a.tar.gz", "w:gz"),
+    ("a.tar.bz2", "w:bz2"),
+    ("a.tar.xz", "w:xz"),
+])
+def test_members_read_in_any_order(tmp_path, name, mode):
+    path = make_archive(str(tmp_path), name, mode)
+    reader = archive_reader(path)
+    assert sorted(reader.members) == sorted(MEMBERS)
+    for member in sorted(MEMBERS, reverse=True):
+        source = open_source(os.path.join(path, *member.split("/")))
+        with source:
+            assert source.read() == MEMBERS[member]
+
+
+def test_compressed_tar_is_unpacked_once(tmp_path, spool_dir):
+    path = make_archive(str(tmp_path), "a.tar.gz", "w:gz")
+    reader = archive_reader(path)
+    spools = [name for name in os.listdir(spool_dir) if name.startswith(ARCHIVE_SPOOL_PREFIX)]
+    assert spools == [os.path.basename(reader.spool)]
+    with reader.open("dir/05.jpg") as member:
+        assert member.read() == MEMBERS["dir/05.jpg"]
+    close_archives()
+    assert os.listdir(spool_dir) == []
+
+
+def test_damaged_compressed_tar(tmp_path, spool_dir):
+    path = make_archive(str(tmp_path), "a.tar.gz", "w:gz")
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:len(data) // 2])
+    with pytest.raises((OSError, tarfile.TarError)):
+        archive_reader(path)
+    assert os.listdir(spool_dir) == []
@@ -0,0 +1,82 @@
+import os
+import threading
+import time
+
+from conftest import open_session, wait_moves
+from sorter_core import MoveOperation
+
+
+def test_batch_moves_all_files(sorting_dir):
+    session = open_session(str(sorting_dir))
+    try:
+        session.select_range(len(session.image_files) - 1)
+        batch, current_removed = session.move_selection(0)
+        wait_moves(session)
+        assert current_removed
+        assert len(batch.operations) == 10
+        assert sorted(os.listdir(sorting_dir / "Target")) == sorted(f"f{i}.jpg" for i in range(10))
+        assert len(session.image_files) == 0
+        assert session.processed_images == 10
+    finally:
+        session.close()
+
+
+def test_batch_with_failing_operation(sorting_dir):
+    """Неудачная операция пакета не мешает выполнить остальные, даже если поток интерфейса
+    обрабатывает ее результат, пока поток перемещений еще идет по пакету"""
+    session = open_session(str(sorting_dir))
+    worker = session.move_worker
+    move_file = worker.move_file
+    resume = threading.Event()
+
+    def slow_move_file(src, dst, *args, **kwargs):
+        # Держим поток перемещений на f3, пока интерфейс не разберет ошибку f2
+        if os.path.basename(src) == "f3.jpg":
+            resume.wait(5)
+        return move_file(src, dst, *args, **kwargs)
+
+    worker.move_file = slow_move_file
+    try:
+        session.select_range(len(session.image_files) - 1)
+        os.remove(sorting_dir / "f2.jpg")
+        batch, _ = session.move_selection(0)
+        deadline = time.monotonic() + 5
+        while not session.failed_moves:
+            assert time.monotonic() < deadline
+            session.poll_move_results()
+            time.sleep(0.001)
+        resume.set()
+        wait_moves(session)
+
+        statuses = {os.path.basename(op.src): op.status for op in batch.operations}
+        assert statuses.pop("f2.jpg") == MoveOperation.FAILED
+        assert set(statuses.values()) == {MoveOperation.DONE}
+        assert sorted(os.listdir(sorting_dir / "Target")) == sorted(f"f{i}.jpg" for i in range(10) if i != 2)
+        assert session.processed_images == 9
+        assert batch in session.move_history
+
+        # Отмена возвращает все перемещенные файлы и пропускает неудавшийся
+        restored, pending = session.undo_last()
+        wait_moves(session)
+        assert session.undo_errors == []
+        assert len(restored) + len(session.undone) == 9
+        assert os.listdir(sorting_dir / "Target") == []
+        assert len(session.image_files) == 9
+    finally:
+        resume.set()
+        session.close()
+
+
+def test_batch_removed_from_history_when_all_fail(sorting_dir):
+    session = open_session(str(sorting_dir))
+    try:
+        session.select_range(1)
+        for name in ("f0.jpg", "f1.jpg"):
+            os.remove(sorting_dir / name)
+        batch, _ = session.move_selection(0)
+        wait_moves(session)
+        assert [op.status for op in batch.operations] == [MoveOperation.FAILED] * 2
+        assert batch not in session.move_history
+        assert session.processed_images == 0
+    finally:
+        session.close()
@@ -0,0 +1,61 @@
+import os
+
+from sorter_core import FolderNameIndex
+
+
+def touch(folder, *names):
+    for name in names:
+        open(os.path.join(folder, name), 'wb').close()
+
+
+def test_free_name_is_kept(tmp_path):
+    folder = str(tmp_path)
+    index = FolderNameIndex()
+    assert index.reserve(folder, "a.jpg") == os.path.join(folder, "a.jpg")
+
+
+def test_existing_names_get_suffixes(tmp_path):
+    folder = str(tmp_path)
+    touch(folder, "a.jpg", "a_1.jpg", "a_3.jpg")
+    index = FolderNameIndex()
+    names = [os.path.basename(path) for path in index.reserve_many(folder, ["a.jpg"] * 3 + ["b.jpg"])]
+    assert names == ["a_2.jpg", "a_4.jpg", "a_5.jpg", "b.jpg"]
+
+
+def test_released_suffix_is_reused(tmp_path):
+    folder = str(tmp_path)
+    touch(folder, "a.jpg")
+    index = FolderNameIndex()
+    first, second = index.reserve(folder, "a.jpg"), index.reserve(folder, "a.jpg")
+    index.release(first)
+    assert index.reserve(folder, "a.jpg") == first
+    index.release(second)
+    assert index.reserve(folder, "a.jpg") == second
+    index.release(os.path.join(folder, "a.jpg"))
+    assert index.reserve(folder, "a.jpg") == os.path.join(folder, "a.jpg")
+
+
+def test_missing_folder_starts_empty(tmp_path):
+    folder = str(tmp_path / "New")
+    index = FolderNameIndex()
+    assert index.reserve(folder, "a.jpg") == os.path.join(folder, "a.jpg")
+    assert index.reserve(folder, "a.jpg") == os.path.join(folder, "a_1.jpg")
+
+
+def test_invalidate_rescans_folder(tmp_path):
+    folder = str(tmp_path)
+    index = FolderNameIndex()
+    index.reserve(folder, "x.jpg")
+    # Файл появился в папке извне - индекс о нем не знает, пока его не сбросят
+    touch(folder, "a.jpg")
+    assert index.reserve(folder, "a.jpg") == os.path.join(folder, "a.jpg")
+    index.invalidate(folder)
+    assert index.reserve(folder, "a.jpg") == os.path.join(folder, "a_1.jpg")
+
+
+def test_names_compared_in_filesystem_case(tmp_path):
+    folder = str(tmp_path)
+    touch(folder, "a.jpg")
+    index = FolderNameIndex()
+    expected = "A_1.JPG" if os.path.normcase("A") == "a" else "A.JPG"
+    assert index.reserve(folder, "A.JPG") == os.path.join(folder, expected)
@@ -0,0 +1,72 @@
+import bisect
+import random
+
+import pytest
+
+from sorter_core import ImageQueue
+
+
+def check(queue, model):
+    assert len(queue) == len(model)
+    assert list(queue) == model
+    for i, path in enumerate(model):
+        assert queue[i] == path
+        assert queue[i - len(model)] == path
+        assert queue.index(path) == i
+        assert path in queue
+
+
+@pytest.mark.parametrize("load", [1, 2, 5, 1000])
+def test_random_operations_match_sorted_list(load):
+    rng = random.Random(load)
+    names = [f"img{i:04}.jpg" for i in range(300)]
+    model = sorted(rng.sample(names, 100))
+    queue = ImageQueue(reversed(model), load=load)
+    check(queue, model)
+    for step in range(600):
+        action = rng.random()
+        path = rng.choice(names)
+        if action < 0.4:
+            position = queue.add(path)
+            if path not in model:
+                bisect.insort(model, path)
+            assert position == model.index(path)
+        elif action < 0.7 and model:
+            path = rng.choice(model)
+            assert queue.remove(path) == model.index(path)
+            model.remove(path)
+        elif action < 0.85 and model:
+            index = rng.randrange(-len(model), len(model))
+            assert queue.pop(index) == model.pop(index)
+        else:
+            batch = rng.sample(names, rng.randrange(0, 40))
+            added = queue.update(batch)
+            new = set(batch) - set(model)
+            assert added == len(new)
+            model = sorted(set(model) | new)
+        if step % 50 == 0:
+            check(queue, model)
+    check(queue, model)
+
+
+def test_empty_queue_and_errors():
+    queue = ImageQueue(load=2)
+    assert len(queue) == 0 and list(queue) == []
+    with pytest.raises(IndexError):
+        queue[0]
+    with pytest.raises(ValueError):
+        queue.index("a.jpg")
+    with pytest.raises(ValueError):
+        queue.remove("a.jpg")
+    assert queue.add("b.jpg") == 0
+    assert queue.pop(0) == "b.jpg"
+    assert "b.jpg" not in queue
+    with pytest.raises(IndexError):
+        queue.pop(-1)
+
+
+def test_slices():
+    paths = [f"{i:02}.jpg" for i in range(20)]
+    queue = ImageQueue(paths, load=3)
+    assert queue[5:9] == paths[5:9]
+    assert queue[::-4] == paths[::-4]
@@ -0,0 +1,103 @@
+import os
+import shutil
+
+import pytest
+
+from conftest import make_images
+from sorter_core import JOURNAL_FILE, PART_SUFFIX, MoveJournal, SortingSession
+
+
+@pytest.fixture
+def app(tmp_path):
+    os.makedirs(tmp_path / "Cats")
+    return str(tmp_path)
+
+
+def interrupt(app, *moves):
+    """Записывает в журнал начала перемещений без завершения, как при аварийном выходе"""
+    journal = MoveJournal(os.path.join(app, JOURNAL_FILE))
+    ids = [journal.begin(src, dst) for src, dst in moves]
+    journal.close()
+    return ids
+
+
+def recover(app):
+    session = SortingSession(app)
+    recovered = session.recover_journal()
+    history = [(operation.src, operation.dst) for operation in session.move_history]
+    session.close()
+    # После восстановления в журнале не остается незакрытых записей
+    _, interrupted = MoveJournal(os.path.join(app, JOURNAL_FILE)).load_history(100)
+    assert interrupted == []
+    return recovered, history
+
+
+def test_finished_move_is_committed(app):
+    src, dst = os.path.join(app, "a.jpg"), os.path.join(app, "Cats", "a.jpg")
+    make_images(os.path.join(app, "Cats"), ["a.jpg"])
+    interrupt(app, (src, dst))
+    assert recover(app) == (1, [(src, dst)])
+    assert os.path.exists(dst)
+
+
+def test_move_not_started_is_aborted(app):
+    src, dst = os.path.join(app, "a.jpg"), os.path.join(app, "Cats", "a.jpg")
+    make_images(app, ["a.jpg"])
+    # Недокопированная часть при перемещении на другой диск
+    open(dst + PART_SUFFIX, 'wb').close()
+    interrupt(app, (src, dst))
+    assert recover(app) == (1, [])
+    assert os.path.exists(src)
+    assert not os.path.exists(dst)
+    assert not os.path.exists(dst + PART_SUFFIX)
+
+
+def test_lost_file_is_aborted(app):
+    interrupt(app, (os.path.join(app, "a.jpg"), os.path.join(app, "Cats", "a.jpg")))
+    assert recover(app) == (1, [])
+
+
+def test_copy_renamed_before_source_removed(app):
+    src, dst = os.path.join(app, "a.jpg"), os.path.join(app, "Cats", "a.jpg")
+    make_images(app, ["a.jpg"])
+    shutil.copy2(src, dst)
+    interrupt(app, (src, dst))
+    assert recover(app) == (1, [(src, dst)])
+    assert not os.path.exists(src)
+    assert os.path.exists(dst)
+
+
+def test_unrelated_destination_file_is_kept(app):
+    src, dst = os.path.join(app, "a.jpg"), os.path.join(app, "Cats", "a.jpg")
+    make_images(app, ["a.jpg"])
+    make_images(os.path.join(app, "Cats"), ["x.jpg", "a.jpg"])
+    interrupt(app, (src, dst))
+    assert recover(app) == (1, [])
+    assert os.path.exists(src)
+    assert os.path.exists(dst)
+
+
+def test_same_size_different_content_is_kept(app):
+    src, dst = os.path.join(app, "a.bin.jpg"), os.path.join(app, "Cats", "a.bin.jpg")
+    with open(src, 'wb') as f:
+        f.write(b'a' * 100)
+    with open(dst, 'wb') as f:
+        f.write(b'b' * 100)
+    shutil.copystat(src, dst)
+    interrupt(app, (src, dst))
+    assert recover(app) == (1, [])
+    with open(dst, 'rb') as f:
+        assert f.read() == b'b' * 100
+    assert os.path.exists(src)
+
+
+def test_history_keeps_journal_order(app):
+    names = ["a.jpg", "b.jpg", "c.jpg"]
+    make_images(os.path.join(app, "Cats"), names)
+    moves = [(os.path.join(app, name), os.path.join(app, "Cats", name)) for name in names]
+    journal = MoveJournal(os.path.join(app, JOURNAL_FILE))
+    journal.commit(journal.begin(*moves[0]))
+    journal.begin(*moves[1])
+    journal.commit(journal.begin(*moves[2]))
+    journal.close()
+    assert recover(app) == (1, moves)
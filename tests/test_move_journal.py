@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+from sorter_core import MoveJournal
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "journal.jsonl")
+
+
+def write_records(path, records):
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+
+@pytest.mark.parametrize("block_size", [1, 7, 64, 65536])
+def test_read_backwards_across_blocks(path, block_size):
+    records = [["M", i, f"src/{i}.jpg", f"dst/ä{i}.jpg"] for i in range(1, 50)]
+    write_records(path, records)
+    assert list(MoveJournal(path).read_backwards(block_size)) == records[::-1]
+
+
+def test_torn_tail_is_skipped_and_new_records_start_on_new_line(path):
+    write_records(path, [["M", 1, "a", "b"], ["C", 1]])
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('["M",2,"c"')
+    journal = MoveJournal(path)
+    assert journal.next_id == 2
+    journal.commit(journal.begin("c", "d"))
+    journal.close()
+    assert list(MoveJournal(path).read_backwards()) == [["C", 2], ["M", 2, "c", "d"], ["C", 1], ["M", 1, "a", "b"]]
+
+
+def test_ids_continue_across_sessions(path):
+    journal = MoveJournal(path)
+    assert [journal.begin("a", "b"), journal.begin("c", "d")] == [1, 2]
+    journal.close()
+    journal = MoveJournal(path)
+    assert journal.begin("e", "f", batch=7) == 3
+    journal.close()
+    assert next(MoveJournal(path).read_backwards()) == ["M", 3, "e", "f", 7]
+
+
+def test_load_history_states(path):
+    journal = MoveJournal(path)
+    done = journal.begin("done", "x")
+    journal.commit(done)
+    undone = journal.begin("undone", "x")
+    journal.commit(undone)
+    journal.undo(undone)
+    journal.abort(journal.begin("aborted", "x"))
+    interrupted = journal.begin("interrupted", "x")
+    journal.close()
+
+    history, pending = MoveJournal(path).load_history(100)
+    assert history == [["M", done, "done", "x"]]
+    assert pending == [["M", interrupted, "interrupted", "x"]]
+
+
+def test_load_history_limit_keeps_newest(path):
+    journal = MoveJournal(path)
+    for i in range(10):
+        journal.commit(journal.begin(f"{i}", "x"))
+    journal.close()
+    history, _ = MoveJournal(path).load_history(3)
+    assert [record[2] for record in history] == ["7", "8", "9"]
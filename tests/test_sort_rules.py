@@ -0,0 +1,83 @@
+import json
+import os
+
+import pytest
+from PIL import Image
+
+from sorter_core import SortRule, load_sort_rules, plan_batch
+
+
+@pytest.fixture
+def app(tmp_path):
+    Image.new("RGB", (40, 20)).save(tmp_path / "wide.jpg")
+    Image.new("RGB", (20, 40)).save(tmp_path / "tall.png")
+    Image.new("RGB", (30, 30)).save(tmp_path / "square.jpg")
+    frames = [Image.new("RGB", (10, 10), color) for color in ("red", "blue")]
+    frames[0].save(tmp_path / "anim.gif", save_all=True, append_images=frames[1:])
+    (tmp_path / "broken.jpg").write_bytes(b"not an image")
+    (tmp_path / "notes.txt").write_text("skip")
+    for folder in ("Wide", "Tall", "Gifs", "Rest"):
+        (tmp_path / folder).mkdir()
+    return str(tmp_path)
+
+
+def planned(plan, rules):
+    return {os.path.basename(path): rules[number].folder for path, number in plan}
+
+
+def test_name_rules_do_not_open_files(app):
+    rules = [SortRule({"extension": "gif"}, "Gifs"), SortRule({"glob": "*.JPG"}, "Rest")]
+    plan, unmatched = plan_batch(app, rules, workers=1)
+    assert planned(plan, rules) == {"anim.gif": "Gifs", "wide.jpg": "Rest",
+                                         "square.jpg": "Rest", "broken.jpg": "Rest"}
+    assert unmatched == 1
+    assert [path for path, _ in plan] == sorted(path for path, _ in plan)
+
+
+def test_header_rules_fall_through_to_later_rules(app):
+    rules = [
+        SortRule({"animated": True}, "Gifs"),
+        SortRule({"orientation": "landscape", "extension": [".jpg"]}, "Wide"),
+        SortRule({"orientation": "portrait"}, "Tall"),
+        SortRule({"regex": r"^s"}, "Rest"),
+    ]
+    plan, unmatched = plan_batch(app, rules, workers=1)
+    assert planned(plan, rules) == {"anim.gif": "Gifs", "wide.jpg": "Wide",
+                                         "tall.png": "Tall", "square.jpg": "Rest"}
+    # Поврежденный файл не подходит под правила по заголовку
+    assert unmatched == 1
+
+
+def test_cached_headers_skip_the_process_pool(app, monkeypatch):
+    class Metadata:
+        def get(self, path, stat):
+            return {"width": 1, "height": 2, "frames": 1}
+
+    def no_pool(*args, **kwargs):
+        raise AssertionError("headers should come from the cache")
+
+    monkeypatch.setattr("sorter_core.ProcessPoolExecutor", no_pool)
+    rules = [SortRule({"orientation": "portrait"}, "Tall")]
+    plan, unmatched = plan_batch(app, rules, metadata=Metadata())
+    assert len(plan) == 5 and unmatched == 0
+
+
+def test_load_rules_by_folder_and_hotkey(app, tmp_path):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps({"rules": [{"folder": "Wide", "min_width": 30}, {"hotkey": "g", "animated": True}]}))
+    rules = load_sort_rules(str(path), ["Wide", "Gifs"], {"Gifs": "g"})
+    assert [(rule.folder, rule.needs_header) for rule in rules] == [("Wide", True), ("Gifs", True)]
+
+
+@pytest.mark.parametrize("spec, message", [
+    ({"folder": "Missing"}, "does not exist"),
+    ({"hotkey": "x"}, "no folder is assigned"),
+    ({"glob": "*"}, "'folder' or 'hotkey' is required"),
+    ({"folder": "Wide", "colour": "red"}, "Unknown rule keys: colour"),
+    ({"folder": "Wide", "orientation": "round"}, "Unknown orientation"),
+])
+def test_invalid_rules(tmp_path, spec, message):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps([spec]))
+    with pytest.raises(ValueError, match=message):
+        load_sort_rules(str(path), ["Wide"], {})
@@ -0,0 +1,72 @@
+import random
+
+import pytest
+from PIL import Image
+
+from sorter_core import DisplayCache, MemoryBudgetError, RegionReader, TiledImage, display_mode
+
+
+@pytest.fixture(scope="module")
+def picture():
+    return Image.effect_mandelbrot((997, 613), (-2, -1.2, 1, 1.2), 60).convert("RGB")
+
+
+@pytest.mark.parametrize("name, mode, options", [
+    ("a.bmp", "RGB", {}),
+    ("a.bmp", "P", {}),
+    ("a.bmp", "1", {}),
+    ("a.ppm", "RGB", {}),
+    ("a.tif", "RGBA", {}),
+    ("a.tif", "L", {"tiffinfo": {278: 37}}),  # 37 строк в полосе
+])
+def test_region_matches_full_decode(tmp_path, picture, name, mode, options):
+    path = str(tmp_path / name)
+    picture.convert(mode).save(path, **options)
+    with Image.open(path) as image:
+        reader = RegionReader.probe(path, image)
+        full = image.copy()
+    assert reader is not None
+    rng = random.Random(1)
+    for _ in range(20):
+        x0, y0 = rng.randrange(0, 990), rng.randrange(0, 600)
+        box = (x0, y0, rng.randrange(x0 + 1, 998), rng.randrange(y0 + 1, 614))
+        assert reader.read(box).tobytes() == full.crop(box).tobytes()
+    for reduction in (1, 4):
+        assert reader.overview(reduction, display_mode).tobytes() == display_mode(full).reduce(reduction).tobytes()
+
+
+@pytest.mark.parametrize("name, options", [("a.png", {}), ("a.jpg", {}), ("a.tif", {"compression": "tiff_lzw"})])
+def test_compressed_formats_have_no_region_reader(tmp_path, picture, name, options):
+    path = str(tmp_path / name)
+    picture.save(path, **options)
+    with Image.open(path) as image:
+        assert RegionReader.probe(path, image) is None
+
+
+def test_zoom_past_overview_decodes_full_resolution(tmp_path, picture):
+    path = str(tmp_path / "a.bmp")
+    picture.save(path)
+    # Обзорная копия в половину размера: 997 * 613 * 3 байт не помещаются в лимит
+    source = TiledImage(path, DisplayCache(16 * 1024 * 1024), max_decode_bytes=600 * 1024)
+    assert source.detail_scale < 1
+    assert source.needs_region(1.0) and not source.needs_region(source.detail_scale)
+    assert source.cached_region_tile(1.0, 1, 1) is None
+    tile = source.region_tile(1.0, 1, 1)
+    assert tile.tobytes() == picture.crop((256, 256, 512, 512)).tobytes()
+    assert source.cached_region_tile(1.0, 1, 1) is tile
+
+
+def test_jpeg_detail_is_limited_to_draft_scale(tmp_path, picture):
+    path = str(tmp_path / "a.jpg")
+    picture.save(path)
+    source = TiledImage(path, DisplayCache(16 * 1024 * 1024), max_decode_bytes=600 * 1024)
+    assert source.region is None
+    assert source.detail_scale == pytest.approx(0.5, abs=0.01)
+    assert not source.needs_region(1.0)
+
+
+def test_whole_image_formats_over_budget_are_refused(tmp_path, picture):
+    path = str(tmp_path / "a.png")
+    picture.save(path)
+    with pytest.raises(MemoryBudgetError):
+        TiledImage(path, DisplayCache(16 * 1024 * 1024), max_decode_bytes=600 * 1024, max_bytes=1024 * 1024)